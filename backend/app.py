@@ -1,8 +1,9 @@
 from flask import Flask, jsonify, send_from_directory, request, session, send_file, Response
 from flask_cors import CORS
-from flask_bcrypt import Bcrypt
-from flask_session import Session
+from flask.sessions import SessionInterface, SessionMixin
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_range_header
+from werkzeug.datastructures import CallbackDict
 from functools import wraps
 import os
 import sqlite3
@@ -12,11 +13,34 @@ from playwright.async_api import async_playwright
 import base64
 from io import BytesIO
 import threading
-import requests
-from urllib.parse import urljoin, urlparse, quote
+import httpx
+from urllib.parse import urljoin, urlparse, quote, parse_qsl
 from bs4 import BeautifulSoup
+from PIL import Image, ImageOps
+from hypercorn.asyncio import serve as hypercorn_serve
+from hypercorn.config import Config as HypercornConfig
+from hypercorn.middleware import AsyncioWSGIMiddleware
 import uuid
 import re
+import shutil
+import queue
+import sys
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import hmac
+import copy
+import codecs
+import secrets
+import multiprocessing
+import bcrypt as bcrypt_lib
+import tempfile
+import time
+import traceback
+import mimetypes
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
 
 # --- App Initialization and Configuration ---
 static_folder_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'frontend'))
@@ -24,16 +48,60 @@ UPLOADS_FOLDER_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '.
 
 app = Flask(__name__, static_folder=static_folder_path)
 app.config['SECRET_KEY'] = 'supersecretkey'
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = os.path.join(os.path.dirname(__file__), '.flask_session')
-app.config['SESSION_PERMANENT'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400
+app.config['SESSION_CACHE_MAX_ENTRIES'] = 10000 # Login sessions kept in memory in front of SQLite
+app.config['SESSION_CACHE_TTL'] = 60 # Seconds a cached session is trusted before re-reading it (other workers may log it out)
+app.config['SESSION_REFRESH_INTERVAL'] = 3600 # A session's expiry is pushed back at most this often
+app.config['SESSION_SWEEP_INTERVAL'] = 300 # Seconds between deletions of expired sessions
 
 CORS(app, supports_credentials=True, origins=["http://127.0.0.1:5001"])
-Session(app)
-bcrypt = Bcrypt(app)
 
 DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'db', 'database.db'))
+app.config['BCRYPT_LOG_ROUNDS'] = 12 # Work factor for new hashes; older, cheaper hashes are upgraded at login
+app.config['PASSWORD_HASH_WORKERS'] = os.cpu_count() or 1 # bcrypt worker processes; 0 hashes on the request thread
+app.config['PASSWORD_HASH_QUEUE'] = 64 # Logins/registrations hashing or waiting at once before new ones get 503
+app.config['DB_POOL_SIZE'] = 16 # Idle connections kept open; 0 disables pooling
+app.config['DB_BUSY_TIMEOUT'] = 5000 # Milliseconds to wait on a locked database
+app.config['DB_CACHED_STATEMENTS'] = 256 # Prepared statements cached per connection
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024 # Bytes per chunk for resumable uploads
+app.config['UPLOAD_SESSION_TTL'] = 86400 # Seconds an idle resumable upload is kept
+# Downloads already go through the server's zero-copy wsgi.file_wrapper (sendfile) when it has one;
+# set this when running behind Apache/lighttpd to hand the transfer to the front end instead.
+app.config['USE_X_SENDFILE'] = False
+app.config['THUMBNAIL_SIZES'] = {'small': 128, 'medium': 256, 'large': 1280} # Longest edge in pixels
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['CONTENT_PAGE_MAX_BYTES'] = 4 * 1024 * 1024 # Largest window /api/files/content returns at once
+app.config['CONTENT_PAGE_MAX_LINES'] = 10000
+app.config['DIR_CACHE_MAX_ENTRIES'] = 10000 # Folder listings kept in memory
+app.config['SETTINGS_CACHE_MAX_ENTRIES'] = 10000 # Users' parsed settings kept in memory
+app.config['SETTINGS_CACHE_TTL'] = 30 # Seconds cached settings are trusted before re-reading them (other workers may write)
+app.config['SEARCH_MAX_TEXT_BYTES'] = 1024 * 1024 # Leading bytes of each file indexed for content search
+app.config['SEARCH_PAGE_SIZE'] = 50 # Results per page of /api/search, unless the client asks for fewer
+app.config['SEARCH_TERMINAL_MAX_LINES'] = 1000 # Lines the terminal's find and grep print before stopping
+app.config['TERMINAL_READ_SIZE'] = 64 * 1024 # Bytes cat reads from a file at a time
+app.config['TERMINAL_FLUSH_BYTES'] = 16 * 1024 # Streamed terminal output is sent once this much is buffered...
+app.config['TERMINAL_FLUSH_INTERVAL'] = 0.05 # ...or this many seconds after the previous send
+app.config['BROWSER_PROCESSES'] = 2 # Shared Chromium processes; each user gets a BrowserContext in one of them
+app.config['BROWSER_MAX_CONTEXTS'] = 200 # Open user sessions before the least recently used is reclaimed
+app.config['BROWSER_IDLE_TIMEOUT'] = 900 # Seconds before an unused session is closed
+app.config['BROWSER_PREWARM_CONTEXTS'] = 2 # Ready-made contexts (with a blank page) waiting for new sessions
+app.config['BROWSER_NAVIGATION_TIMEOUT'] = 60000 # Default and maximum navigation timeout in ms
+app.config['BROWSER_REQUEST_TIMEOUT'] = 90 # Seconds before a browser request is cancelled with 504
+app.config['BROWSER_PERSIST_INTERVAL'] = 30 # Seconds between saves of changed sessions' cookies and tabs
+app.config['RENDER_CACHE_MAX_BYTES'] = 64 * 1024 * 1024 # Rewritten pages kept in memory for /view
+app.config['RENDER_CACHE_TTL'] = 300 # Seconds a rewritten page may be served again
+app.config['PROXY_CACHE_MAX_BYTES'] = 1024 * 1024 * 1024 # Proxied assets kept on disk, shared by all users
+app.config['PROXY_CACHE_MAX_OBJECT'] = 64 * 1024 * 1024 # Larger responses are streamed but not stored
+app.config['PROXY_HEURISTIC_MAX_AGE'] = 86400 # Cap on the freshness guessed from Last-Modified alone
+app.config['PROXY_CHUNK_SIZE'] = 64 * 1024 # Bytes relayed per read from the origin or the cache
+app.config['PROXY_MAX_PER_SESSION'] = 16 # Concurrent upstream fetches per browser session (ASGI mode)
+app.config['PROXY_MAX_PER_ORIGIN'] = 6 # Concurrent upstream fetches per origin host (ASGI mode)
+app.config['CAPTURED_ASSETS_MAX_BYTES'] = 256 * 1024 * 1024 # Asset bodies kept from Chromium's own loads, all sessions
+app.config['CAPTURED_ASSET_MAX_OBJECT'] = 8 * 1024 * 1024 # Larger responses are left to the proxy
+app.config['SCREENCAST_MAX_FPS'] = 15 # Upper bound on frames per second of a live view stream
+app.config['SCREENCAST_MAX_KBPS'] = 2000 # Upper bound on a live view stream's egress in kilobits per second
+app.config['SCREENCAST_QUALITY'] = 70 # Starting and highest JPEG quality; lowered while bandwidth-bound
+app.config['SCREENCAST_MIN_QUALITY'] = 30
 
 # --- Decorators ---
 def login_required(f):
@@ -45,10 +113,21 @@ def login_required(f):
     return decorated_function
 
 # --- Database Setup ---
+def connect_db(busy_timeout=None, cached_statements=None):
+    """Opens a configured connection: WAL journal, NORMAL sync and a busy timeout (via `timeout`)."""
+    busy_timeout = app.config['DB_BUSY_TIMEOUT'] if busy_timeout is None else busy_timeout
+    cached_statements = app.config['DB_CACHED_STATEMENTS'] if cached_statements is None else cached_statements
+    conn = sqlite3.connect(DB_PATH, timeout=busy_timeout / 1000, check_same_thread=False,
+                           cached_statements=cached_statements)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
 def init_db():
     if not os.path.exists(UPLOADS_FOLDER_PATH):
         os.makedirs(UPLOADS_FOLDER_PATH)
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -71,12 +150,1576 @@ def init_db():
         FOREIGN KEY (parent_id) REFERENCES files (id) ON DELETE CASCADE
     )''')
     conn.commit()
+    migrate_db(conn)
     conn.close()
 
+def dedupe_file_paths(conn):
+    """Renames all but the oldest of same-named items in a folder to 'name (2).ext', 'name (3).ext', ..."""
+    duplicates = conn.execute('''
+        SELECT f.id FROM files f WHERE f.path IS NOT NULL AND EXISTS (
+            SELECT 1 FROM files g WHERE g.user_id = f.user_id AND g.path = f.path AND g.id < f.id
+        ) ORDER BY length(f.path), f.id''').fetchall()
+    for duplicate in duplicates:
+        # Renaming a folder repaths its children, which may settle their own clashes
+        row = conn.execute('SELECT * FROM files WHERE id = ?', (duplicate['id'],)).fetchone()
+        if not conn.execute('SELECT 1 FROM files WHERE user_id = ? AND path = ? AND id < ?',
+                            (row['user_id'], row['path'], row['id'])).fetchone():
+            continue
+        parent_path = row['path'].rsplit('/', 1)[0]
+        base, extension = (row['filename'], '') if row['is_folder'] else os.path.splitext(row['filename'])
+        counter = 2
+        while conn.execute('SELECT 1 FROM files WHERE user_id = ? AND path = ?',
+                           (row['user_id'], f'{parent_path}/{base} ({counter}){extension}')).fetchone():
+            counter += 1
+        filename = f'{base} ({counter}){extension}'
+        conn.execute('UPDATE files SET filename = ?, path = ? WHERE id = ?', (filename, f'{parent_path}/{filename}', row['id']))
+        if row['is_folder']:
+            repath_subtree(conn, row['user_id'], row['id'], f'{parent_path}/{filename}')
+
+# Each entry is one schema version; PRAGMA user_version records how many have been applied.
+# Statements are SQL strings, or functions taking the connection for steps SQL can't express.
+# Append new migrations at the end, never edit or reorder applied ones.
+SCHEMA_MIGRATIONS = [
+    # 1: indexes for the files hot paths (listing, name lookup in a folder, child lookup).
+    # Root listings are the most frequent, so they also get a small partial index of their own.
+    [
+        'CREATE INDEX IF NOT EXISTS idx_files_listing ON files (user_id, parent_id, is_folder DESC, filename)',
+        'CREATE INDEX IF NOT EXISTS idx_files_name ON files (user_id, parent_id, filename)',
+        'CREATE INDEX IF NOT EXISTS idx_files_root_listing ON files (user_id, is_folder DESC, filename) WHERE parent_id IS NULL',
+        'CREATE INDEX IF NOT EXISTS idx_files_parent ON files (parent_id)',
+    ],
+    # 2: durable queue of physical files waiting to be unlinked by the reclaimer thread.
+    [
+        '''CREATE TABLE IF NOT EXISTS pending_deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT NOT NULL,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ],
+    # 3: content-addressed blob store. files.blob_hash is NULL for files stored before the blob store existed.
+    [
+        '''CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL,
+            path TEXT UNIQUE NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount <= 0',
+        'ALTER TABLE files ADD COLUMN blob_hash TEXT',
+    ],
+    # 4: resumable chunked uploads. One row per received chunk, so chunks can arrive in any order.
+    [
+        '''CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            parent_id INTEGER,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            tmp_path TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at)',
+        '''CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, chunk_index)
+        ) WITHOUT ROWID''',
+    ],
+    # 5: materialized paths ('/docs/notes.txt') so any path resolves with one indexed lookup
+    # and a subtree is the range path >= '<folder>/' AND path < '<folder>0' ('0' sorts right after '/').
+    [
+        "UPDATE files SET parent_id = NULL WHERE parent_id = ''", # Root uploads used to store ''
+        'ALTER TABLE files ADD COLUMN path TEXT',
+        'CREATE TEMP TABLE file_paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL)',
+        '''INSERT INTO temp.file_paths (id, path)
+            WITH RECURSIVE tree(id, path) AS (
+                SELECT id, '/' || filename FROM files WHERE parent_id IS NULL
+                UNION ALL
+                SELECT f.id, t.path || '/' || f.filename FROM files f JOIN tree t ON f.parent_id = t.id
+            )
+            SELECT id, path FROM tree''',
+        'UPDATE files SET path = (SELECT path FROM temp.file_paths p WHERE p.id = files.id)',
+        'DROP TABLE temp.file_paths',
+        'CREATE INDEX IF NOT EXISTS idx_files_path ON files (user_id, path)',
+    ],
+    # 6: browser sessions that outlive the process: each user's cookies/localStorage and open tabs.
+    [
+        '''CREATE TABLE IF NOT EXISTS browser_state (
+            user_id INTEGER PRIMARY KEY,
+            storage_state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS browser_pages (
+            user_id INTEGER NOT NULL,
+            page_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (user_id, page_id)
+        ) WITHOUT ROWID''',
+    ],
+    # 7: login sessions, replacing one Flask-Session pickle file per session.
+    [
+        '''CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+    ],
+    # 8: a version per settings blob, so concurrent writers can compare-and-swap instead of overwriting.
+    [
+        'ALTER TABLE users ADD COLUMN settings_version INTEGER NOT NULL DEFAULT 0',
+    ],
+    # 9: full-text search over names and text contents. The trigram tokenizer gives substring matches,
+    # the owner column ('<user_id>') keeps each query to one user's documents. Names follow files
+    # through triggers; content changes are queued in search_queue for the SearchIndexer thread.
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(owner, name, body, tokenize = 'trigram')",
+        '''CREATE TABLE IF NOT EXISTS search_queue (
+            file_id INTEGER PRIMARY KEY,
+            file_path TEXT NOT NULL
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+            INSERT INTO search_index (rowid, owner, name, body) VALUES (new.id, '<' || new.user_id || '>', new.filename, '');
+            INSERT OR REPLACE INTO search_queue (file_id, file_path)
+                SELECT new.id, new.file_path WHERE NOT new.is_folder AND new.file_path IS NOT NULL;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS files_search_rename AFTER UPDATE OF filename ON files BEGIN
+            UPDATE search_index SET name = new.filename WHERE rowid = new.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS files_search_content AFTER UPDATE OF file_path ON files
+            WHEN NOT new.is_folder AND new.file_path IS NOT old.file_path BEGIN
+            INSERT OR REPLACE INTO search_queue (file_id, file_path) VALUES (new.id, new.file_path);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+            DELETE FROM search_index WHERE rowid = old.id;
+            DELETE FROM search_queue WHERE file_id = old.id;
+        END''',
+        "INSERT INTO search_index (rowid, owner, name, body) SELECT id, '<' || user_id || '>', filename, '' FROM files",
+        'INSERT INTO search_queue (file_id, file_path) SELECT id, file_path FROM files WHERE NOT is_folder AND file_path IS NOT NULL',
+    ],
+    # 10: unique paths. Migration 5 left rows whose parent chain doesn't reach the root without a path;
+    # they are moved to the root and given one. Same-named items in a folder are renamed apart so
+    # (user_id, path) can be unique, which every path-range query relies on.
+    [
+        '''UPDATE files SET parent_id = NULL WHERE path IS NULL AND parent_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM files p WHERE p.id = files.parent_id AND p.user_id = files.user_id AND p.is_folder
+        )''',
+        'CREATE TEMP TABLE file_paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL)',
+        '''INSERT INTO temp.file_paths (id, path)
+            WITH RECURSIVE tree(id, path) AS (
+                SELECT f.id, COALESCE(p.path, '') || '/' || f.filename FROM files f LEFT JOIN files p ON p.id = f.parent_id
+                WHERE f.path IS NULL AND (f.parent_id IS NULL OR p.path IS NOT NULL)
+                UNION ALL
+                SELECT f.id, t.path || '/' || f.filename FROM files f JOIN tree t ON f.parent_id = t.id WHERE f.path IS NULL
+            )
+            SELECT id, path FROM tree''',
+        'UPDATE files SET path = (SELECT path FROM temp.file_paths p WHERE p.id = files.id) WHERE id IN (SELECT id FROM temp.file_paths)',
+        'DROP TABLE temp.file_paths',
+        dedupe_file_paths,
+        'DROP INDEX IF EXISTS idx_files_path',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_files_unique_path ON files (user_id, path)',
+    ],
+    # 11: files longer than SEARCH_MAX_TEXT_BYTES, whose indexed body is only a prefix. grep can't
+    # rule them out by their indexed text. Everything is queued again so the indexer can record them.
+    [
+        'CREATE TABLE IF NOT EXISTS search_truncated (file_id INTEGER PRIMARY KEY)',
+        '''CREATE TRIGGER IF NOT EXISTS files_search_truncated_delete AFTER DELETE ON files BEGIN
+            DELETE FROM search_truncated WHERE file_id = old.id;
+        END''',
+        'INSERT OR REPLACE INTO search_queue (file_id, file_path) SELECT id, file_path FROM files WHERE NOT is_folder AND file_path IS NOT NULL',
+    ],
+]
+
+def migrate_db(conn):
+    """Applies any pending SCHEMA_MIGRATIONS, each in its own transaction."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    conn.execute('PRAGMA optimize')
+
+class PooledConnection:
+    """Wraps a pooled sqlite3 connection; close() hands it back to the pool instead of closing it."""
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+class ConnectionPool:
+    """A bounded pool of idle SQLite connections shared by the request worker threads."""
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect_db()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback() # Never leak an unfinished transaction to the next request
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(app.config['DB_POOL_SIZE'])
+    return db_pool
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    if app.config['DB_POOL_SIZE'] <= 0:
+        return connect_db()
+    return get_db_pool().acquire()
+
+# --- Background File Reclamation ---
+class FileReclaimer:
+    """Unlinks files queued in pending_deletions on a daemon thread.
+
+    The queue lives in SQLite, so anything left over from a crash or restart is
+    picked up again on the next start.
+    """
+    def __init__(self, batch_size=500, interval=30):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='file-reclaimer', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.expire_uploads()
+                while self.reclaim_batch() == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"File reclamation failed: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def expire_uploads(self):
+        """Queues the temp files of resumable uploads that have been idle longer than UPLOAD_SESSION_TTL."""
+        cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT INTO pending_deletions (file_path) SELECT tmp_path FROM upload_sessions WHERE updated_at < ?', (cutoff,))
+            conn.execute('DELETE FROM upload_chunks WHERE upload_id IN (SELECT id FROM upload_sessions WHERE updated_at < ?)', (cutoff,))
+            conn.execute('DELETE FROM upload_sessions WHERE updated_at < ?', (cutoff,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def reclaim_batch(self):
+        trash_dir = os.path.join(UPLOADS_FOLDER_PATH, 'trash')
+        os.makedirs(trash_dir, exist_ok=True)
+        conn = get_db_connection()
+        try:
+            # Under the write lock, dead files are only renamed into trash/, which is cheap;
+            # a concurrent upload can then re-create a blob at its path without losing it.
+            # The slow unlinks happen after the lock is released.
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('SELECT id, file_path FROM pending_deletions ORDER BY id LIMIT ?',
+                                (self.batch_size,)).fetchall()
+            done = []
+            for row in rows:
+                if conn.execute('SELECT 1 FROM blobs WHERE path = ?', (row['file_path'],)).fetchone():
+                    done.append((row['id'],)) # The content was uploaded again; keep the file
+                    continue
+                try:
+                    os.rename(row['file_path'], os.path.join(trash_dir, str(row['id'])))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Could not remove {row['file_path']}: {e}")
+                    continue # Leave it queued and retry on the next pass
+                done.append((row['id'],))
+            conn.executemany('DELETE FROM pending_deletions WHERE id = ?', done)
+            conn.commit()
+        finally:
+            conn.close()
+        self.empty_trash(trash_dir)
+        return len(done)
+
+    def empty_trash(self, trash_dir):
+        """Unlinks everything in trash/, including leftovers from a crash after the rename."""
+        for name in os.listdir(trash_dir):
+            try:
+                os.remove(os.path.join(trash_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove {name} from trash: {e}")
+
+file_reclaimer = FileReclaimer()
+
+# --- Login Sessions ---
+class StoredSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the session to a fresh id when it is saved and deletes the old one (call on login)."""
+        if self.sid is not None:
+            self.replaced_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+class SQLiteSessionInterface(SessionInterface):
+    """Server-side sessions in the sessions table, with an in-memory LRU in front of it.
+
+    The cookie holds a random session id. Authenticated requests are served from the LRU
+    without touching the database; entries are re-read after SESSION_CACHE_TTL so a logout
+    in another worker takes effect. A session is only written when its contents change, and
+    its expiry only moves forward every SESSION_REFRESH_INTERVAL. A daemon thread deletes
+    expired rows in batches every SESSION_SWEEP_INTERVAL.
+    """
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._cache = OrderedDict() # sid -> (data, expires_at, cached_at)
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep, name='session-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            try:
+                while self.expire_batch(self.batch_size) == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"Session expiry failed: {e}")
+            time.sleep(app.config['SESSION_SWEEP_INTERVAL'])
+
+    def _forget(self, conn, sid):
+        conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def _cache_put(self, sid, data, expires_at):
+        with self._lock:
+            self._cache[sid] = (data, expires_at, time.monotonic())
+            self._cache.move_to_end(sid)
+            while len(self._cache) > app.config['SESSION_CACHE_MAX_ENTRIES']:
+                self._cache.popitem(last=False)
+
+    def _load(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry and entry[1] > now and time.monotonic() - entry[2] < app.config['SESSION_CACHE_TTL']:
+                self._cache.move_to_end(sid)
+                return dict(entry[0]), entry[1]
+        conn = get_db_connection()
+        row = conn.execute('SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?', (sid, now)).fetchone()
+        conn.close()
+        if row is None:
+            with self._lock:
+                self._cache.pop(sid, None)
+            return None, 0
+        data = json.loads(row['data'])
+        self._cache_put(sid, data, row['expires_at'])
+        return dict(data), row['expires_at']
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data, expires_at = self._load(sid)
+            if data is not None:
+                return StoredSession(data, sid=sid, expires_at=expires_at)
+        return StoredSession()
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if (session.sid or session.replaced_sid) and session.modified: # Logged out
+                conn = get_db_connection()
+                self._forget(conn, session.sid or session.replaced_sid)
+                conn.commit()
+                conn.close()
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        conn = None
+        if session.sid is None or session.modified:
+            session.sid = session.sid or secrets.token_urlsafe(32)
+            session.expires_at = now + lifetime
+            conn = get_db_connection()
+            if session.replaced_sid:
+                self._forget(conn, session.replaced_sid)
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                         (session.sid, json.dumps(dict(session)), session.expires_at))
+        elif session.expires_at - now < lifetime - app.config['SESSION_REFRESH_INTERVAL']:
+            session.expires_at = now + lifetime
+            conn = get_db_connection()
+            conn.execute('UPDATE sessions SET expires_at = ? WHERE id = ?', (session.expires_at, session.sid))
+        else:
+            return # Unchanged and recently extended: nothing to write, cookie still valid
+        conn.commit()
+        conn.close()
+        self._cache_put(session.sid, dict(session), session.expires_at)
+        response.set_cookie(name, session.sid, expires=session.expires_at, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def expire_batch(self, limit):
+        """Deletes up to limit expired sessions; returns how many."""
+        conn = get_db_connection()
+        try:
+            conn.execute('DELETE FROM sessions WHERE id IN (SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?)',
+                         (time.time(), limit))
+            deleted = conn.execute('SELECT changes()').fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+        return deleted
+
+app.session_interface = SQLiteSessionInterface()
+
+# --- Content-Addressed Blob Store ---
+# File contents live once under uploads/blobs/<sha256[:2]>/<sha256>, shared by every
+# files row with that blob_hash. blobs.refcount counts those rows, so copying or
+# deleting a file only touches metadata; a blob is unlinked when its count reaches zero.
+# Blobs are immutable: saving new content stores a new blob and moves the reference.
+class HashingWriter:
+    """File-like wrapper that hashes and counts bytes as they are written through it."""
+    def __init__(self, f):
+        self._f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+def blob_path(digest):
+    return os.path.join(UPLOADS_FOLDER_PATH, 'blobs', digest[:2], digest)
+
+def stage_blob(write):
+    """Calls write(fileobj) to fill a temp file, hashing while it writes.
+
+    Returns (tmp_path, digest, size); pass them to commit_blob() inside a write transaction.
+    """
+    tmp_dir = os.path.join(UPLOADS_FOLDER_PATH, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = HashingWriter(f)
+            write(writer)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, writer.hash.hexdigest(), writer.size
+
+def commit_blob(conn, tmp_path, digest, size):
+    """Adds one reference to the blob, moving the staged file into place if the content is new.
+
+    Must run inside a write transaction (BEGIN IMMEDIATE) so it can't race the reclaimer.
+    Returns the blob's path.
+    """
+    path = blob_path(digest)
+    if conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,)).rowcount:
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        conn.execute('INSERT INTO blobs (hash, size, refcount, path) VALUES (?, ?, 1, ?)', (digest, size, path))
+    return path
+
+def retain_blob(conn, digest):
+    conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?', (digest,))
+
+def release_blob(conn, digest):
+    """Drops one reference; an unreferenced blob is queued for the reclaimer."""
+    conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (digest,))
+    collect_unreferenced_blobs(conn)
+
+def collect_unreferenced_blobs(conn):
+    conn.execute('INSERT INTO pending_deletions (file_path) SELECT path FROM blobs WHERE refcount <= 0')
+    conn.execute('DELETE FROM blobs WHERE refcount <= 0')
+
+def discard_staged(staged):
+    if os.path.exists(staged[0]):
+        os.remove(staged[0])
+
+def insert_file(conn, user_id, parent_id, filename, staged):
+    """Creates a files row for staged content. Must run inside a write transaction."""
+    tmp_path, digest, size = staged
+    tree_path = child_path(conn, user_id, parent_id, filename)
+    path = commit_blob(conn, tmp_path, digest, size)
+    cursor = conn.execute(
+        'INSERT INTO files (user_id, parent_id, filename, is_folder, file_path, blob_hash, path) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (user_id, parent_id, filename, False, path, digest, tree_path)
+    )
+    return cursor.lastrowid
+
+class VersionConflict(Exception):
+    """The file changed since the version the client based its edit on."""
+
+def replace_file_content(conn, file_id, staged, expected_version=None):
+    """Points an existing file at staged content and releases its old blob. Must run inside a write transaction.
+
+    With expected_version set, raises VersionConflict unless the file is still at that blob hash.
+    """
+    tmp_path, digest, size = staged
+    # Re-read under the write lock so two concurrent saves can't both release the same old blob
+    file_info = conn.execute('SELECT file_path, blob_hash FROM files WHERE id = ?', (file_id,)).fetchone()
+    if not file_info:
+        raise FileNotFoundError(f'File {file_id} no longer exists')
+    if expected_version is not None and file_info['blob_hash'] != expected_version:
+        raise VersionConflict(file_info['blob_hash'])
+    path = commit_blob(conn, tmp_path, digest, size)
+    conn.execute('UPDATE files SET file_path = ?, blob_hash = ? WHERE id = ?', (path, digest, file_id))
+    if file_info['blob_hash']:
+        release_blob(conn, file_info['blob_hash'])
+    elif file_info['file_path']:
+        conn.execute('INSERT INTO pending_deletions (file_path) VALUES (?)', (file_info['file_path'],))
+    thumbnail_cache.invalidate(file_id)
+
+# --- File Tree Paths ---
+class ParentNotFound(LookupError):
+    """The folder a new or moved item should go into doesn't exist for this user."""
+
+@app.errorhandler(ParentNotFound)
+def handle_parent_not_found(e):
+    return jsonify({'error': 'Parent folder not found'}), 404
+
+def valid_filename(name):
+    return bool(name) and '/' not in name and name not in ('.', '..')
+
+def get_folder_path(conn, user_id, folder_id):
+    """Materialized path of a folder: '' for the root, None if it doesn't exist."""
+    if folder_id is None:
+        return ''
+    row = conn.execute('SELECT path FROM files WHERE id = ? AND user_id = ? AND is_folder = 1', (folder_id, user_id)).fetchone()
+    return row['path'] if row else None
+
+class NameTaken(ValueError):
+    """Another item in the folder already has this name; paths are unique per user."""
+
+@app.errorhandler(NameTaken)
+def handle_name_taken(e):
+    return jsonify({'error': 'An item with that name already exists'}), 409
+
+def child_path(conn, user_id, parent_id, filename, item_id=None):
+    """Path of filename inside a folder. Raises NameTaken if something other than item_id is already there."""
+    parent_path = get_folder_path(conn, user_id, parent_id)
+    if parent_path is None:
+        raise ParentNotFound(parent_id)
+    path = f'{parent_path}/{filename}'
+    existing = conn.execute('SELECT id FROM files WHERE user_id = ? AND path = ?', (user_id, path)).fetchone()
+    if existing and existing['id'] != item_id:
+        raise NameTaken(path)
+    return path
+
+def subtree_range(path):
+    """(low, high) bounds such that low <= p < high matches exactly the paths strictly below `path`."""
+    return path + '/', path + '0'
+
+def repath_subtree(conn, user_id, folder_id, new_path):
+    """Rewrites the paths below a folder after it was renamed or moved to new_path.
+
+    Walks the folder's real subtree by parent_id, so rows whose stored paths are wrong are fixed too.
+    """
+    conn.execute('''
+        WITH RECURSIVE subtree(id, path) AS (
+            SELECT id, ? || '/' || filename FROM files WHERE parent_id = ? AND user_id = ?
+            UNION ALL
+            SELECT f.id, s.path || '/' || f.filename FROM files f JOIN subtree s ON f.parent_id = s.id WHERE f.user_id = ?
+        )
+        UPDATE files SET path = (SELECT s.path FROM subtree s WHERE s.id = files.id)
+        WHERE id IN (SELECT id FROM subtree)
+    ''', (new_path, folder_id, user_id, user_id))
+
+def normalize_path(cwd_path, path):
+    """Joins path onto cwd_path and resolves '.', '..' and '~'; returns '' for the root."""
+    if path == '~' or path.startswith(('/', '~/')):
+        parts = []
+        path = path.lstrip('~')
+    else:
+        parts = [p for p in cwd_path.split('/') if p]
+    for part in path.split('/'):
+        if not part or part == '.':
+            continue
+        if part == '..':
+            if parts:
+                parts.pop() # Stay at root if already there
+            continue
+        parts.append(part)
+    return '/' + '/'.join(parts) if parts else ''
+
+def lookup_path(conn, user_id, cwd_id, path):
+    """Resolves a relative or absolute path with one indexed lookup.
+
+    Returns (full_path, row); row is None for the root and 'not_found' if nothing is there.
+    """
+    cwd_path = get_folder_path(conn, user_id, cwd_id)
+    if cwd_path is None:
+        return None, 'not_found'
+    full_path = normalize_path(cwd_path, path)
+    if not full_path:
+        return '', None
+    row = conn.execute('SELECT * FROM files WHERE user_id = ? AND path = ?', (user_id, full_path)).fetchone()
+    return full_path, row or 'not_found'
+
+# --- File Tree Operations ---
+# Shared by the file manager routes and the terminal. Each must run inside a write transaction;
+# callers invalidate directory_cache for the folders they touched once it has committed.
+class InvalidMove(ValueError):
+    """A folder can't be moved or copied into itself."""
+
+def relocate_item(conn, user_id, item, parent_id, filename):
+    """Moves and/or renames a file or folder; a folder's subtree is repathed along with it."""
+    new_path = child_path(conn, user_id, parent_id, filename, item_id=item['id'])
+    if item['is_folder'] and new_path.startswith(item['path'] + '/'):
+        raise InvalidMove(item['path'])
+    if filename == item['filename']:
+        # Leaving filename out of the SET keeps the search trigger from reindexing the file
+        conn.execute('UPDATE files SET parent_id = ?, path = ? WHERE id = ?', (parent_id, new_path, item['id']))
+    else:
+        conn.execute('UPDATE files SET parent_id = ?, filename = ?, path = ? WHERE id = ?',
+                     (parent_id, filename, new_path, item['id']))
+    if item['is_folder']:
+        repath_subtree(conn, user_id, item['id'], new_path)
+
+def copy_file_item(conn, user_id, source, parent_id, filename):
+    """Copies a file's row; files in the blob store share the blob instead of copying bytes. Returns the new id."""
+    if source['blob_hash']:
+        tree_path = child_path(conn, user_id, parent_id, filename)
+        retain_blob(conn, source['blob_hash']) # Metadata-only: share the blob
+        cursor = conn.execute(
+            'INSERT INTO files (user_id, parent_id, filename, is_folder, file_path, blob_hash, path) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, parent_id, filename, False, source['file_path'], source['blob_hash'], tree_path)
+        )
+        return cursor.lastrowid
+    # Files stored before the blob store existed are copied into it once
+    with open(source['file_path'], 'rb') as src:
+        staged = stage_blob(lambda f: shutil.copyfileobj(src, f))
+    return insert_file(conn, user_id, parent_id, filename, staged)
+
+def copy_folder_item(conn, user_id, folder, parent_id, filename):
+    """Copies a folder and everything below it. Returns the new folder's id."""
+    new_path = child_path(conn, user_id, parent_id, filename)
+    if new_path == folder['path'] or new_path.startswith(folder['path'] + '/'):
+        raise InvalidMove(folder['path'])
+    # The real subtree by parent_id, shallowest first, so every parent is copied before its children
+    rows = conn.execute('''
+        WITH RECURSIVE subtree(id, depth) AS (
+            SELECT id, 1 FROM files WHERE parent_id = ? AND user_id = ?
+            UNION ALL
+            SELECT f.id, s.depth + 1 FROM files f JOIN subtree s ON f.parent_id = s.id WHERE f.user_id = ?
+        )
+        SELECT f.* FROM files f JOIN subtree s ON s.id = f.id ORDER BY s.depth
+    ''', (folder['id'], user_id, user_id)).fetchall()
+    insert_folder = 'INSERT INTO files (user_id, parent_id, filename, is_folder, path) VALUES (?, ?, ?, ?, ?)'
+    new_ids = {folder['id']: conn.execute(insert_folder, (user_id, parent_id, filename, True, new_path)).lastrowid}
+    new_paths = {folder['id']: new_path}
+    for row in rows:
+        parent = new_ids[row['parent_id']]
+        if row['is_folder']:
+            new_paths[row['id']] = f"{new_paths[row['parent_id']]}/{row['filename']}"
+            new_ids[row['id']] = conn.execute(insert_folder, (user_id, parent, row['filename'], True, new_paths[row['id']])).lastrowid
+        else:
+            copy_file_item(conn, user_id, row, parent, row['filename'])
+    return new_ids[folder['id']]
+
+def delete_item(conn, user_id, file_id):
+    """Deletes a file or a folder with its whole subtree. Returns (folder_ids, file_ids) of the deleted
+    rows, whose cached listings and thumbnails the caller should invalidate.
+
+    Blob references are dropped; unreferenced blobs and pre-blob-store files are queued for
+    the reclaimer instead of being unlinked inside the transaction.
+    """
+    # Resolve the whole subtree in SQL. Children are deleted explicitly because
+    # foreign_keys is off by default in SQLite, so ON DELETE CASCADE never fires.
+    subtree = '''
+        WITH RECURSIVE subtree(id) AS (
+            SELECT id FROM files WHERE id = ? AND user_id = ?
+            UNION ALL
+            SELECT f.id FROM files f JOIN subtree s ON f.parent_id = s.id WHERE f.user_id = ?
+        )
+    '''
+    params = (file_id, user_id, user_id)
+    folder_ids, file_ids = [], []
+    for row in conn.execute(subtree + 'SELECT id, is_folder FROM files WHERE id IN (SELECT id FROM subtree)', params):
+        (folder_ids if row['is_folder'] else file_ids).append(row['id'])
+    conn.execute(subtree + ''',
+        dropped(hash, n) AS (
+            SELECT blob_hash, COUNT(*) FROM files
+            WHERE id IN (SELECT id FROM subtree) AND blob_hash IS NOT NULL
+            GROUP BY blob_hash
+        )
+        UPDATE blobs SET refcount = refcount - (SELECT n FROM dropped WHERE dropped.hash = blobs.hash)
+        WHERE hash IN (SELECT hash FROM dropped)
+    ''', params)
+    collect_unreferenced_blobs(conn)
+    conn.execute(subtree + '''
+        INSERT INTO pending_deletions (file_path)
+        SELECT file_path FROM files
+        WHERE id IN (SELECT id FROM subtree) AND NOT is_folder AND blob_hash IS NULL AND file_path IS NOT NULL
+    ''', params)
+    conn.execute(subtree + 'DELETE FROM files WHERE id IN (SELECT id FROM subtree)', params)
+    return folder_ids, file_ids
+
+# --- Directory Listing Cache ---
+class DirectoryCache:
+    """Bounded LRU of folder listings keyed by (user_id, parent_id), with a content ETag per listing.
+
+    Writers call invalidate() for every folder whose listing they changed, after committing.
+    The cache is per process; run a single worker or accept that other workers' writes only
+    show up once their own entries are invalidated or evicted.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0 # Bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(user_id, parent_id):
+        return (user_id, None if parent_id in (None, '', 'null', 'undefined') else int(parent_id))
+
+    def get(self, user_id, parent_id):
+        """Returns (rows, etag) for a folder listing, reading SQLite only on a miss."""
+        key = self.key(user_id, parent_id)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            generation = self._generation
+
+        query = 'SELECT id, filename, is_folder, created_at FROM files WHERE user_id = ? AND '
+        params = [user_id]
+        if key[1] is None:
+            query += 'parent_id IS NULL'
+        else:
+            query += 'parent_id = ?'
+            params.append(key[1])
+        query += ' ORDER BY is_folder DESC, filename ASC'
+
+        conn = get_db_connection()
+        rows = [dict(row) for row in conn.execute(query, tuple(params)).fetchall()]
+        conn.close()
+        etag = hashlib.sha1(json.dumps(rows, sort_keys=True).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            # Skip storing if anything was invalidated meanwhile; the rows may predate that write
+            if generation == self._generation:
+                self._entries[key] = (rows, etag)
+                while len(self._entries) > app.config['DIR_CACHE_MAX_ENTRIES']:
+                    self._entries.popitem(last=False)
+        return rows, etag
+
+    def invalidate(self, user_id, *parent_ids):
+        with self._lock:
+            self._generation += 1
+            for parent_id in parent_ids:
+                if self._entries.pop(self.key(user_id, parent_id), None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self._entries), 'max_entries': app.config['DIR_CACHE_MAX_ENTRIES']}
+
+directory_cache = DirectoryCache()
+
+# --- Settings Cache ---
+class SettingsCache:
+    """Bounded LRU of each user's parsed settings with their version, so reads skip SQLite and json.loads.
+
+    Entries are (settings, version, loaded_at); settings are shared and must be treated as read-only.
+    Writers go through write_settings(), which updates the entry after committing. Entries are
+    re-read after SETTINGS_CACHE_TTL so writes made by other workers show up.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns (settings, version) for a user, reading SQLite only on a miss or once stale."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and time.monotonic() - entry[2] < app.config['SETTINGS_CACHE_TTL']:
+                self._entries.move_to_end(user_id)
+                return entry[0], entry[1]
+
+        conn = get_db_connection()
+        row = conn.execute('SELECT settings, settings_version FROM users WHERE id = ?', (user_id,)).fetchone()
+        conn.close()
+        if not row:
+            return {}, 0
+        settings = json.loads(row['settings']) if row['settings'] else {}
+        self.put(user_id, settings, row['settings_version'])
+        return settings, row['settings_version']
+
+    def put(self, user_id, settings, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            # A slow reader must not replace a newer version stored by a writer meanwhile
+            if entry and entry[1] > version:
+                return
+            self._entries[user_id] = (settings, version, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > app.config['SETTINGS_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+settings_cache = SettingsCache()
+
+def settings_etag(user_id, version):
+    return f'{user_id}-{version}'
+
+class SettingsConflict(Exception):
+    """The settings changed since the version the client based its update on."""
+
+def write_settings(user_id, change, expected_version=None):
+    """Replaces a user's settings with change(current copy) in one write transaction and bumps the version.
+
+    change may raise ValueError to reject the update. With expected_version set, raises
+    SettingsConflict unless the stored settings are still at that version.
+    Returns (settings, version).
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT settings, settings_version FROM users WHERE id = ?', (user_id,)).fetchone()
+        version = row['settings_version']
+        if expected_version is not None and expected_version != version:
+            raise SettingsConflict(version)
+        settings = change(json.loads(row['settings']) if row['settings'] else {})
+        conn.execute('UPDATE users SET settings = ?, settings_version = ? WHERE id = ?',
+                     (json.dumps(settings), version + 1, user_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    settings_cache.put(user_id, settings, version + 1)
+    return settings, version + 1
+
+# JSON Patch (RFC 6902) over the settings object
+class PatchTestFailed(Exception):
+    """A 'test' operation in a JSON patch did not match."""
+
+def json_pointer(path):
+    """Splits an RFC 6901 pointer ('/a/b~1c') into its unescaped tokens."""
+    if not isinstance(path, str) or (path and not path.startswith('/')):
+        raise ValueError(f'Invalid JSON pointer: {path!r}')
+    return [token.replace('~1', '/').replace('~0', '~') for token in path.split('/')[1:]]
+
+def _pointer_get(doc, tokens, path):
+    for token in tokens:
+        if isinstance(doc, dict) and token in doc:
+            doc = doc[token]
+        elif isinstance(doc, list) and token.isdigit() and int(token) < len(doc):
+            doc = doc[int(token)]
+        else:
+            raise ValueError(f'Path not found: {path}')
+    return doc
+
+def _pointer_set(doc, tokens, value, path, insert):
+    """Adds (insert=True) or replaces the value at tokens; returns the new document."""
+    if not tokens:
+        return value
+    parent = _pointer_get(doc, tokens[:-1], path)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        if not insert and token not in parent:
+            raise ValueError(f'Path not found: {path}')
+        parent[token] = value
+    elif isinstance(parent, list):
+        if insert and token == '-':
+            parent.append(value)
+        elif token.isdigit() and int(token) <= len(parent) - (0 if insert else 1):
+            if insert:
+                parent.insert(int(token), value)
+            else:
+                parent[int(token)] = value
+        else:
+            raise ValueError(f'Path not found: {path}')
+    else:
+        raise ValueError(f'Path not found: {path}')
+    return doc
+
+def _pointer_remove(doc, tokens, path):
+    if not tokens:
+        raise ValueError('Cannot remove the whole document')
+    parent = _pointer_get(doc, tokens[:-1], path)
+    _pointer_get(parent, tokens[-1:], path)
+    del parent[int(tokens[-1]) if isinstance(parent, list) else tokens[-1]]
+
+def apply_json_patch(doc, operations):
+    """Applies a list of RFC 6902 operations (add/remove/replace/move/copy/test) to doc in place.
+
+    Raises PatchTestFailed when a 'test' doesn't match and ValueError for anything malformed.
+    Returns the patched document.
+    """
+    if not isinstance(operations, list):
+        raise ValueError('A JSON patch must be a list of operations')
+    for operation in operations:
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in ('add', 'remove', 'replace', 'move', 'copy', 'test'):
+            raise ValueError(f'Invalid patch operation: {operation!r}')
+        path = operation.get('path')
+        tokens = json_pointer(path)
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise ValueError(f"'{op}' needs a value")
+
+        if op == 'remove':
+            _pointer_remove(doc, tokens, path)
+        elif op == 'test':
+            if _pointer_get(doc, tokens, path) != operation['value']:
+                raise PatchTestFailed(path)
+        elif op in ('move', 'copy'):
+            source = operation.get('from')
+            source_tokens = json_pointer(source)
+            value = _pointer_get(doc, source_tokens, source)
+            if op == 'move':
+                if tokens[:len(source_tokens)] == source_tokens and tokens != source_tokens:
+                    raise ValueError(f'Cannot move {source} into itself')
+                _pointer_remove(doc, source_tokens, source)
+            else:
+                value = copy.deepcopy(value)
+            doc = _pointer_set(doc, tokens, value, path, insert=True)
+        else:
+            doc = _pointer_set(doc, tokens, copy.deepcopy(operation['value']), path, insert=op == 'add')
+    return doc
+
+def merge_patch(target, patch):
+    """Applies an RFC 7396 merge patch: objects merge recursively and null removes a key."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
+
+def clean_settings(settings):
+    """Checks a complete settings object before it is stored; raises ValueError if it can't be."""
+    if not isinstance(settings, dict):
+        raise ValueError('Settings must be an object')
+    if 'browser' in settings:
+        # Navigation defaults are stored cleaned up, so every navigation can trust them as-is
+        if not isinstance(settings['browser'], dict):
+            raise ValueError('browser settings must be an object')
+        policy, error = validate_navigation_policy(settings['browser'])
+        if error:
+            raise ValueError(error)
+        settings['browser'] = policy
+    return settings
+
+# --- Search Index ---
+def is_binary(data):
+    return b'\0' in data[:8192]
+
+def extract_text(path):
+    """Searchable text of a stored file and whether it was cut short.
+
+    The text is the file's first SEARCH_MAX_TEXT_BYTES as UTF-8, or '' for binary files.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(app.config['SEARCH_MAX_TEXT_BYTES'])
+            truncated = bool(f.read(1))
+    except OSError:
+        return '', False
+    if is_binary(data):
+        return '', False
+    return data.decode('utf-8', errors='ignore'), truncated
+
+class SearchIndexer:
+    """Indexes the text of files queued in search_queue on a daemon thread.
+
+    Triggers on files queue every new or changed file in the same transaction as the change,
+    so nothing is lost across restarts. Files are read outside the write lock; a file whose
+    content changed again meanwhile is left for the next pass.
+    """
+    def __init__(self, batch_size=100, interval=30):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                while self.index_batch() == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"Search indexing failed: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def index_batch(self):
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('SELECT file_id, file_path FROM search_queue LIMIT ?', (self.batch_size,)).fetchall()
+            texts = [(row['file_id'], row['file_path'], *extract_text(row['file_path'])) for row in rows]
+            conn.execute('BEGIN IMMEDIATE')
+            for file_id, file_path, text, truncated in texts:
+                if conn.execute('DELETE FROM search_queue WHERE file_id = ? AND file_path = ?', (file_id, file_path)).rowcount:
+                    conn.execute('UPDATE search_index SET body = ? WHERE rowid = ?', (text, file_id))
+                    if truncated:
+                        conn.execute('INSERT OR IGNORE INTO search_truncated (file_id) VALUES (?)', (file_id,))
+                    else:
+                        conn.execute('DELETE FROM search_truncated WHERE file_id = ?', (file_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        return len(rows)
+
+search_indexer = SearchIndexer()
+
+SEARCH_FIELDS = {'all': '{name body}', 'name': '{name}', 'content': '{body}'}
+
+def fts_string(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def search_files(user_id, query, fields='all', folder_path='', limit=50, offset=0):
+    """Ranked matches for query among a user's files and folders, optionally only below folder_path.
+
+    Every whitespace-separated term must occur as a substring (case-insensitive). Name matches
+    outrank content matches. If a name search finds nothing, retries with any of the terms'
+    trigrams so misspelled names still turn up, ranked by how much of them matched.
+    Returns (rows, fuzzy); rows carry id, filename, path, parent_id, is_folder and a content snippet.
+    """
+    terms = query.split()
+    if not terms:
+        return [], False
+    conn = get_db_connection()
+    try:
+        scope, params = '', []
+        if folder_path:
+            scope = ' AND f.path >= ? AND f.path < ?'
+            params = list(subtree_range(folder_path))
+
+        if any(len(term) < 3 for term in terms):
+            # Trigrams can't match shorter terms, so fall back to scanning this user's names
+            if fields == 'content':
+                return [], False
+            like = ''.join(" AND f.filename LIKE ? ESCAPE '\\'" for _ in terms)
+            patterns = ['%' + re.sub(r'([%_\\])', r'\\\1', term) + '%' for term in terms]
+            rows = conn.execute(
+                "SELECT f.id, f.filename, f.path, f.parent_id, f.is_folder, '' AS snippet FROM files f "
+                'WHERE f.user_id = ?' + like + scope + ' ORDER BY length(f.filename), f.filename LIMIT ? OFFSET ?',
+                (user_id, *patterns, *params, limit, offset)).fetchall()
+            return [dict(row) for row in rows], False
+
+        def run(expression):
+            return conn.execute(
+                "SELECT f.id, f.filename, f.path, f.parent_id, f.is_folder, snippet(search_index, 2, '', '', '…', 48) AS snippet "
+                'FROM search_index JOIN files f ON f.id = search_index.rowid '
+                'WHERE search_index MATCH ?' + scope + ' ORDER BY bm25(search_index, 0.0, 10.0, 1.0) LIMIT ? OFFSET ?',
+                (f'owner : {fts_string(f"<{user_id}>")} AND {expression}', *params, limit, offset)).fetchall()
+
+        rows = run(f"{SEARCH_FIELDS[fields]} : ({' AND '.join(fts_string(term) for term in terms)})")
+        fuzzy = False
+        if not rows and not offset and fields != 'content':
+            trigrams = {term[i:i + 3].lower() for term in terms for i in range(len(term) - 2)}
+            rows = run(f"{{name}} : ({' OR '.join(fts_string(trigram) for trigram in sorted(trigrams))})")
+            fuzzy = True
+        return [dict(row) for row in rows], fuzzy
+    finally:
+        conn.close()
+
+def required_literal(pattern):
+    """Longest plain substring every match of a regex must contain, or None if it's not simple to tell."""
+    if re.search(r'[|?*{}()\[\]\\]', pattern):
+        return None
+    literal = max(re.split(r'[.^$+]', pattern), key=len)
+    return literal if len(literal) >= 3 else None
+
+def grep_files(conn, user_id, folder_path, literal=None):
+    """Yields (path, file_path) of the text files below folder_path that may match, in path order.
+
+    With a literal that every match contains, only files whose indexed text has it are read.
+    Files not indexed yet (still queued) or indexed only in part are always included.
+    """
+    low, high = subtree_range(folder_path)
+    if literal:
+        rows = conn.execute(
+            'SELECT f.path, f.file_path FROM search_index JOIN files f ON f.id = search_index.rowid '
+            'WHERE search_index MATCH ? AND f.path >= ? AND f.path < ? '
+            'UNION SELECT f.path, f.file_path FROM search_queue q JOIN files f ON f.id = q.file_id '
+            'WHERE f.user_id = ? AND f.path >= ? AND f.path < ? '
+            'UNION SELECT f.path, f.file_path FROM search_truncated t JOIN files f ON f.id = t.file_id '
+            'WHERE f.user_id = ? AND f.path >= ? AND f.path < ? ORDER BY 1',
+            (f'owner : {fts_string(f"<{user_id}>")} AND {{body}} : {fts_string(literal)}', low, high,
+             user_id, low, high, user_id, low, high))
+    else:
+        rows = conn.execute('SELECT path, file_path FROM files WHERE user_id = ? AND NOT is_folder '
+                            'AND file_path IS NOT NULL AND path >= ? AND path < ? ORDER BY path', (user_id, low, high))
+    for row in rows:
+        yield row['path'], row['file_path']
+
+def grep_file(file_path, regex, invert=False):
+    """Yields (line_number, line) for the lines of a text file matching regex (or not, with invert).
+
+    Binary files yield nothing.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            if is_binary(f.read(8192)):
+                return
+            f.seek(0)
+            for number, line in enumerate(f, start=1):
+                line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+                if bool(regex.search(line)) != invert:
+                    yield number, line
+    except OSError:
+        return
+
+# --- Thumbnail Cache ---
+class ThumbnailCache:
+    """Downscaled image renditions on disk, evicted least-recently-used once over max_bytes.
+
+    Entries are named <file_id>-<version>-<size>.webp, where version is the blob hash,
+    so a rendition can never be served for content other than the one it was made from.
+    """
+    def __init__(self):
+        self._entries = None # path -> size in bytes, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def folder(self):
+        return os.path.join(UPLOADS_FOLDER_PATH, 'thumbnails')
+
+    def _load(self):
+        # Rebuild the LRU order from access times left by a previous run
+        if self._entries is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith('.webp'):
+                stat = entry.stat()
+                found.append((stat.st_atime, entry.path, stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((path, size) for _, path, size in found)
+        self._total = sum(self._entries.values())
+
+    def path_for(self, file_id, version, size_name):
+        return os.path.join(self.folder, f'{file_id}-{version}-{size_name}.webp')
+
+    def get(self, file_id, version, size_name, source_path):
+        """Returns the path of the rendition, rendering it from source_path on a miss."""
+        path = self.path_for(file_id, version, size_name)
+        with self._lock:
+            self._load()
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return path
+
+        edge = app.config['THUMBNAIL_SIZES'][size_name]
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out, Image.open(source_path) as image:
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((edge, edge))
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+                image.save(out, 'WEBP', quality=80)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if path not in self._entries:
+                self._entries[path] = os.path.getsize(path)
+                self._total += self._entries[path]
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._total > app.config['THUMBNAIL_CACHE_MAX_BYTES'] and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, *file_ids):
+        """Drops every rendition of the given files, whatever their version."""
+        names = {str(file_id) for file_id in file_ids}
+        if not names:
+            return
+        with self._lock:
+            self._load()
+            for path in [p for p in self._entries if os.path.basename(p).split('-', 1)[0] in names]:
+                self._total -= self._entries.pop(path)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+thumbnail_cache = ThumbnailCache()
+
+# --- Proxy Cache ---
+# One keep-alive client for everything the server fetches on a page's behalf, so proxied assets
+# reuse connections (HTTP/2 where the origin offers it) instead of a new TLS handshake per request.
+http_client = httpx.Client(http2=True, follow_redirects=True, timeout=20,
+                           limits=httpx.Limits(max_connections=200, max_keepalive_connections=50))
+http_async_client = httpx.AsyncClient(http2=True, follow_redirects=True, timeout=20,
+                                      limits=httpx.Limits(max_connections=200, max_keepalive_connections=50))
+
+# Response headers kept with a cached body and passed on to the client
+PROXY_STORED_HEADERS = ('content-type', 'content-encoding', 'cache-control', 'etag', 'last-modified', 'expires')
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') or True
+    return directives
+
+def http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+def freshness_lifetime(headers):
+    """Seconds a response may be served from a shared cache without revalidation, or None if it
+    must not be stored at all. Follows RFC 9111: s-maxage, max-age, Expires, then a heuristic
+    of 10% of the time since Last-Modified."""
+    directives = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in directives or 'private' in directives or headers.get('vary', '').strip() == '*':
+        return None
+    if 'no-cache' in directives:
+        return 0
+    try:
+        age = int(headers.get('age', 0))
+    except ValueError:
+        age = 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(int(directives[name]) - age, 0)
+            except ValueError:
+                return 0
+    date = http_date(headers.get('date')) or time.time()
+    if 'expires' in headers:
+        expires = http_date(headers['expires'])
+        return max(int(expires - date) - age, 0) if expires else 0
+    last_modified = http_date(headers.get('last-modified'))
+    if last_modified:
+        return min(max(int((date - last_modified) / 10) - age, 0), app.config['PROXY_HEURISTIC_MAX_AGE'])
+    return 0
+
+class ProxyCache:
+    """Shared on-disk HTTP cache for proxied page assets, evicted least-recently-used once over
+    PROXY_CACHE_MAX_BYTES.
+
+    A URL is stored as <sha256(url)> (the body as the origin encoded it) next to <sha256(url)>.json
+    (kept headers and when it goes stale). Stale entries with an ETag or Last-Modified are
+    revalidated with a conditional request instead of being downloaded again.
+    """
+    def __init__(self):
+        self._entries = None # key -> body size in bytes, oldest first
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def folder(self):
+        return os.path.join(UPLOADS_FOLDER_PATH, 'proxy-cache')
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and len(entry.name) == 64 and os.path.exists(entry.path + '.json'):
+                stat = entry.stat()
+                found.append((stat.st_atime, entry.name, stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in found)
+        self._total = sum(self._entries.values())
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        """Returns the stored entry for url ({'path', 'headers', 'fresh_until'}) or None."""
+        key = self.key(url)
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(os.path.join(self.folder, key + '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        meta['path'] = os.path.join(self.folder, key)
+        return meta
+
+    def _write_meta(self, key, url, headers, lifetime):
+        meta = {'url': url, 'fresh_until': time.time() + lifetime,
+                'headers': {name: headers[name] for name in PROXY_STORED_HEADERS if name in headers}}
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.folder, key + '.json'))
+
+    def new_body_file(self):
+        """A temp file in the cache folder to stream a body into before store()."""
+        with self._lock:
+            self._load()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def store(self, url, headers, tmp_path):
+        """Moves a fully received body into the cache, or discards it if the headers forbid storing."""
+        lifetime = freshness_lifetime(headers)
+        if lifetime is None or not (lifetime or 'etag' in headers or 'last-modified' in headers):
+            os.remove(tmp_path)
+            return
+        key = self.key(url)
+        size = os.path.getsize(tmp_path)
+        self._write_meta(key, url, headers, lifetime)
+        os.replace(tmp_path, os.path.join(self.folder, key))
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def revalidated(self, url, entry, headers):
+        """Records a 304 from the origin: the stored body is fresh again, with any updated headers."""
+        merged = dict(entry['headers'])
+        merged.update({name: headers[name] for name in PROXY_STORED_HEADERS if name in headers})
+        lifetime = freshness_lifetime({**merged, 'date': headers.get('date'), 'age': headers.get('age', '0')})
+        with self._lock:
+            if self.key(url) not in self._entries:
+                return
+        if lifetime is None:
+            self.remove(url)
+        else:
+            self._write_meta(self.key(url), url, merged, lifetime)
+
+    def remove(self, url):
+        key = self.key(url)
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                self._total -= self._entries.pop(key)
+                self._delete_files(key)
+
+    def _delete_files(self, key):
+        for name in (key, key + '.json'):
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self._total > app.config['PROXY_CACHE_MAX_BYTES'] and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            self._delete_files(key)
+
+proxy_cache = ProxyCache()
+
+# --- Password Hashing ---
+# bcrypt is deliberately slow (~250 ms per hash at 12 rounds). Running it in worker processes keeps
+# a burst of logins from occupying every request thread (and the GIL) while the rest of the desktop waits.
+def hash_password(password, rounds):
+    return bcrypt_lib.hashpw(password.encode('utf-8'), bcrypt_lib.gensalt(rounds)).decode('utf-8')
+
+def verify_password(password_hash, password):
+    # Same comparison Flask-Bcrypt made, so existing hashes keep working
+    password_hash = password_hash.encode('utf-8')
+    return hmac.compare_digest(bcrypt_lib.hashpw(password.encode('utf-8'), password_hash), password_hash)
+
+def hash_rounds(password_hash):
+    """The work factor a $2b$12$... hash was made with."""
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+class HashingBusy(Exception):
+    """PASSWORD_HASH_QUEUE hashing requests are already admitted; the caller should retry shortly."""
+
+@app.errorhandler(HashingBusy)
+def handle_hashing_busy(e):
+    return jsonify({'error': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool of PASSWORD_HASH_WORKERS, admitting at most PASSWORD_HASH_QUEUE
+    requests at a time; beyond that, requests fail fast with HashingBusy instead of queueing."""
+    def __init__(self):
+        self._executor = None
+        self._admission = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking would copy the Playwright and reclaimer threads' state into the workers
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    app.config['PASSWORD_HASH_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+            if self._admission is None: # Kept across restarts; admitted requests release into it
+                self._admission = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+        return self._executor
+
+    def _restart(self, broken):
+        """Replaces a pool that lost a worker (crash, OOM kill), unless another thread already has."""
+        with self._lock:
+            if self._executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        return self._start()
+
+    def _submit(self, fn, *args):
+        executor = self._start()
+        try:
+            return executor, executor.submit(fn, *args)
+        except BrokenProcessPool:
+            executor = self._restart(executor)
+            return executor, executor.submit(fn, *args)
+
+    def run(self, fn, *args):
+        if app.config['PASSWORD_HASH_WORKERS'] <= 0:
+            return fn(*args)
+        self._start()
+        if not self._admission.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            executor, future = self._submit(fn, *args)
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                # The pool broke while this request waited; retry once on a fresh one
+                return self._restart(executor).submit(fn, *args).result()
+        finally:
+            self._admission.release()
+
+    def run_in_background(self, fn, args, callback):
+        """Fire-and-forget work that is dropped, not queued, when the pool is saturated."""
+        if app.config['PASSWORD_HASH_WORKERS'] <= 0:
+            callback(fn(*args))
+            return
+        self._start()
+        if not self._admission.acquire(blocking=False):
+            return
+        try:
+            executor, future = self._submit(fn, *args)
+        except Exception:
+            self._admission.release()
+            raise
+        def done(future):
+            self._admission.release()
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._restart(executor) # Dropped like any other failure, but later requests get a working pool
+            elif future.exception() is None:
+                callback(future.result())
+        future.add_done_callback(done)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+password_hasher = PasswordHasher()
+
+def upgrade_password_hash(user_id, old_hash, password):
+    """Rehashes with the current BCRYPT_LOG_ROUNDS after a successful login with an older hash."""
+    def save(new_hash):
+        conn = get_db_connection()
+        # Only replace the hash the login was checked against; a password change meanwhile wins
+        conn.execute('UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?', (new_hash, user_id, old_hash))
+        conn.commit()
+        conn.close()
+    password_hasher.run_in_background(hash_password, (password, app.config['BCRYPT_LOG_ROUNDS']), save)
 
 # --- Auth API Routes ---
 @app.route('/api/register', methods=['POST'])
@@ -87,19 +1730,25 @@ def register():
         return jsonify({'error': 'Missing required fields'}), 400
 
     conn = get_db_connection()
-    if conn.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email)).fetchone():
-        conn.close()
+    exists = conn.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email)).fetchone()
+    conn.close() # Not held while hashing
+    if exists:
         return jsonify({'error': 'Username or email already exists'}), 409
 
-    password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+    password_hash = password_hasher.run(hash_password, password, app.config['BCRYPT_LOG_ROUNDS'])
     default_settings = json.dumps({'theme': 'dark', 'wallpaper': 'default.jpg'})
 
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO users (username, email, password_hash, settings) VALUES (?, ?, ?, ?)',
-                   (username, email, password_hash, default_settings))
-    user_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO users (username, email, password_hash, settings) VALUES (?, ?, ?, ?)',
+                       (username, email, password_hash, default_settings))
+        user_id = cursor.lastrowid
+        conn.commit()
+    except sqlite3.IntegrityError: # Registered by a concurrent request while this one was hashing
+        return jsonify({'error': 'Username or email already exists'}), 409
+    finally:
+        conn.close()
 
     # Create user's upload directory
     os.makedirs(os.path.join(UPLOADS_FOLDER_PATH, str(user_id)), exist_ok=True)
@@ -117,7 +1766,12 @@ def login():
     user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
     conn.close()
 
-    if user and bcrypt.check_password_hash(user['password_hash'], password):
+    if user and password_hasher.run(verify_password, user['password_hash'], password):
+        if hash_rounds(user['password_hash']) < app.config['BCRYPT_LOG_ROUNDS']:
+            upgrade_password_hash(user['id'], user['password_hash'], password)
+        # A new session id on login, so an id planted before authentication is worthless
+        session.clear()
+        session.regenerate()
         session['user_id'] = user['id']
         session['username'] = user['username']
         return jsonify({'message': 'Login successful', 'username': user['username']}), 200
@@ -140,24 +1794,18 @@ def check_session():
 @login_required
 def list_files():
     user_id = session['user_id']
-    parent_id = request.args.get('parent_id')
-
-    query = 'SELECT id, filename, is_folder, created_at FROM files WHERE user_id = ? AND '
-    params = [user_id]
-
-    if parent_id in (None, 'null', 'undefined'):
-        query += 'parent_id IS NULL'
-    else:
-        query += 'parent_id = ?'
-        params.append(int(parent_id))
+    files, etag = directory_cache.get(user_id, request.args.get('parent_id'))
 
-    query += ' ORDER BY is_folder DESC, filename ASC'
+    response = jsonify(files)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-    conn = get_db_connection()
-    files = conn.execute(query, tuple(params)).fetchall()
-    conn.close()
-
-    return jsonify([dict(row) for row in files])
+@app.route('/api/files/cache_stats', methods=['GET'])
+@login_required
+def directory_cache_stats():
+    return jsonify(directory_cache.stats())
 
 @app.route('/api/files/folder', methods=['POST'])
 @login_required
@@ -168,14 +1816,21 @@ def create_folder():
     parent_id = data.get('parent_id')
     if not filename:
         return jsonify({'error': 'Filename is required'}), 400
+    if not valid_filename(filename):
+        return jsonify({'error': 'Invalid folder name'}), 400
 
     conn = get_db_connection()
-    conn.execute(
-        'INSERT INTO files (user_id, parent_id, filename, is_folder) VALUES (?, ?, ?, ?)',
-        (user_id, parent_id, filename, True)
-    )
-    conn.commit()
-    conn.close()
+    try:
+        # Check and insert under one write lock, so a concurrent create gets NameTaken too
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT INTO files (user_id, parent_id, filename, is_folder, path) VALUES (?, ?, ?, ?, ?)',
+            (user_id, parent_id, filename, True, child_path(conn, user_id, parent_id, filename))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    directory_cache.invalidate(user_id, parent_id)
     return jsonify({'message': 'Folder created successfully'}), 201
 
 @app.route('/api/files/upload', methods=['POST'])
@@ -189,25 +1844,263 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    parent_id = request.form.get('parent_id')
+    parent_id = request.form.get('parent_id') or None
     filename = secure_filename(file.filename)
 
+    # Hash while saving, then take a reference to the (possibly already stored) blob
+    staged = stage_blob(file.save)
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO files (user_id, parent_id, filename, is_folder, file_path) VALUES (?, ?, ?, ?, ?)',
-        (user_id, parent_id, filename, False, 'placeholder')
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        insert_file(conn, user_id, parent_id, filename, staged)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        discard_staged(staged)
+        raise
+    finally:
+        conn.close()
+
+    directory_cache.invalidate(user_id, parent_id)
+    search_indexer.wake()
+    return jsonify({'message': 'File uploaded successfully'}), 201
+
+# --- Resumable Upload API ---
+# POST   /api/files/uploads                  -> start a session for {filename, size, parent_id}
+# GET    /api/files/uploads/<id>             -> which chunks the server already has (for resuming)
+# PUT    /api/files/uploads/<id>/<offset>    -> raw chunk bytes, written in place; chunks may arrive in parallel
+# POST   /api/files/uploads/<id>/complete    -> hash the assembled file and add it to the file tree
+# DELETE /api/files/uploads/<id>             -> abort
+def get_upload_session(conn, upload_id, user_id):
+    return conn.execute('SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?', (upload_id, user_id)).fetchone()
+
+class UploadClosed(Exception):
+    """The upload is being completed or aborted; its chunks are no longer accepted."""
+
+@app.errorhandler(UploadClosed)
+def handle_upload_closed(e):
+    return jsonify({'error': 'Upload is being completed or aborted'}), 409
+
+class UploadWriters:
+    """Keeps chunk writes away from an upload that is being completed or aborted.
+
+    Chunks of one upload still write in parallel. Closing an upload turns new chunks away and
+    waits for the ones in flight, so its temp file is never written after it has been hashed
+    and handed to the blob store.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._writing = {} # upload_id -> chunk writes in progress
+        self._closed = set()
+
+    def begin_write(self, upload_id):
+        """Registers a chunk write; False if the upload is closed."""
+        with self._cond:
+            if upload_id in self._closed:
+                return False
+            self._writing[upload_id] = self._writing.get(upload_id, 0) + 1
+            return True
+
+    def end_write(self, upload_id):
+        with self._cond:
+            self._writing[upload_id] -= 1
+            if not self._writing[upload_id]:
+                del self._writing[upload_id]
+                self._cond.notify_all()
+
+    @contextmanager
+    def closed(self, upload_id):
+        """Holds the upload closed for the duration, once its in-flight chunk writes have finished.
+
+        Raises UploadClosed if another request holds it closed already.
+        """
+        with self._cond:
+            if upload_id in self._closed:
+                raise UploadClosed(upload_id)
+            self._closed.add(upload_id)
+            self._cond.wait_for(lambda: upload_id not in self._writing)
+        try:
+            yield
+        finally:
+            # By now the session row is gone (or the upload can go on), so later chunks re-check the database
+            with self._cond:
+                self._closed.discard(upload_id)
+
+upload_writers = UploadWriters()
+
+def upload_status(conn, upload):
+    chunks = conn.execute('SELECT chunk_index FROM upload_chunks WHERE upload_id = ?', (upload['id'],)).fetchall()
+    total = -(-upload['size'] // upload['chunk_size']) # ceil
+    received = [c['chunk_index'] * upload['chunk_size'] for c in chunks]
+    return {
+        'upload_id': upload['id'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'received_offsets': received,
+        'complete': len(received) == total
+    }
+
+@app.route('/api/files/uploads', methods=['POST'])
+@login_required
+def start_upload():
+    user_id = session['user_id']
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    if not filename:
+        return jsonify({'error': 'Filename is required'}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'A non-negative size is required'}), 400
+    conn = get_db_connection()
+    try:
+        child_path(conn, user_id, data.get('parent_id'), filename) # Fail now rather than after the last chunk
+    finally:
+        conn.close()
+
+    upload_id = uuid.uuid4().hex
+    tmp_dir = os.path.join(UPLOADS_FOLDER_PATH, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f'upload-{upload_id}')
+
+    # Preallocate the destination so chunks are written straight into their final place
+    with open(tmp_path, 'wb') as f:
+        if size:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):
+                f.truncate(size)
+
+    conn = get_db_connection()
+    conn.execute(
+        'INSERT INTO upload_sessions (id, user_id, parent_id, filename, size, chunk_size, tmp_path, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (upload_id, user_id, data.get('parent_id'), filename, size, app.config['UPLOAD_CHUNK_SIZE'], tmp_path, time.time())
     )
-    file_id = cursor.lastrowid
+    conn.commit()
+    upload = get_upload_session(conn, upload_id, user_id)
+    status = upload_status(conn, upload)
+    conn.close()
+    return jsonify(status), 201
+
+@app.route('/api/files/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_upload(upload_id):
+    conn = get_db_connection()
+    upload = get_upload_session(conn, upload_id, session['user_id'])
+    status = upload_status(conn, upload) if upload else None
+    conn.close()
+    if not status:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/files/uploads/<upload_id>/<int:offset>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, offset):
+    if not upload_writers.begin_write(upload_id):
+        raise UploadClosed(upload_id)
+    try:
+        return write_upload_chunk(upload_id, offset)
+    finally:
+        upload_writers.end_write(upload_id)
 
-    file_path = os.path.join(UPLOADS_FOLDER_PATH, str(user_id), str(file_id))
-    file.save(file_path)
+def write_upload_chunk(upload_id, offset):
+    # Looked up after begin_write, so a session completed or aborted meanwhile is seen as gone
+    conn = get_db_connection()
+    upload = get_upload_session(conn, upload_id, session['user_id'])
+    conn.close()
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    chunk_size, size = upload['chunk_size'], upload['size']
+    if offset % chunk_size or offset >= size:
+        return jsonify({'error': f'Offset must be a multiple of {chunk_size} below {size}'}), 400
+    expected = min(chunk_size, size - offset)
+    if request.content_length != expected:
+        return jsonify({'error': f'Chunk at offset {offset} must be {expected} bytes'}), 400
+
+    # Stream the body straight into its slot; pwrite lets parallel chunks share the file
+    remaining = expected
+    fd = os.open(upload['tmp_path'], os.O_WRONLY)
+    try:
+        position = offset
+        while remaining:
+            block = request.stream.read(min(remaining, 1024 * 1024))
+            if not block:
+                break
+            os.pwrite(fd, block, position)
+            position += len(block)
+            remaining -= len(block)
+    finally:
+        os.close(fd)
+    if remaining:
+        return jsonify({'error': 'Chunk body was truncated'}), 400
 
-    cursor.execute('UPDATE files SET file_path = ? WHERE id = ?', (file_path, file_id))
+    conn = get_db_connection()
+    conn.execute('INSERT OR IGNORE INTO upload_chunks (upload_id, chunk_index) VALUES (?, ?)', (upload_id, offset // chunk_size))
+    conn.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?', (time.time(), upload_id))
     conn.commit()
     conn.close()
+    return jsonify({'offset': offset, 'length': expected})
 
-    return jsonify({'message': 'File uploaded successfully'}), 201
+@app.route('/api/files/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    with upload_writers.closed(upload_id):
+        return finish_upload(upload_id)
+
+def finish_upload(upload_id):
+    user_id = session['user_id']
+    conn = get_db_connection()
+    upload = get_upload_session(conn, upload_id, user_id)
+    status = upload_status(conn, upload) if upload else None
+    conn.close()
+    if not status:
+        return jsonify({'error': 'Upload not found'}), 404
+    if not status['complete']:
+        return jsonify({'error': 'Upload is missing chunks', **status}), 409
+
+    # Chunks arrive out of order, so the content hash is taken in one pass once the file is whole
+    digest = hashlib.sha256()
+    with open(upload['tmp_path'], 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        # Deleting the session first makes a second /complete after this one a no-op
+        if not conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,)).rowcount:
+            conn.rollback()
+            return jsonify({'error': 'Upload not found'}), 404
+        conn.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+        file_id = insert_file(conn, user_id, upload['parent_id'], upload['filename'],
+                              (upload['tmp_path'], digest.hexdigest(), upload['size']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    directory_cache.invalidate(user_id, upload['parent_id'])
+    search_indexer.wake()
+    return jsonify({'message': 'File uploaded successfully', 'id': file_id, 'filename': upload['filename']}), 201
+
+@app.route('/api/files/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    with upload_writers.closed(upload_id):
+        conn = get_db_connection()
+        upload = get_upload_session(conn, upload_id, session['user_id'])
+        if upload:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+            conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+            conn.execute('INSERT INTO pending_deletions (file_path) VALUES (?)', (upload['tmp_path'],))
+            conn.commit()
+        conn.close()
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    file_reclaimer.wake()
+    return jsonify({'message': 'Upload aborted'})
 
 @app.route('/api/files/download/<int:file_id>', methods=['GET'])
 @login_required
@@ -220,7 +2113,97 @@ def download_file(file_id):
     if not file_info or file_info['is_folder']:
         return jsonify({'error': 'File not found or is a folder'}), 404
 
-    return send_file(file_info['file_path'], as_attachment=True, download_name=file_info['filename'])
+    inline = request.args.get('inline') in ('1', 'true')
+    return send_stored_file(file_info, as_attachment=not inline)
+
+def send_stored_file(file_info, as_attachment=True):
+    """Sends a stored file with ETag/Last-Modified validators and single or multipart Range support."""
+    path = file_info['file_path']
+    mimetype = mimetypes.guess_type(file_info['filename'])[0] or 'application/octet-stream'
+    # Blob contents never change, so the content hash is a strong validator.
+    # Files stored before the blob store fall back to Werkzeug's mtime/size ETag.
+    etag = file_info['blob_hash'] or True
+
+    byte_ranges = request.range.ranges if request.range else []
+    if (len(byte_ranges) > 1 and file_info['blob_hash']
+            and not request.if_none_match.contains(etag)
+            and not request.if_range.date and request.if_range.etag in (None, etag)):
+        # Werkzeug only serves single ranges, so multipart/byteranges is assembled here
+        return send_byteranges(path, mimetype, etag, byte_ranges)
+
+    response = send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                         download_name=file_info['filename'], conditional=True, etag=etag)
+    # Always revalidate: the id can point at new content after a save, but unchanged files cost a 304
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def send_byteranges(path, mimetype, etag, byte_ranges):
+    size = os.path.getsize(path)
+    parts = []
+    for start, stop in byte_ranges:
+        if start < 0: # Suffix range: the last -start bytes
+            start, stop = max(size + start, 0), size
+        stop = size if stop is None else min(stop, size)
+        if start < stop:
+            parts.append((start, stop))
+    if not parts:
+        return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    boundary = uuid.uuid4().hex
+    heads = [
+        f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'.encode()
+        for start, stop in parts
+    ]
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    length = sum(len(head) + stop - start for head, (start, stop) in zip(heads, parts)) + len(tail)
+
+    def generate():
+        with open(path, 'rb') as f:
+            for head, (start, stop) in zip(heads, parts):
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                while remaining:
+                    block = f.read(min(remaining, 64 * 1024))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+        yield tail
+
+    response = Response(generate(), status=206, content_type=f'multipart/byteranges; boundary={boundary}')
+    response.headers['Content-Length'] = str(length)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/files/thumbnail/<int:file_id>', methods=['GET'])
+@login_required
+def get_thumbnail(file_id):
+    user_id = session['user_id']
+    size_name = request.args.get('size', 'medium')
+    if size_name not in app.config['THUMBNAIL_SIZES']:
+        return jsonify({'error': f"Size must be one of {', '.join(app.config['THUMBNAIL_SIZES'])}"}), 400
+
+    conn = get_db_connection()
+    file_info = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
+    conn.close()
+    if not file_info or file_info['is_folder']:
+        return jsonify({'error': 'File not found or is a folder'}), 404
+
+    try:
+        # Files stored before the blob store are versioned by modification time instead
+        version = file_info['blob_hash'] or str(int(os.path.getmtime(file_info['file_path'])))
+        path = thumbnail_cache.get(file_id, version, size_name, file_info['file_path'])
+    except (OSError, Image.DecompressionBombError):
+        return jsonify({'error': 'No preview available for this file'}), 415
+
+    response = send_file(path, mimetype='image/webp', conditional=True, etag=f'{version}-{size_name}')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/files/rename/<int:file_id>', methods=['PUT'])
 @login_required
@@ -229,48 +2212,183 @@ def rename_file(file_id):
     new_name = request.json.get('new_name')
     if not new_name:
         return jsonify({'error': 'New name is required'}), 400
+    if not valid_filename(new_name):
+        return jsonify({'error': 'Invalid name'}), 400
 
     conn = get_db_connection()
-    conn.execute('UPDATE files SET filename = ? WHERE id = ? AND user_id = ?', (new_name, file_id, user_id))
-    conn.commit()
-    conn.close()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        item = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
+        if not item:
+            conn.rollback()
+            return jsonify({'error': 'File not found'}), 404
+        relocate_item(conn, user_id, item, item['parent_id'], new_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    directory_cache.invalidate(user_id, item['parent_id'])
     return jsonify({'message': 'File renamed successfully'})
 
+@app.route('/api/files/move/<int:file_id>', methods=['PUT'])
+@login_required
+def move_file(file_id):
+    user_id = session['user_id']
+    data = request.get_json() or {}
+    if 'parent_id' not in data:
+        return jsonify({'error': 'Target parent_id is required'}), 400
+    parent_id = data['parent_id']
+
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        item = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
+        if not item:
+            conn.rollback()
+            return jsonify({'error': 'File not found'}), 404
+        relocate_item(conn, user_id, item, parent_id, item['filename'])
+        conn.commit()
+    except InvalidMove:
+        conn.rollback()
+        return jsonify({'error': 'Cannot move a folder into itself'}), 400
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    directory_cache.invalidate(user_id, item['parent_id'], parent_id)
+    return jsonify({'message': 'File moved successfully'})
+
 @app.route('/api/files/delete/<int:file_id>', methods=['DELETE'])
 @login_required
 def delete_file(file_id):
     user_id = session['user_id']
     conn = get_db_connection()
-
-    # Recursively find all files to delete from filesystem
-    files_to_delete = []
-    q = [file_id]
-    while q:
-        current_id = q.pop(0)
-        item = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (current_id, user_id)).fetchone()
-        if not item: continue # Should not happen if DB is consistent
-        if not item['is_folder'] and item['file_path']:
-            files_to_delete.append(item['file_path'])
-
-        children = conn.execute('SELECT id FROM files WHERE parent_id = ?', (current_id,)).fetchall()
-        for child in children:
-            q.append(child['id'])
-
-    # Delete physical files
-    for path in files_to_delete:
-        if os.path.exists(path):
-            os.remove(path)
-
-    # Delete from DB (CASCADE should handle children)
-    conn.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (file_id, user_id))
-    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        item = conn.execute('SELECT parent_id FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
+        folder_ids, file_ids = delete_item(conn, user_id, file_id) if item else ([], [])
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        conn.close()
+        raise
     conn.close()
 
+    if not item:
+        return jsonify({'error': 'File not found'}), 404
+    directory_cache.invalidate(user_id, item['parent_id'], *folder_ids)
+    thumbnail_cache.invalidate(*file_ids)
+    file_reclaimer.wake()
     return jsonify({'message': 'File or folder deleted successfully'})
 
+# --- Paged File Content ---
+# Blobs are immutable, so a sparse line index (byte offset of every LINE_INDEX_STRIDE-th
+# line) can be cached per blob hash and reused until the content changes.
+LINE_INDEX_STRIDE = 1000
+line_index_cache = OrderedDict()
+line_index_lock = threading.Lock()
+
+def get_line_index(path, version):
+    with line_index_lock:
+        if version in line_index_cache:
+            line_index_cache.move_to_end(version)
+            return line_index_cache[version]
+
+    offsets = [0]
+    position = 0
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, start=1):
+            position += len(line)
+            if number % LINE_INDEX_STRIDE == 0:
+                offsets.append(position)
+
+    with line_index_lock:
+        line_index_cache[version] = offsets
+        while len(line_index_cache) > 64:
+            line_index_cache.popitem(last=False)
+    return offsets
+
+def read_byte_window(path, offset, length):
+    """Reads up to length bytes from offset, trimmed back to a UTF-8 character boundary."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        data = f.read(length)
+    end = len(data)
+    if offset + end < size:
+        # Back up over a trailing partial character; its bytes start the next window
+        lead = end
+        while lead > 0 and end - lead < 3 and (data[lead - 1] & 0xC0) == 0x80:
+            lead -= 1
+        if lead > 0 and data[lead - 1] >= 0xC0:
+            first = data[lead - 1]
+            width = 2 if first < 0xE0 else 3 if first < 0xF0 else 4
+            if end - (lead - 1) < width:
+                end = lead - 1
+    return data[:end].decode('utf-8', errors='replace'), offset + end, size
+
+def read_line_window(path, version, start_line, count):
+    index = get_line_index(path, version)
+    block = min(start_line // LINE_INDEX_STRIDE, len(index) - 1)
+    lines = []
+    with open(path, 'rb') as f:
+        f.seek(index[block])
+        for _ in range(start_line - block * LINE_INDEX_STRIDE):
+            if not f.readline():
+                break
+        for _ in range(count):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        eof = not f.read(1)
+    return b''.join(lines).decode('utf-8', errors='replace'), start_line + len(lines), eof
+
+def parse_patches(patches, size):
+    """Validates [{offset, length, content}] edits against the original size; returns (offset, length, bytes) sorted."""
+    if not isinstance(patches, list) or not all(isinstance(patch, dict) for patch in patches):
+        raise ValueError('Patches must be a list of {offset, length, content} objects')
+    parsed = []
+    for patch in patches:
+        offset, length, content = patch.get('offset'), patch.get('length'), patch.get('content')
+        if not isinstance(offset, int) or not isinstance(length, int) or not isinstance(content, str) \
+                or offset < 0 or length < 0 or offset + length > size:
+            raise ValueError('Each patch needs an integer offset and length inside the file and a string content')
+        parsed.append((offset, length, content.encode('utf-8')))
+    parsed.sort(key=lambda p: p[0])
+    for (a_offset, a_length, _), (b_offset, _, _) in zip(parsed, parsed[1:]):
+        if a_offset + a_length > b_offset:
+            raise ValueError('Patches must not overlap')
+    return parsed
+
+def copy_bytes(src, dst, count):
+    while count > 0:
+        block = src.read(min(count, 1024 * 1024))
+        if not block:
+            break
+        dst.write(block)
+        count -= len(block)
+
+def stage_patched(source_path, patches):
+    """Stages a new blob: the source with each (offset, length) byte range replaced, streamed without loading it."""
+    def write(out):
+        with open(source_path, 'rb') as src:
+            position = 0
+            for offset, length, content in patches:
+                copy_bytes(src, out, offset - position)
+                src.seek(offset + length)
+                position = offset + length
+                out.write(content)
+            shutil.copyfileobj(src, out)
+    return stage_blob(write)
+
 @app.route('/api/files/content/<int:file_id>', methods=['GET'])
 @login_required
 def get_file_content(file_id):
+    """Returns the whole file, or a window of it with ?offset=&length= (bytes) or ?start_line=&lines=."""
     user_id = session['user_id']
     conn = get_db_connection()
     file_info = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
@@ -279,16 +2397,39 @@ def get_file_content(file_id):
     if not file_info or file_info['is_folder']:
         return jsonify({'error': 'File not found or is a folder'}), 404
 
+    path = file_info['file_path']
+    version = file_info['blob_hash']
     try:
-        with open(file_info['file_path'], 'r', encoding='utf-8') as f:
+        if 'offset' in request.args or 'length' in request.args:
+            offset = max(request.args.get('offset', 0, type=int), 0)
+            length = request.args.get('length', app.config['CONTENT_PAGE_MAX_BYTES'], type=int)
+            length = min(max(length, 0), app.config['CONTENT_PAGE_MAX_BYTES'])
+            content, next_offset, size = read_byte_window(path, offset, length)
+            return jsonify({'content': content, 'offset': offset, 'next_offset': next_offset,
+                            'size': size, 'eof': next_offset >= size, 'version': version})
+
+        if 'start_line' in request.args or 'lines' in request.args:
+            start_line = max(request.args.get('start_line', 0, type=int), 0)
+            count = request.args.get('lines', app.config['CONTENT_PAGE_MAX_LINES'], type=int)
+            count = min(max(count, 0), app.config['CONTENT_PAGE_MAX_LINES'])
+            content, next_line, eof = read_line_window(path, version or path, start_line, count)
+            return jsonify({'content': content, 'start_line': start_line, 'next_line': next_line,
+                            'eof': eof, 'version': version})
+
+        with open(path, 'r', encoding='utf-8') as f:
             content = f.read()
-        return jsonify({'content': content})
+        return jsonify({'content': content, 'version': version})
     except Exception as e:
         return jsonify({'error': f'Could not read file: {e}'}), 500
 
 @app.route('/api/files/content/<int:file_id>', methods=['PUT'])
 @login_required
 def update_file_content(file_id):
+    """Saves {content} as the whole file, or applies {patches: [{offset, length, content}]} byte-range edits.
+
+    Either form may send base_version (the version it read); a mismatch returns 409 instead of overwriting.
+    Every save writes a new blob and swaps the reference, so a crash can't leave a half-written file.
+    """
     user_id = session['user_id']
     conn = get_db_connection()
     file_info = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
@@ -297,182 +2438,892 @@ def update_file_content(file_id):
     if not file_info or file_info['is_folder']:
         return jsonify({'error': 'File not found or is a folder'}), 404
 
-    data = request.get_json()
-    if 'content' not in data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or ('content' not in data and 'patches' not in data):
         return jsonify({'error': 'No content provided'}), 400
+    if 'patches' not in data and not isinstance(data['content'], str):
+        return jsonify({'error': 'Content must be a string'}), 400
+    base_version = data.get('base_version')
+    if base_version is not None and base_version != file_info['blob_hash']:
+        return jsonify({'error': 'File was changed by someone else', 'version': file_info['blob_hash']}), 409
 
     try:
-        with open(file_info['file_path'], 'w', encoding='utf-8') as f:
-            f.write(data['content'])
-        return jsonify({'message': 'File saved successfully'})
+        if 'patches' in data:
+            try:
+                patches = parse_patches(data['patches'], os.path.getsize(file_info['file_path']))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            staged = stage_patched(file_info['file_path'], patches)
+        else:
+            content = data['content'].encode('utf-8')
+            staged = stage_blob(lambda f: f.write(content))
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            replace_file_content(conn, file_id, staged, expected_version=base_version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            discard_staged(staged)
+            raise
+        finally:
+            conn.close()
+        file_reclaimer.wake()
+        search_indexer.wake()
+        return jsonify({'message': 'File saved successfully', 'version': staged[1], 'size': staged[2]})
+    except VersionConflict as e:
+        return jsonify({'error': 'File was changed by someone else', 'version': e.args[0]}), 409
     except Exception as e:
         return jsonify({'error': f'Could not write to file: {e}'}), 500
 
-# --- Terminal API Route ---
-def resolve_path(conn, user_id, cwd_id, path):
-    """Resolves a path string (like '..', 'folder', '/a/b') to a file ID."""
-    if path.startswith('/'):
-        # Absolute path - not implemented for simplicity
-        return None # Or resolve from root
-
-    path_parts = path.split('/')
-    current_id = cwd_id
-
-    for part in path_parts:
-        if not part or part == '.':
-            continue
-        if part == '..':
-            if current_id is not None:
-                # Get parent of current_id
-                parent = conn.execute('SELECT parent_id FROM files WHERE id = ?', (current_id,)).fetchone()
-                current_id = parent['parent_id'] if parent else None
-            continue # Stay at root if already there
-
-        # Look for the next part in the current directory
-        query = 'SELECT id FROM files WHERE user_id = ? AND filename = ? AND is_folder = 1 AND '
-        params = [user_id, part]
-        if current_id is None:
-            query += 'parent_id IS NULL'
-        else:
-            query += 'parent_id = ?'
-            params.append(current_id)
-
-        next_item = conn.execute(query, tuple(params)).fetchone()
-        if next_item:
-            current_id = next_item['id']
-        else:
-            return 'not_found' # Path does not exist
-
-    return current_id
+@app.route('/api/files/copy/<int:file_id>', methods=['POST'])
+@login_required
+def copy_file(file_id):
+    user_id = session['user_id']
+    data = request.get_json() or {}
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        source = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
+        if not source or source['is_folder']:
+            conn.rollback()
+            return jsonify({'error': 'File not found or is a folder'}), 404
+
+        parent_id = data.get('parent_id', source['parent_id'])
+        filename = data.get('filename') or source['filename']
+        if not valid_filename(filename):
+            conn.rollback()
+            return jsonify({'error': 'Invalid name'}), 400
+        new_id = copy_file_item(conn, user_id, source, parent_id, filename)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    directory_cache.invalidate(user_id, parent_id)
+    search_indexer.wake()
+    return jsonify({'message': 'File copied successfully', 'id': new_id, 'filename': filename}), 201
 
-@app.route('/api/terminal/execute', methods=['POST'])
+# --- Search API Routes ---
+@app.route('/api/search', methods=['GET'])
 @login_required
-def execute_command():
+def search():
+    """Ranked, paginated search: ?q=terms&in=all|name|content&path=/folder&limit=50&offset=0."""
     user_id = session['user_id']
-    data = request.get_json()
-    command_str = data.get('command', '')
-    cwd_id = data.get('cwd_id') # Current working directory ID
+    fields = request.args.get('in', 'all')
+    if fields not in SEARCH_FIELDS:
+        return jsonify({'error': 'in must be all, name or content'}), 400
+    limit = max(1, min(request.args.get('limit', app.config['SEARCH_PAGE_SIZE'], type=int), app.config['SEARCH_PAGE_SIZE']))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    folder_path = ''
+    if request.args.get('path'):
+        conn = get_db_connection()
+        folder_path, folder = lookup_path(conn, user_id, None, request.args['path'])
+        conn.close()
+        if folder == 'not_found' or (folder is not None and not folder['is_folder']):
+            return jsonify({'error': 'Folder not found'}), 404
 
-    parts = command_str.strip().split()
-    command = parts[0].lower() if parts else ''
-    args = parts[1:]
+    # One extra row tells whether there is a next page
+    rows, fuzzy = search_files(user_id, request.args.get('q', ''), fields, folder_path, limit + 1, offset)
+    return jsonify({'results': rows[:limit], 'fuzzy': fuzzy,
+                    'next_offset': offset + limit if len(rows) > limit else None})
 
-    output = ''
-    new_cwd = {} # To send back if 'cd' is successful
+# --- Terminal ---
+# A command line is split into pipeline stages, wildcards are expanded, and every stage runs as a
+# generator reading the previous one's output, so output streams out as it is produced and a
+# `head` at the end stops the commands before it. Commands register themselves in TERMINAL_COMMANDS.
+TERMINAL_COMMANDS = {} # name -> (function(term, args, stdin) yielding output text, usage)
 
-    conn = get_db_connection()
+def terminal_command(name, usage):
+    def register(f):
+        TERMINAL_COMMANDS[name] = (f, usage)
+        return f
+    return register
 
-    if command == 'help':
-        output = 'Available commands: help, ls, cd, cat, echo'
-    elif command == 'echo':
-        output = ' '.join(args)
-    elif command == 'ls':
-        query = 'SELECT filename, is_folder FROM files WHERE user_id = ? AND '
-        params = [user_id]
-        if cwd_id is None:
-            query += 'parent_id IS NULL'
-        else:
-            query += 'parent_id = ?'
-            params.append(cwd_id)
-        query += ' ORDER BY is_folder DESC, filename ASC'
+class TerminalError(Exception):
+    """Ends a command with an error message, like a process exiting with a status."""
 
-        items = conn.execute(query, tuple(params)).fetchall()
-        output = '\n'.join([f"{i['filename']}{'/' if i['is_folder'] else ''}" for i in items])
-    elif command == 'cd':
-        if not args:
-            output = 'Usage: cd <directory>'
-        else:
-            path = args[0]
-            target_id = resolve_path(conn, user_id, cwd_id, path)
+GLOB_CHARS = '*?['
 
-            if target_id == 'not_found':
-                output = f"cd: no such file or directory: {path}"
+def split_command_line(line):
+    """Splits a command line into pipeline stages of (word, glob) pairs, with POSIX shell quoting.
+
+    glob is None unless the word has unquoted wildcards; quoted wildcard characters in it are
+    bracketed ('[*]') so they only match themselves.
+    """
+    stages, words, chars, quote = [], [], None, None
+
+    def end_word():
+        nonlocal chars
+        if chars is not None:
+            text = ''.join(c for c, _ in chars)
+            glob = None
+            if any(c in GLOB_CHARS and not quoted for c, quoted in chars):
+                glob = ''.join(f'[{c}]' if quoted and c in GLOB_CHARS else c for c, quoted in chars)
+            words.append((text, glob))
+            chars = None
+
+    i = 0
+    while i < len(line):
+        ch = line[i]
+        if quote:
+            if ch == quote:
+                quote = None
+            elif ch == '\\' and quote == '"' and line[i + 1:i + 2] in ('"', '\\'):
+                i += 1
+                chars.append((line[i], True))
             else:
-                # Get the name of the new directory for the prompt
-                if target_id is None:
-                    new_cwd = {'id': None, 'name': '~'}
-                else:
-                    new_name = conn.execute('SELECT filename FROM files WHERE id = ?', (target_id,)).fetchone()['filename']
-                    new_cwd = {'id': target_id, 'name': new_name}
-                output = f"Changed directory to {new_cwd['name']}"
-    elif command == 'cat':
-        if not args:
-            output = 'Usage: cat <path/to/filename>'
+                chars.append((ch, True))
+        elif ch in '\'"':
+            quote = ch
+            chars = chars if chars is not None else []
+        elif ch == '\\' and i + 1 < len(line):
+            i += 1
+            chars = chars if chars is not None else []
+            chars.append((line[i], True))
+        elif ch.isspace():
+            end_word()
+        elif ch == '|':
+            end_word()
+            stages.append(words)
+            words = []
         else:
-            path = args[0]
-            target_dir_id = cwd_id
-            filename = path
-
-            if '/' in path:
-                path_parts = path.rsplit('/', 1)
-                dir_path, filename = path_parts[0], path_parts[1]
-                if dir_path: # Handle cases like 'folder/file.txt' but not '/file.txt' from root
-                    target_dir_id = resolve_path(conn, user_id, cwd_id, dir_path)
-                else: # Path starts with '/', treat as absolute from user's root
-                    target_dir_id = None
-
-            if target_dir_id == 'not_found':
-                output = f"cat: {path}: No such file or directory"
+            chars = chars if chars is not None else []
+            chars.append((ch, False))
+        i += 1
+    if quote:
+        raise TerminalError(f'syntax error: unterminated {quote}')
+    end_word()
+    stages.append(words)
+    if len(stages) > 1 and not all(stages):
+        raise TerminalError("syntax error near unexpected token '|'")
+    return stages if stages[0] else []
+
+def glob_regex(pattern):
+    """Compiles a shell wildcard pattern over whole paths: * and ? never match '/'."""
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '*':
+            out.append('[^/]*')
+        elif ch == '?':
+            out.append('[^/]')
+        elif ch == '[':
+            j = i + 1
+            if pattern[j:j + 1] in ('!', '^'):
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1 # A ']' right after the opening bracket is part of the set
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append(re.escape(ch))
             else:
-                query = 'SELECT id, file_path, is_folder FROM files WHERE user_id = ? AND filename = ? AND '
-                params = [user_id, filename]
-                if target_dir_id is None:
-                    query += 'parent_id IS NULL'
+                body = pattern[i + 1:j]
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j
+        else:
+            out.append(re.escape(ch))
+        i += 1
+    return re.compile(''.join(out) + r'\Z')
+
+def parse_options(command, args, flags='', valued=''):
+    """Splits args getopt-style into ({option: True or value}, operands); understands -rf, -n 5, -n5 and --."""
+    options, operands = {}, []
+    args = iter(args)
+    for arg in args:
+        if arg == '--':
+            operands.extend(args)
+            break
+        if len(arg) < 2 or arg[0] != '-':
+            operands.append(arg)
+            continue
+        for i, option in enumerate(arg[1:], start=1):
+            if option in valued:
+                value = arg[i + 1:] or next(args, None)
+                if value is None:
+                    raise TerminalError(f"{command}: option requires an argument -- '{option}'")
+                options[option] = value
+                break
+            if option not in flags:
+                raise TerminalError(f"{command}: invalid option -- '{option}'")
+            options[option] = True
+    return options, operands
+
+def count_option(command, options, default=10):
+    try:
+        return int(options.get('n', default))
+    except ValueError:
+        raise TerminalError(f"{command}: invalid number of lines: '{options['n']}'")
+
+def iter_lines(chunks):
+    """Re-splits streamed text into lines, each keeping its '\\n' (except possibly the last)."""
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+class TerminalSession:
+    """One command line's state: the user, the working folder and a database connection opened on first use."""
+    def __init__(self, user_id, cwd_id):
+        self.user_id = user_id
+        self.cwd_id = None if cwd_id in (None, '', 'null') else cwd_id
+        self.new_cwd = {}
+        self.errors = [] # Messages not yet sent; the terminal has no separate stderr pane
+        self.touched_folders = set() # Listings to invalidate once the command line is done
+        self.deleted = False
+        self.wrote = False
+        self._conn = None
+        self._cwd_path = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = get_db_connection()
+        return self._conn
+
+    @property
+    def cwd_path(self):
+        if self._cwd_path is None:
+            self._cwd_path = get_folder_path(self.conn, self.user_id, self.cwd_id) if self.cwd_id is not None else ''
+            if self._cwd_path is None:
+                raise TerminalError('working directory no longer exists; cd ~')
+        return self._cwd_path
+
+    def error(self, message):
+        self.errors.append(message + '\n')
+
+    def lookup(self, path):
+        """(full_path, row) for a path typed at the prompt; row is None for the root and 'not_found' if missing."""
+        full_path = normalize_path(self.cwd_path, path)
+        if not full_path:
+            return '', None
+        row = self.conn.execute('SELECT * FROM files WHERE user_id = ? AND path = ?', (self.user_id, full_path)).fetchone()
+        return full_path, row or 'not_found'
+
+    def resolve(self, command, path):
+        full_path, row = self.lookup(path)
+        if row == 'not_found':
+            raise TerminalError(f'{command}: {path}: No such file or directory')
+        return full_path, row
+
+    def folder_id(self, row):
+        return None if row is None else row['id']
+
+    @staticmethod
+    def display(full_path):
+        return '~' + full_path
+
+    def expand(self, stages):
+        """Replaces wildcard words with the sorted paths they match, resolved for the whole line in one query.
+
+        Like a shell, a pattern that matches nothing is passed on unchanged.
+        """
+        patterns = {}
+        for words in stages:
+            for text, glob in words:
+                if glob:
+                    full = normalize_path(self.cwd_path, glob)
+                    directory = full[:full.find(next(c for c in full if c in GLOB_CHARS))].rsplit('/', 1)[0]
+                    patterns[glob] = (full, directory, glob_regex(full), [])
+        if patterns:
+            where, params = [], [self.user_id]
+            for full, directory, _, _ in patterns.values():
+                where.append('(path >= ? AND path < ? AND path GLOB ?)')
+                params.extend((*subtree_range(directory), full.replace('[!', '[^')))
+            rows = self.conn.execute(f"SELECT DISTINCT path FROM files WHERE user_id = ? AND ({' OR '.join(where)}) ORDER BY path",
+                                     params).fetchall()
+            for glob, (_, _, regex, matches) in patterns.items():
+                relative = not glob.startswith(('/', '~')) and '..' not in glob.split('/')
+                for row in rows:
+                    if regex.match(row['path']):
+                        matches.append(row['path'][len(self.cwd_path) + 1:] if relative else self.display(row['path']))
+        expanded = []
+        for words in stages:
+            args = []
+            for text, glob in words:
+                args.extend((patterns[glob][3] or [text]) if glob else [text])
+            expanded.append(args)
+        return expanded
+
+    def run(self, line):
+        """Runs a command line, yielding its output text as it is produced (errors included)."""
+        try:
+            try:
+                stages = self.expand(split_command_line(line))
+            except TerminalError as e:
+                self.error(str(e))
+                stages = []
+            stream = None
+            for args in stages:
+                name = args[0].lower()
+                entry = TERMINAL_COMMANDS.get(name)
+                if entry is None:
+                    self.error(f'{name}: command not found')
+                    stream = iter(())
                 else:
-                    query += 'parent_id = ?'
-                    params.append(target_dir_id)
-
-                file_to_cat = conn.execute(query, tuple(params)).fetchone()
+                    stream = self._run_command(entry[0], name, args[1:], stream)
+            for chunk in stream or ():
+                if self.errors:
+                    yield ''.join(self.errors)
+                    self.errors.clear()
+                yield chunk
+            if self.errors:
+                yield ''.join(self.errors)
+        finally:
+            self.close()
 
-                if not file_to_cat:
-                    output = f"cat: {path}: No such file or directory"
-                elif file_to_cat['is_folder']:
-                    output = f"cat: {filename}: Is a directory"
-                else:
-                    try:
-                        with open(file_to_cat['file_path'], 'r', encoding='utf-8') as f:
-                            output = f.read()
-                    except Exception:
-                        output = f"cat: {filename}: Cannot read file"
+    def _run_command(self, function, name, args, stdin):
+        try:
+            output = function(self, args, stdin) # Commands without output may be plain functions
+            if output is not None:
+                yield from output
+        except TerminalError as e:
+            self.error(str(e))
+        except NameTaken as e:
+            self.error(f"{name}: '{self.display(e.args[0])}': File exists")
+        except ParentNotFound:
+            self.error(f'{name}: No such directory')
+        except (sqlite3.Error, OSError) as e:
+            # Locked database, unreadable blob and the like; anything else is a bug and propagates
+            print(f"Terminal command {name} failed: {e}")
+            self.error(f'{name}: {e}')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self.touched_folders:
+            directory_cache.invalidate(self.user_id, *self.touched_folders)
+        if self.deleted:
+            file_reclaimer.wake()
+        if self.wrote:
+            search_indexer.wake()
+
+    def write(self, operation):
+        """Runs operation(conn) in its own write transaction, so one failing item doesn't undo the others."""
+        conn = self.conn
+        self.wrote = True
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = operation(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return result
+
+    def read_file(self, command, path, row):
+        """Streams a text file's content in TERMINAL_READ_SIZE pieces."""
+        if row is None or row['is_folder']:
+            raise TerminalError(f'{command}: {path}: Is a directory')
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        try:
+            with open(row['file_path'], 'rb') as f:
+                first = True
+                for block in iter(lambda: f.read(app.config['TERMINAL_READ_SIZE']), b''):
+                    if first and is_binary(block):
+                        raise TerminalError(f'{command}: {path}: Cannot read file')
+                    first = False
+                    yield decoder.decode(block)
+        except OSError:
+            raise TerminalError(f'{command}: {path}: Cannot read file')
+        yield decoder.decode(b'', final=True)
+
+    def input_lines(self, command, paths, stdin):
+        """Lines of the named files in turn, or of stdin when no file is named."""
+        if not paths:
+            yield from iter_lines(stdin or ())
+            return
+        for path in paths:
+            _, row = self.resolve(command, path)
+            yield from iter_lines(self.read_file(command, path, row))
+
+    def destination(self, command, target, sources):
+        """Where mv/cp put each source: [(source path, row, parent_id, name, replaced row or None)]."""
+        full_path, row = self.lookup(target)
+        if row is None or (row != 'not_found' and row['is_folder']):
+            return [(path, source, self.folder_id(row), source['filename'], None) for path, source in sources]
+        if len(sources) > 1:
+            raise TerminalError(f"{command}: target '{target}' is not a directory")
+        parent_path, name = full_path.rsplit('/', 1)
+        parent = self.lookup(parent_path or '/')[1]
+        if parent == 'not_found' or (parent is not None and not parent['is_folder']):
+            raise TerminalError(f"{command}: cannot create '{target}': No such file or directory")
+        if not valid_filename(name):
+            raise TerminalError(f"{command}: invalid name '{name}'")
+        path, source = sources[0]
+        return [(path, source, self.folder_id(parent), name, None if row == 'not_found' else row)]
+
+    def sources(self, command, paths):
+        found = []
+        for path in paths:
+            _, row = self.lookup(path)
+            if row == 'not_found':
+                self.error(f"{command}: cannot stat '{path}': No such file or directory")
+            elif row is None:
+                self.error(f"{command}: cannot {command} '{path}': it is the home folder")
+            else:
+                found.append((path, row))
+        return found
+
+@terminal_command('help', 'help')
+def help_command(term, args, stdin):
+    yield 'Available commands:\n'
+    for name in sorted(TERMINAL_COMMANDS):
+        yield f'  {TERMINAL_COMMANDS[name][1]}\n'
+    yield 'Commands can be chained with | and paths may use the wildcards * ? [...]\n'
+
+@terminal_command('echo', 'echo [text...]')
+def echo_command(term, args, stdin):
+    yield ' '.join(args) + '\n'
+
+@terminal_command('pwd', 'pwd')
+def pwd_command(term, args, stdin):
+    yield term.display(term.cwd_path) + '\n'
+
+@terminal_command('cd', 'cd [dir]')
+def cd_command(term, args, stdin):
+    path = args[0] if args else '~'
+    full_path, target = term.lookup(path)
+    if target == 'not_found' or (target is not None and not target['is_folder']):
+        raise TerminalError(f'cd: no such file or directory: {path}')
+    # Get the name of the new directory for the prompt
+    if target is None:
+        term.new_cwd = {'id': None, 'name': '~'}
     else:
-        output = f'{command}: command not found'
+        term.new_cwd = {'id': target['id'], 'name': target['filename']}
+    yield f"Changed directory to {term.new_cwd['name']}\n"
+
+def listing_line(item):
+    return f"{item['filename']}{'/' if item['is_folder'] else ''}\n"
+
+@terminal_command('ls', 'ls [-R] [path...]')
+def ls_command(term, args, stdin):
+    options, paths = parse_options('ls', args, flags='R')
+    folders = []
+    for path in paths or ['.']:
+        full_path, row = term.lookup(path)
+        if row == 'not_found':
+            term.error(f"ls: cannot access '{path}': No such file or directory")
+        elif row is not None and not row['is_folder']:
+            yield path + '\n'
+        else:
+            folders.append((path, full_path, row))
+    for index, (path, full_path, row) in enumerate(folders):
+        if options.get('R'):
+            # The whole subtree in one indexed range scan, then printed folder by folder
+            low, high = subtree_range(full_path)
+            children = {}
+            for item in term.conn.execute('SELECT filename, is_folder, path FROM files WHERE user_id = ? AND path >= ? AND path < ? '
+                                          'ORDER BY is_folder DESC, filename', (term.user_id, low, high)):
+                children.setdefault(item['path'].rsplit('/', 1)[0], []).append(item)
+            pending = [full_path]
+            while pending:
+                folder = pending.pop()
+                yield f'{term.display(folder)}:\n'
+                items = children.get(folder, [])
+                for item in items:
+                    yield listing_line(item)
+                yield '\n'
+                pending.extend(reversed([item['path'] for item in items if item['is_folder']]))
+        else:
+            if len(folders) > 1:
+                yield ('\n' if index else '') + f'{path}:\n'
+            items, _ = directory_cache.get(term.user_id, term.folder_id(row))
+            for item in items:
+                yield listing_line(item)
+
+@terminal_command('cat', 'cat [file...]')
+def cat_command(term, args, stdin):
+    if not args:
+        yield from stdin or ()
+        return
+    for path in args:
+        try:
+            _, row = term.resolve('cat', path)
+            yield from term.read_file('cat', path, row)
+        except TerminalError as e:
+            term.error(str(e))
+
+@terminal_command('head', 'head [-n lines] [file...]')
+def head_command(term, args, stdin):
+    options, paths = parse_options('head', args, valued='n')
+    count = count_option('head', options)
+    if count <= 0:
+        return
+    for number, line in enumerate(term.input_lines('head', paths, stdin), start=1):
+        yield line
+        if number >= count:
+            return
+
+@terminal_command('tail', 'tail [-n lines] [file...]')
+def tail_command(term, args, stdin):
+    options, paths = parse_options('tail', args, valued='n')
+    yield from deque(term.input_lines('tail', paths, stdin), maxlen=max(count_option('tail', options), 0))
+
+@terminal_command('wc', 'wc [-l] [-w] [-c] [file...]')
+def wc_command(term, args, stdin):
+    options, paths = parse_options('wc', args, flags='lwc')
+    lines = words = chars = 0
+    for line in term.input_lines('wc', paths, stdin):
+        lines += line.endswith('\n')
+        words += len(line.split())
+        chars += len(line)
+    counts = [(flag, value) for flag, value in (('l', lines), ('w', words), ('c', chars)) if options.get(flag)]
+    yield ' '.join(str(value) for _, value in counts or [(None, lines), (None, words), (None, chars)]) + '\n'
+
+@terminal_command('grep', 'grep [-i] [-l] [-n] [-v] pattern [path...]')
+def grep_command(term, args, stdin):
+    options, operands = parse_options('grep', args, flags='ilnv')
+    if not operands:
+        raise TerminalError('Usage: grep [-i] [-l] [-n] [-v] <pattern> [path...]')
+    try:
+        regex = re.compile(operands[0], re.IGNORECASE if options.get('i') else 0)
+    except re.error as e:
+        raise TerminalError(f'grep: invalid pattern: {e}')
+    invert = bool(options.get('v'))
+    paths = operands[1:]
+
+    if not paths and stdin is not None:
+        for number, line in enumerate(iter_lines(stdin), start=1):
+            if bool(regex.search(line)) != invert:
+                if options.get('l'):
+                    yield '(standard input)\n'
+                    return
+                yield f'{number}:{line}' if options.get('n') else line
+        return
+
+    max_lines = app.config['SEARCH_TERMINAL_MAX_LINES']
+    shown = 0
+    for path in paths or ['.']:
+        full_path, target = term.resolve('grep', path)
+        if target is not None and not target['is_folder']:
+            files = [(None, target['file_path'])] # A single file prints bare lines, like grep
+        else:
+            # Folders are searched recursively; the index narrows them to files that can match
+            literal = None if invert else required_literal(operands[0])
+            files = grep_files(term.conn, term.user_id, full_path, literal)
+        for shown_path, file_path in files:
+            name = term.display(shown_path) if shown_path else path
+            for number, line in grep_file(file_path, regex, invert):
+                if options.get('l'):
+                    yield name + '\n'
+                    shown += 1
+                    break
+                prefix = (f'{name}:' if shown_path or len(paths) > 1 else '') + (f'{number}:' if shown_path or options.get('n') else '')
+                yield f'{prefix}{line}\n'
+                shown += 1
+                if shown >= max_lines:
+                    break
+            if shown >= max_lines:
+                yield f'(stopped after {max_lines} lines)\n'
+                return
+
+@terminal_command('find', 'find [dir] [-name pattern] [-type f|d]')
+def find_command(term, args, stdin):
+    # -name matches whole names, exactly or as a glob; ranked fuzzy matching is left to /api/search
+    name = kind = None
+    paths = []
+    args = iter(args)
+    for arg in args:
+        if arg in ('-name', '-type'):
+            value = next(args, None)
+            if value is None:
+                raise TerminalError(f'find: missing argument to {arg}')
+            if arg == '-name':
+                name = value
+            elif value in ('f', 'd'):
+                kind = value
+            else:
+                raise TerminalError(f'find: unknown argument to -type: {value}')
+        else:
+            paths.append(arg)
+    max_lines = app.config['SEARCH_TERMINAL_MAX_LINES']
+    for path in paths or ['.']:
+        folder_path, folder = term.resolve('find', path)
+        if folder is not None and not folder['is_folder']:
+            raise TerminalError(f'find: {path}: Not a directory')
+        low, high = subtree_range(folder_path)
+        query = 'SELECT path, is_folder FROM files WHERE user_id = ? AND path >= ? AND path < ?'
+        params = [term.user_id, low, high]
+        if name and any(c in GLOB_CHARS for c in name):
+            query += ' AND filename GLOB ?'
+            params.append(name.replace('[!', '[^'))
+        elif name:
+            query += ' AND filename = ?'
+            params.append(name)
+        if kind:
+            query += ' AND is_folder = ?'
+            params.append(kind == 'd')
+        for row in term.conn.execute(query + ' ORDER BY path LIMIT ?', (*params, max_lines)):
+            yield f"{term.display(row['path'])}{'/' if row['is_folder'] else ''}\n"
+
+def human_size(size):
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            return f'{size:.1f}{unit}' if unit and size < 10 else f'{size:.0f}{unit}'
+        size /= 1024
+
+@terminal_command('du', 'du [-s] [-h] [path...]')
+def du_command(term, args, stdin):
+    options, paths = parse_options('du', args, flags='sh')
+    show = human_size if options.get('h') else lambda size: str(-(-size // 1024)) # 1K blocks, rounded up
+    for path in paths or ['.']:
+        full_path, row = term.resolve('du', path)
+        if row is not None and not row['is_folder']:
+            size = term.conn.execute('SELECT size FROM blobs WHERE hash = ?', (row['blob_hash'],)).fetchone() if row['blob_hash'] else None
+            yield f"{show(size['size'] if size else os.path.getsize(row['file_path']))}\t{path}\n"
+            continue
+        # Sizes for the whole subtree in one query, then summed up into every ancestor folder
+        low, high = subtree_range(full_path)
+        totals = {full_path: 0}
+        for item in term.conn.execute(
+                'SELECT f.path, f.is_folder, f.file_path, f.blob_hash, b.size FROM files f LEFT JOIN blobs b ON b.hash = f.blob_hash '
+                'WHERE f.user_id = ? AND f.path >= ? AND f.path < ?', (term.user_id, low, high)):
+            if item['is_folder']:
+                totals.setdefault(item['path'], 0)
+                continue
+            size = item['size']
+            if size is None:
+                try:
+                    size = os.path.getsize(item['file_path']) if item['file_path'] else 0
+                except OSError:
+                    size = 0
+            folder = item['path'].rsplit('/', 1)[0]
+            while True:
+                totals[folder] = totals.get(folder, 0) + size
+                if folder == full_path:
+                    break
+                folder = folder.rsplit('/', 1)[0]
+        # Deepest folders first, like du
+        for folder in ([full_path] if options.get('s') else sorted(totals, key=lambda p: (-p.count('/'), p))):
+            yield f'{show(totals[folder])}\t{term.display(folder)}\n'
+
+@terminal_command('mkdir', 'mkdir [-p] dir...')
+def mkdir_command(term, args, stdin):
+    options, paths = parse_options('mkdir', args, flags='p')
+    if not paths:
+        raise TerminalError('mkdir: missing operand')
+    for path in paths:
+        full_path = normalize_path(term.cwd_path, path)
+        if not full_path:
+            term.error(f"mkdir: cannot create directory '{path}': File exists")
+            continue
+        parts = full_path.split('/')[1:]
+        parent_id, current = None, ''
+        for depth, part in enumerate(parts):
+            current += '/' + part
+            _, row = term.lookup(current)
+            last = depth == len(parts) - 1
+            if row != 'not_found':
+                if not row['is_folder'] or (last and not options.get('p')):
+                    term.error(f"mkdir: cannot create directory '{path}': File exists")
+                    break
+                parent_id = row['id']
+                continue
+            if not last and not options.get('p'):
+                term.error(f"mkdir: cannot create directory '{path}': No such file or directory")
+                break
+            if not valid_filename(part):
+                term.error(f"mkdir: cannot create directory '{path}': Invalid name")
+                break
+            term.touched_folders.add(parent_id)
+            parent_id = term.write(lambda conn: conn.execute(
+                'INSERT INTO files (user_id, parent_id, filename, is_folder, path) VALUES (?, ?, ?, ?, ?)',
+                (term.user_id, parent_id, part, True, child_path(conn, term.user_id, parent_id, part))).lastrowid)
+
+def replace_target(conn, term, replaced):
+    """Deletes the file an mv/cp is about to overwrite."""
+    folder_ids, file_ids = delete_item(conn, term.user_id, replaced['id'])
+    term.touched_folders.update(folder_ids)
+    term.touched_folders.add(replaced['parent_id'])
+    thumbnail_cache.invalidate(*file_ids)
+    term.deleted = True
+
+@terminal_command('mv', 'mv source... dest')
+def mv_command(term, args, stdin):
+    _, paths = parse_options('mv', args)
+    if len(paths) < 2:
+        raise TerminalError('mv: missing destination file operand')
+    for path, source, parent_id, name, replaced in term.destination('mv', paths[-1], term.sources('mv', paths[:-1])):
+        if replaced is not None and (replaced['is_folder'] or replaced['id'] == source['id']):
+            term.error(f"mv: cannot overwrite '{paths[-1]}'")
+            continue
 
-    conn.close()
-    return jsonify({'output': output, 'new_cwd': new_cwd})
+        def move(conn):
+            item = conn.execute('SELECT * FROM files WHERE id = ?', (source['id'],)).fetchone()
+            if replaced is not None:
+                replace_target(conn, term, replaced)
+            relocate_item(conn, term.user_id, item, parent_id, name)
+        try:
+            term.write(move)
+        except InvalidMove:
+            term.error(f"mv: cannot move '{path}' into itself")
+            continue
+        term.touched_folders.update((source['parent_id'], parent_id))
+
+@terminal_command('cp', 'cp [-r] source... dest')
+def cp_command(term, args, stdin):
+    options, paths = parse_options('cp', args, flags='rR')
+    if len(paths) < 2:
+        raise TerminalError('cp: missing destination file operand')
+    for path, source, parent_id, name, replaced in term.destination('cp', paths[-1], term.sources('cp', paths[:-1])):
+        if source['is_folder'] and not (options.get('r') or options.get('R')):
+            term.error(f"cp: -r not specified; omitting directory '{path}'")
+            continue
+        if replaced is not None and (replaced['is_folder'] or replaced['id'] == source['id']):
+            term.error(f"cp: cannot overwrite '{paths[-1]}'")
+            continue
+
+        def copy_item(conn):
+            if replaced is not None:
+                replace_target(conn, term, replaced)
+            if source['is_folder']:
+                copy_folder_item(conn, term.user_id, source, parent_id, name)
+            else:
+                copy_file_item(conn, term.user_id, source, parent_id, name)
+        try:
+            term.write(copy_item)
+        except InvalidMove:
+            term.error(f"cp: cannot copy '{path}' into itself")
+            continue
+        term.touched_folders.add(parent_id)
+
+@terminal_command('rm', 'rm [-r] [-f] path...')
+def rm_command(term, args, stdin):
+    options, paths = parse_options('rm', args, flags='rRf')
+    if not paths and not options.get('f'):
+        raise TerminalError('rm: missing operand')
+    for path in paths:
+        _, row = term.lookup(path)
+        if row == 'not_found':
+            if not options.get('f'):
+                term.error(f"rm: cannot remove '{path}': No such file or directory")
+        elif row is None:
+            term.error("rm: refusing to remove the home folder")
+        elif row['is_folder'] and not (options.get('r') or options.get('R')):
+            term.error(f"rm: cannot remove '{path}': Is a directory")
+        else:
+            folder_ids, file_ids = term.write(lambda conn: delete_item(conn, term.user_id, row['id']))
+            term.touched_folders.update(folder_ids)
+            term.touched_folders.add(row['parent_id'])
+            thumbnail_cache.invalidate(*file_ids)
+            term.deleted = True
+
+def coalesce_output(chunks):
+    """Joins small output chunks, sending once TERMINAL_FLUSH_BYTES are buffered or TERMINAL_FLUSH_INTERVAL has passed."""
+    buffer, size, sent_at = [], 0, time.monotonic()
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= app.config['TERMINAL_FLUSH_BYTES'] or time.monotonic() - sent_at >= app.config['TERMINAL_FLUSH_INTERVAL']:
+                yield ''.join(buffer)
+                buffer, size, sent_at = [], 0, time.monotonic()
+    except Exception:
+        if buffer:
+            yield ''.join(buffer) # Output produced before a failure still reaches the client
+        raise
+    if buffer:
+        yield ''.join(buffer)
+
+@app.route('/api/terminal/execute', methods=['POST'])
+@login_required
+def execute_command():
+    """Runs a command line in cwd_id.
+
+    Clients accepting application/x-ndjson get the output as it is produced: {"output": text} lines,
+    then {"new_cwd": {...}}. Otherwise the reply is one {output, new_cwd} object.
+    """
+    data = request.get_json() or {}
+    term = TerminalSession(session['user_id'], data.get('cwd_id'))
+    output = term.run(data.get('command', ''))
+
+    if request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        def generate():
+            try:
+                for chunk in coalesce_output(output):
+                    yield json.dumps({'output': chunk}) + '\n'
+            except Exception as e:
+                # The 200 is already sent, so a failure can only be reported in-band
+                traceback.print_exc()
+                yield json.dumps({'error': f'Command failed: {e}'}) + '\n'
+                return
+            yield json.dumps({'new_cwd': term.new_cwd}) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    return jsonify({'output': ''.join(output).rstrip('\n'), 'new_cwd': term.new_cwd})
 
 # --- Settings API Routes ---
+def if_match_settings_version(user_id):
+    """The settings version named by an If-Match header: None without one, -1 if it names none of ours."""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = f'{user_id}-'
+    for etag in request.if_match.as_set():
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit():
+            return int(etag[len(prefix):])
+    return -1
+
+def save_settings(user_id, change):
+    """Stores change(current settings), honouring If-Match, and answers with the new version as ETag."""
+    try:
+        settings, version = write_settings(user_id, lambda current: clean_settings(change(current)),
+                                           expected_version=if_match_settings_version(user_id))
+    except SettingsConflict as e:
+        return jsonify({'error': 'Settings were changed by someone else', 'version': e.args[0]}), 412
+    except PatchTestFailed as e:
+        return jsonify({'error': f'Patch test failed at {e.args[0]}'}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = jsonify({'message': 'Settings updated successfully', 'version': version})
+    response.set_etag(settings_etag(user_id, version))
+    return response
+
 @app.route('/api/settings', methods=['GET'])
 @login_required
 def get_settings():
     user_id = session['user_id']
-    conn = get_db_connection()
-    settings_json = conn.execute('SELECT settings FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    if settings_json and settings_json['settings']:
-        return jsonify(json.loads(settings_json['settings']))
-    return jsonify({})
+    settings, version = settings_cache.get(user_id)
+
+    response = jsonify(settings)
+    response.set_etag(settings_etag(user_id, version))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/settings', methods=['PUT'])
 @login_required
 def update_settings():
-    user_id = session['user_id']
-    new_settings = request.get_json()
-
-    conn = get_db_connection()
+    """Merges the given top-level keys into the user's settings. Send If-Match to only apply on an unchanged version."""
+    new_settings = request.get_json(silent=True)
+    if not isinstance(new_settings, dict):
+        return jsonify({'error': 'Settings must be an object'}), 400
+    return save_settings(session['user_id'], lambda current: {**current, **new_settings})
 
-    # Get current settings
-    user = conn.execute('SELECT settings FROM users WHERE id = ?', (user_id,)).fetchone()
-    current_settings = json.loads(user['settings']) if user and user['settings'] else {}
-
-    # Merge new settings into current settings
-    current_settings.update(new_settings)
-
-    # Save merged settings
-    conn.execute('UPDATE users SET settings = ? WHERE id = ?', (json.dumps(current_settings), user_id))
-    conn.commit()
-    conn.close()
+@app.route('/api/settings', methods=['PATCH'])
+@login_required
+def patch_settings():
+    """Applies a JSON Patch (application/json-patch+json) or a JSON merge patch to the user's settings.
 
-    return jsonify({'message': 'Settings updated successfully'})
+    Patches only touch the keys they name, so concurrent editors don't lose each other's changes;
+    If-Match and 'test' operations cover the cases where a change depends on what was read.
+    """
+    patch = request.get_json(silent=True)
+    if request.mimetype == 'application/json-patch+json' or isinstance(patch, list):
+        return save_settings(session['user_id'], lambda current: apply_json_patch(current, patch))
+    if not isinstance(patch, dict):
+        return jsonify({'error': 'Expected a JSON patch or merge patch'}), 400
+    return save_settings(session['user_id'], lambda current: merge_patch(current, patch))
 
 
 # --- Browser API Routes ---
@@ -491,168 +3342,744 @@ def start_event_loop_thread():
     t.daemon = True
     t.start()
 
-async def launch_playwright():
-    global playwright
-    playwright = await async_playwright().start()
+# The DOM revision of a page counts mutations seen since its current document finished parsing;
+# it restarts at 0 on every main-frame navigation. Reloads and back/forward keep the URL, so main-frame
+# navigations are counted too. Together with the URL they tell /view whether a previously rewritten
+# copy of the page is still what the browser shows, without asking Chromium.
+dom_revisions = {} # page -> revision
+page_navigations = {} # page -> main-frame navigations so far
+
+DOM_REVISION_SCRIPT = """
+(() => {
+    if (window !== window.top) return;
+    let pending = false;
+    const report = () => { pending = false; window.__webosDomChanged(); };
+    document.addEventListener('DOMContentLoaded', () => {
+        new MutationObserver(() => {
+            if (!pending) { pending = true; setTimeout(report, 100); }
+        }).observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+    });
+})();
+"""
+
+def on_dom_changed(source):
+    page = source['page']
+    if page in dom_revisions and source['frame'] == page.main_frame:
+        dom_revisions[page] += 1
+
+def track_dom_revisions(page):
+    dom_revisions[page] = 0
+    page_navigations[page] = 0
+    def on_navigated(frame):
+        if frame == page.main_frame:
+            dom_revisions[page] = 0
+            page_navigations[page] += 1
+    def on_close(_):
+        dom_revisions.pop(page, None)
+        page_navigations.pop(page, None)
+    page.on('framenavigated', on_navigated)
+    page.on('close', on_close)
+
+class RenderedPageCache:
+    """Rewritten /view HTML keyed by (session, page, URL, navigation, DOM revision), evicted LRU past
+    RENDER_CACHE_MAX_BYTES and dropped after RENDER_CACHE_TTL seconds."""
+    def __init__(self):
+        self._entries = OrderedDict() # key -> (html, size, stored_at)
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[2] < app.config['RENDER_CACHE_TTL']:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, html):
+        size = sys.getsizeof(html)
+        if size > app.config['RENDER_CACHE_MAX_BYTES']:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (html, size, time.monotonic())
+            self._total += size
+            while self._total > app.config['RENDER_CACHE_MAX_BYTES']:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._total -= self._entries.pop(key)[1]
+
+    def invalidate(self, session_id, page_id=None):
+        """Forgets a closed page, or every page of a closed session."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == session_id and page_id in (None, k[1])]:
+                self._drop(key)
+
+rendered_page_cache = RenderedPageCache()
+
+# Subresource types whose bodies are kept when Chromium loads them, so /proxy can hand the iframe
+# the same bytes instead of downloading them a second time. Media is left out: it is usually
+# fetched in ranges and is too large to hold in memory.
+CAPTURED_RESOURCE_TYPES = {'stylesheet', 'script', 'image', 'font'}
+# Headers kept with a captured body; Playwright returns bodies already decoded, so no Content-Encoding
+CAPTURED_HEADERS = ('content-type', 'cache-control', 'etag', 'last-modified', 'expires')
+
+class CapturedAssets:
+    """Response bodies Chromium received, per browser context, under one LRU byte budget
+    (CAPTURED_ASSETS_MAX_BYTES). Filled on the Playwright loop, read by the proxy from any thread."""
+    def __init__(self):
+        self._entries = OrderedDict() # (context, url) -> {'headers', 'body'}
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, context, urls, headers, body):
+        asset = {'headers': {name: headers[name] for name in CAPTURED_HEADERS if name in headers}, 'body': body}
+        with self._lock:
+            for url in urls:
+                previous = self._entries.pop((context, url), None)
+                if previous:
+                    self._total -= len(previous['body'])
+                self._entries[(context, url)] = asset
+                self._total += len(body)
+            while self._total > app.config['CAPTURED_ASSETS_MAX_BYTES'] and self._entries:
+                self._total -= len(self._entries.popitem(last=False)[1]['body'])
+
+    def get(self, context, url):
+        with self._lock:
+            asset = self._entries.get((context, url))
+            if asset is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((context, url))
+            self.hits += 1
+            return asset
+
+    def drop(self, context):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] is context]:
+                self._total -= len(self._entries.pop(key)['body'])
+
+captured_assets = CapturedAssets()
+
+def capture_responses(context):
+    async def on_response(response):
+        request = response.request
+        if request.method != 'GET' or response.status != 200 or request.resource_type not in CAPTURED_RESOURCE_TYPES:
+            return
+        headers = response.headers
+        try:
+            if int(headers.get('content-length') or 0) > app.config['CAPTURED_ASSET_MAX_OBJECT']:
+                return
+            body = await response.body()
+        except Exception:
+            return # Page navigated away or the body was evicted from Chromium's buffer
+        if len(body) > app.config['CAPTURED_ASSET_MAX_OBJECT']:
+            return
+        # Pages reference the URL before redirects, so file the body under every hop
+        urls = [response.url]
+        while request.redirected_from:
+            request = request.redirected_from
+            urls.append(request.url)
+        captured_assets.put(context, urls, headers, body)
+    context.on('response', on_response)
+
+def captured_asset(session_id, url):
+    session_data = browser_sessions.get(session_id)
+    return captured_assets.get(session_data['context'], url) if session_data else None
+
+# Sessions are saved to the database (storage state plus open tab URLs) so they survive restarts,
+# idle reaping and LRU reclamation, and so any app worker on the same database can pick them up.
+def load_browser_state(user_id):
+    """Returns (storage state dict or None, [(page_id, url)] in tab order)."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT storage_state FROM browser_state WHERE user_id = ?', (user_id,)).fetchone()
+    pages = conn.execute('SELECT page_id, url FROM browser_pages WHERE user_id = ? ORDER BY position',
+                         (user_id,)).fetchall()
+    conn.close()
+    return (json.loads(row['storage_state']) if row else None), [(p['page_id'], p['url']) for p in pages]
 
-def start_playwright():
-    future = asyncio.run_coroutine_threadsafe(launch_playwright(), loop)
-    future.result()
+def save_browser_state(user_id, storage_state, pages):
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('INSERT OR REPLACE INTO browser_state (user_id, storage_state, updated_at) VALUES (?, ?, ?)',
+                     (user_id, storage_state, time.time()))
+        conn.execute('DELETE FROM browser_pages WHERE user_id = ?', (user_id,))
+        conn.executemany('INSERT INTO browser_pages (user_id, page_id, url, position) VALUES (?, ?, ?, ?)',
+                         [(user_id, page_id, url, position) for page_id, url, position in pages])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-@app.route('/api/browser', methods=['POST'])
-@login_required
-def browser_new_session():
-    user_id = session['user_id']
-    session_id = str(user_id)
+def session_page_url(session_data, page_id):
+    """The page's URL, or for a tab not restored yet, the URL it will open."""
+    return session_data['restore'].get(page_id) or session_data['pages'][page_id].url
+
+def watch_session_page(session_data, page):
+    track_dom_revisions(page)
+    def on_navigated(frame):
+        if frame == page.main_frame:
+            session_data['dirty'] = True
+    page.on('framenavigated', on_navigated)
+
+async def persist_browser_session(session_data, keep_pages=True):
+    storage_state = await session_data['context'].storage_state()
+    pages = []
+    if keep_pages:
+        for position, page_id in enumerate(session_data['pages']):
+            url = session_page_url(session_data, page_id)
+            if url.startswith(('http://', 'https://')):
+                pages.append((page_id, url, position))
+    session_data['dirty'] = False
+    session_data['saved_at'] = time.monotonic()
+    await asyncio.get_running_loop().run_in_executor(
+        None, save_browser_state, session_data['user_id'], json.dumps(storage_state), pages)
+
+class BrowserPool:
+    """Shares a few Chromium processes between all users, one isolated BrowserContext per session.
+
+    Keeps BROWSER_PREWARM_CONTEXTS contexts (each with a blank page) ready so a new session
+    starts without waiting for Chromium, closes sessions idle for BROWSER_IDLE_TIMEOUT, and
+    reclaims the least recently used session once BROWSER_MAX_CONTEXTS are open. Sessions with
+    saved state are restored lazily: every tab gets a blank page right away, but only loads its
+    URL when it is first viewed.
+    All methods run on the Playwright event loop thread.
+    """
+    def __init__(self):
+        self.browsers = []
+        self.spare = [] # (browser, context, page) ready to hand out
+        self._refilling = False
+
+    async def start(self):
+        for _ in range(app.config['BROWSER_PROCESSES']):
+            self.browsers.append(await playwright.chromium.launch())
+        await self._refill()
+        asyncio.get_running_loop().create_task(self._reap_idle_forever())
+        asyncio.get_running_loop().create_task(self._persist_forever())
+
+    def _least_loaded_browser(self):
+        load = {id(b): 0 for b in self.browsers}
+        for data in list(browser_sessions.values()) + [{'browser': b} for b, _, _ in self.spare]:
+            if id(data['browser']) in load:
+                load[id(data['browser'])] += 1
+        return min(self.browsers, key=lambda b: load[id(b)])
+
+    async def _replace_dead_browsers(self):
+        for index, browser in enumerate(self.browsers):
+            if not browser.is_connected():
+                self.browsers[index] = await playwright.chromium.launch()
+        self.spare = [entry for entry in self.spare if entry[0].is_connected()]
+
+    async def _new_context(self, storage_state=None):
+        await self._replace_dead_browsers()
+        browser = self._least_loaded_browser()
+        context = await browser.new_context(storage_state=storage_state)
+        await context.expose_binding('__webosDomChanged', on_dom_changed)
+        await context.add_init_script(DOM_REVISION_SCRIPT)
+        capture_responses(context)
+        page = await context.new_page()
+        return browser, context, page
 
-    if session_id in browser_sessions:
-        # If session exists, just return the existing info
-        first_page_id = next(iter(browser_sessions[session_id]['pages']))
-        return jsonify({'session_id': session_id, 'page_id': first_page_id, 'message': 'Session already exists.'})
+    async def _refill(self):
+        if self._refilling:
+            return
+        self._refilling = True
+        try:
+            while len(self.spare) < app.config['BROWSER_PREWARM_CONTEXTS']:
+                self.spare.append(await self._new_context())
+        except Exception as e:
+            print(f"Could not pre-warm browser context: {e}")
+        finally:
+            self._refilling = False
+
+    async def open_session(self, session_id, user_id):
+        """Creates the session, restoring the user's saved state if there is any.
+
+        A user without saved state gets a pre-warmed context when one is ready; saved cookies and
+        localStorage need a context created with them. Returns the session data.
+        """
+        while len(browser_sessions) >= app.config['BROWSER_MAX_CONTEXTS']:
+            oldest = min(browser_sessions, key=lambda sid: browser_sessions[sid]['last_used'])
+            await self.close_session(oldest)
+
+        storage_state, saved_pages = await asyncio.get_running_loop().run_in_executor(None, load_browser_state, user_id)
+        if storage_state:
+            browser, context, page = await self._new_context(storage_state)
+        else:
+            while self.spare and not self.spare[0][0].is_connected():
+                self.spare.pop(0)
+            browser, context, page = self.spare.pop(0) if self.spare else await self._new_context()
+            asyncio.get_running_loop().create_task(self._refill())
 
-    async def _create_session():
-        browser = await playwright.chromium.launch()
-        context = await browser.new_context()
-        page = await context.new_page()
-        page_id = str(uuid.uuid4())
-        browser_sessions[session_id] = {
+        now = time.monotonic()
+        session_data = {
             'browser': browser,
             'context': context,
-            'pages': {page_id: page}
+            'pages': {},
+            'restore': {}, # page_id -> URL to load when the tab is first viewed
+            'user_id': user_id,
+            'last_used': now,
+            'saved_at': now,
+            'dirty': False
         }
-        return page_id
-
-    future = asyncio.run_coroutine_threadsafe(_create_session(), loop)
-    page_id = future.result()
-    return jsonify({'session_id': session_id, 'page_id': page_id})
-
-@app.route('/api/browser/<session_id>', methods=['DELETE'])
-@login_required
-def browser_close_session(session_id):
-    if session_id in browser_sessions:
-        async def _close_session():
-            session_data = browser_sessions.pop(session_id)
-            await session_data['browser'].close() # Closing the browser closes all contexts and pages
+        for page_id, url in saved_pages or [(str(uuid.uuid4()), None)]:
+            if session_data['pages']:
+                page = await context.new_page()
+            session_data['pages'][page_id] = page
+            watch_session_page(session_data, page)
+            if url:
+                session_data['restore'][page_id] = url
+        browser_sessions[session_id] = session_data
+        return session_data
+
+    async def close_session(self, session_id, keep_pages=True):
+        """Saves and closes a session. keep_pages=False forgets its tabs (the user closed the browser)."""
+        session_data = browser_sessions.pop(session_id, None)
+        rendered_page_cache.invalidate(session_id)
+        if session_data:
+            captured_assets.drop(session_data['context'])
+            try:
+                await persist_browser_session(session_data, keep_pages)
+            except Exception as e:
+                print(f"Error saving browser session {session_id}: {e}")
+            try:
+                await session_data['context'].close() # Closes its pages; the browser stays up for others
+            except Exception as e:
+                print(f"Error closing browser session {session_id}: {e}")
+
+    async def _reap_idle_forever(self):
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.monotonic() - app.config['BROWSER_IDLE_TIMEOUT']
+            for session_id in [sid for sid, data in browser_sessions.items() if data['last_used'] < cutoff]:
+                await self.close_session(session_id)
+
+    async def _persist_forever(self):
+        # Cookies can change without a navigation, so any session used since its last save is saved again
+        while True:
+            await asyncio.sleep(app.config['BROWSER_PERSIST_INTERVAL'])
+            for session_data in list(browser_sessions.values()):
+                if session_data['dirty'] or session_data['last_used'] > session_data['saved_at']:
+                    try:
+                        await persist_browser_session(session_data)
+                    except Exception as e:
+                        print(f"Error saving browser session for user {session_data['user_id']}: {e}")
 
-        future = asyncio.run_coroutine_threadsafe(_close_session(), loop)
-        future.result()
-        return jsonify({'message': 'Browser session closed'})
-    return jsonify({'error': 'Session not found'}), 404
+    async def stop(self):
+        for session_id in list(browser_sessions):
+            await self.close_session(session_id)
+        for browser in self.browsers:
+            await browser.close()
 
-@app.route('/api/browser/<session_id>/pages', methods=['POST'])
-@login_required
-def browser_new_page(session_id):
-    if session_id not in browser_sessions:
-        return jsonify({'error': 'Session not found'}), 404
+browser_pool = BrowserPool()
 
-    async def _create_page():
-        context = browser_sessions[session_id]['context']
-        page = await context.new_page()
-        page_id = str(uuid.uuid4())
-        browser_sessions[session_id]['pages'][page_id] = page
-        return page_id
+def touch_browser_session(session_id):
+    """Marks a session as used now, so idle eviction and LRU reclamation leave it alone."""
+    if session_id in browser_sessions:
+        browser_sessions[session_id]['last_used'] = time.monotonic()
 
-    future = asyncio.run_coroutine_threadsafe(_create_page(), loop)
-    page_id = future.result()
-    return jsonify({'page_id': page_id})
+async def restore_browser_page(session_id, page_id, page):
+    """Loads a restored tab's saved URL the first time the tab is shown."""
+    session_data = browser_sessions.get(session_id)
+    url = session_data['restore'].pop(page_id, None) if session_data else None
+    if url:
+        report, _ = await run_navigation(page, url, session_data['user_id'], None)
+        if 'error' in report:
+            print(f"Could not restore {url}: {report['error']}")
 
-@app.route('/api/browser/<session_id>/pages/<page_id>', methods=['DELETE'])
-@login_required
-def browser_close_page(session_id, page_id):
-    if session_id not in browser_sessions or page_id not in browser_sessions[session_id]['pages']:
-        return jsonify({'error': 'Session or page not found'}), 404
-
-    async def _close_page():
-        page = browser_sessions[session_id]['pages'].pop(page_id)
-        await page.close()
+async def launch_playwright():
+    global playwright
+    playwright = await async_playwright().start()
+    await browser_pool.start()
 
-    future = asyncio.run_coroutine_threadsafe(_close_page(), loop)
+def start_playwright():
+    future = asyncio.run_coroutine_threadsafe(launch_playwright(), loop)
     future.result()
 
-    # Optional: close the entire browser if the last tab is closed
-    if not browser_sessions[session_id]['pages']:
-        return browser_close_session(session_id)
+# Each browser endpoint is an async handler returning (body, status): a dict is sent as JSON,
+# a str as HTML. Under the threaded WSGI server the Flask routes below run them on the Playwright
+# loop thread and wait; in ASGI mode (--asgi) asgi_app awaits them on the server's own event loop,
+# so a slow navigation doesn't hold a worker thread.
+def get_browser_page(session_id, page_id):
+    if session_id not in browser_sessions or page_id not in browser_sessions[session_id]['pages']:
+        return None
+    touch_browser_session(session_id)
+    return browser_sessions[session_id]['pages'][page_id]
 
-    return jsonify({'message': 'Page closed'})
+def navigation_timeout(requested=None):
+    """Per-request navigation timeout in ms, capped at BROWSER_NAVIGATION_TIMEOUT."""
+    limit = app.config['BROWSER_NAVIGATION_TIMEOUT']
+    try:
+        return min(max(int(requested), 1), limit) if requested is not None else limit
+    except (TypeError, ValueError):
+        return limit
+
+# Navigation policies decide how a navigation is run: when it counts as done, which subresources Chromium may fetch, and how
+# many bytes a page may pull in. Users set defaults under the 'browser' key of /api/settings, and a
+# navigate request can override any of them for itself.
+NAVIGATION_READINESS = ('commit', 'domcontentloaded', 'load', 'networkidle')
+BLOCKABLE_RESOURCE_TYPES = {'image', 'media', 'font', 'stylesheet', 'script', 'xhr', 'fetch', 'websocket',
+                            'eventsource', 'manifest', 'texttrack', 'other'}
+
+def default_navigation_policy():
+    return {'wait_until': 'domcontentloaded', 'timeout': app.config['BROWSER_NAVIGATION_TIMEOUT'],
+            'block_resource_types': [], 'block_domains': [], 'max_page_bytes': 0}
+
+def validate_navigation_policy(options):
+    """Returns (the recognised policy fields of options, cleaned up, or None; an error message or None)."""
+    policy = {}
+    if 'wait_until' in options:
+        if options['wait_until'] not in NAVIGATION_READINESS:
+            return None, f"wait_until must be one of: {', '.join(NAVIGATION_READINESS)}"
+        policy['wait_until'] = options['wait_until']
+    if 'timeout' in options:
+        policy['timeout'] = navigation_timeout(options['timeout'])
+    for key in ('block_resource_types', 'block_domains'):
+        if key in options:
+            values = options[key]
+            if isinstance(values, str): # Query strings pass lists comma-separated
+                values = [v for v in values.split(',') if v]
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                return None, f'{key} must be a list of strings'
+            policy[key] = sorted({v.strip().lower().lstrip('.') for v in values if v.strip()})
+    if set(policy.get('block_resource_types', ())) - BLOCKABLE_RESOURCE_TYPES:
+        return None, f"block_resource_types may contain: {', '.join(sorted(BLOCKABLE_RESOURCE_TYPES))}"
+    if 'max_page_bytes' in options:
+        try:
+            policy['max_page_bytes'] = max(int(options['max_page_bytes']), 0)
+        except (TypeError, ValueError):
+            return None, 'max_page_bytes must be a number of bytes (0 for no limit)'
+    return policy, None
 
-@app.route('/api/browser/<session_id>/pages/<page_id>/navigate', methods=['POST'])
-@login_required
-def browser_navigate(session_id, page_id):
-    url = request.json.get('url')
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
-    if not url.startswith(('http://', 'https://')):
-        url = 'http://' + url
+def user_navigation_policy(user_id):
+    """The user's saved navigation defaults on top of the server's."""
+    policy = default_navigation_policy()
+    saved = settings_cache.get(user_id)[0].get('browser')
+    if isinstance(saved, dict):
+        policy.update(validate_navigation_policy(saved)[0] or {})
+    return policy
 
-    if session_id in browser_sessions and page_id in browser_sessions[session_id]['pages']:
-        page = browser_sessions[session_id]['pages'][page_id]
-        async def _navigate():
-            try:
-                await page.goto(url, wait_until='domcontentloaded', timeout=60000)
-                final_url = page.url
-                return {'message': f'Navigated to {url}', 'final_url': final_url}
-            except Exception as e:
-                return {'error': f'Navigation failed: {e}'}
+request_policies = {} # page -> {'policy', 'bytes', 'blocked', 'routed', 'handler'}
 
-        future = asyncio.run_coroutine_threadsafe(_navigate(), loop)
-        result = future.result()
-        return jsonify(result)
-    return jsonify({'error': 'Session or page not found'}), 404
+def domain_blocked(host, domains):
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
 
-@app.route('/api/browser/<session_id>/pages/<page_id>/proxy')
-@login_required
-def proxy_resource(session_id, page_id):
-    url = request.args.get('url')
-    if not url:
-        return "URL is required", 400
-
-    if not url.startswith(('http://', 'https://')):
-        return "Invalid URL scheme", 400
+async def apply_navigation_policy(page, policy):
+    """Makes policy govern the page's requests from now on and resets its byte and block counters.
 
+    Request routing costs a round trip to this process for every request, so the page is only
+    routed while the policy blocks something or has a byte budget.
+    """
+    state = request_policies.get(page)
+    if state is None:
+        state = request_policies[page] = {'routed': False}
+
+        async def handle_route(route):
+            request = route.request
+            current = state['policy']
+            over_budget = (current['max_page_bytes'] and state['bytes'] >= current['max_page_bytes']
+                           and not request.is_navigation_request())
+            if (over_budget or request.resource_type in current['block_resource_types']
+                    or domain_blocked(urlparse(request.url).hostname or '', current['block_domains'])):
+                state['blocked'] += 1
+                await route.abort('blockedbyclient')
+            else:
+                await route.continue_()
+
+        async def count_bytes(request):
+            if state['policy']['max_page_bytes']:
+                try:
+                    sizes = await request.sizes()
+                    state['bytes'] += sizes['responseBodySize'] + sizes['responseHeadersSize']
+                except Exception:
+                    pass # Page closed before the sizes could be read
+
+        state['handler'] = handle_route
+        page.on('requestfinished', count_bytes)
+        page.on('close', lambda _: request_policies.pop(page, None))
+
+    state.update(policy=policy, bytes=0, blocked=0)
+    wants_route = bool(policy['block_resource_types'] or policy['block_domains'] or policy['max_page_bytes'])
+    if wants_route and not state['routed']:
+        await page.route('**/*', state['handler'])
+    elif state['routed'] and not wants_route:
+        await page.unroute('**/*', state['handler'])
+    state['routed'] = wants_route
+    return state
+
+async def run_navigation(page, url, user_id, options):
+    """Navigates under the user's policy with options' overrides. Returns (report, error message)."""
+    overrides, error = validate_navigation_policy(options or {})
+    if error:
+        return None, error
+    policy = await asyncio.get_running_loop().run_in_executor(None, user_navigation_policy, user_id)
+    policy.update(overrides)
+    state = await apply_navigation_policy(page, policy)
+
+    started = time.perf_counter()
+    report = {'policy': policy}
+    try:
+        await page.goto(url, wait_until=policy['wait_until'], timeout=policy['timeout'])
+    except Exception as e:
+        report['error'] = f'Navigation failed: {e}'
+    report['timing'] = {'total_ms': round((time.perf_counter() - started) * 1000, 1)}
     try:
-        proxied_response = requests.get(url, stream=True, timeout=20, headers={'Referer': url})
-        proxied_response.raise_for_status()
+        # Milestones the document reached so far, relative to the start of its navigation
+        entry = await page.evaluate("""() => {
+            const nav = performance.getEntriesByType('navigation')[0];
+            return nav ? {ttfb: nav.responseStart, dcl: nav.domContentLoadedEventEnd, load: nav.loadEventEnd} : null;
+        }""")
+        if entry:
+            report['timing'].update({f'{name}_ms': round(value, 1) for name, value in entry.items() if value})
+    except Exception:
+        pass
+    report['blocked_requests'] = state['blocked']
+    report['bytes'] = state['bytes']
+    return report, None
+
+async def open_browser_session(user_id):
+    session_id = str(user_id)
+    response = {'session_id': session_id}
+    if session_id in browser_sessions:
+        # If session exists, just return the existing info
+        touch_browser_session(session_id)
+        session_data = browser_sessions[session_id]
+        response['message'] = 'Session already exists.'
+    else:
+        session_data = await browser_pool.open_session(session_id, user_id)
 
-        def generate():
-            for chunk in proxied_response.iter_content(chunk_size=8192):
-                yield chunk
+    # Every tab comes back in one response, so the client can rebuild its tab bar without further requests
+    response['pages'] = [{'page_id': page_id, 'url': session_page_url(session_data, page_id)}
+                         for page_id in session_data['pages']]
+    response['page_id'] = response['pages'][0]['page_id']
+    return response, 200
 
-        headers = {
-            'Content-Type': proxied_response.headers.get('Content-Type', 'application/octet-stream'),
-            'Content-Length': proxied_response.headers.get('Content-Length'),
-            'Cache-Control': 'public, max-age=86400'
-        }
-        headers = {k: v for k, v in headers.items() if v is not None}
+async def close_browser_session(session_id):
+    if session_id not in browser_sessions:
+        return {'error': 'Session not found'}, 404
+    await browser_pool.close_session(session_id, keep_pages=False)
+    return {'message': 'Browser session closed'}, 200
 
-        return Response(generate(), status=proxied_response.status_code, headers=headers)
-    except requests.exceptions.RequestException as e:
-        print(f"Error proxying {url}: {e}")
-        return "Failed to proxy resource", 502
+async def open_browser_page(session_id):
+    if session_id not in browser_sessions:
+        return {'error': 'Session not found'}, 404
+    touch_browser_session(session_id)
+    session_data = browser_sessions[session_id]
+    page = await session_data['context'].new_page()
+    watch_session_page(session_data, page)
+    page_id = str(uuid.uuid4())
+    session_data['pages'][page_id] = page
+    session_data['dirty'] = True
+    return {'page_id': page_id}, 200
+
+async def close_browser_page(session_id, page_id):
+    if not get_browser_page(session_id, page_id):
+        return {'error': 'Session or page not found'}, 404
+    session_data = browser_sessions[session_id]
+    page = session_data['pages'].pop(page_id)
+    session_data['restore'].pop(page_id, None)
+    session_data['dirty'] = True
+    rendered_page_cache.invalidate(session_id, page_id)
+    await page.close()
+
+    # Optional: close the entire session if the last tab is closed
+    if not browser_sessions[session_id]['pages']:
+        return await close_browser_session(session_id)
+    return {'message': 'Page closed'}, 200
 
-@app.route('/api/browser/<session_id>/pages/<page_id>/view')
-@login_required
-def browser_view(session_id, page_id):
-    if session_id not in browser_sessions or page_id not in browser_sessions[session_id]['pages']:
+async def navigate_browser_page(session_id, page_id, url, user_id, options=None):
+    """options may override any navigation policy field (wait_until, timeout, block_*, max_page_bytes)."""
+    if not url:
+        return {'error': 'URL is required'}, 400
+    if not url.startswith(('http://', 'https://')):
+        url = 'http://' + url
+
+    page = get_browser_page(session_id, page_id)
+    if not page:
+        return {'error': 'Session or page not found'}, 404
+    browser_sessions[session_id]['restore'].pop(page_id, None) # Superseded by this navigation
+    report, error = await run_navigation(page, url, user_id, options)
+    if error:
+        return {'error': error}, 400
+    if 'error' not in report:
+        report['message'] = f'Navigated to {url}'
+    report['final_url'] = page.url
+    return report, 200
+
+async def view_browser_page(session_id, page_id):
+    page = get_browser_page(session_id, page_id)
+    if not page:
         return "Session or page not found.", 404
+    await restore_browser_page(session_id, page_id, page)
 
-    page = browser_sessions[session_id]['pages'][page_id]
+    # Repeat views of an unchanged document (iframe reloads, back/forward) skip Chromium entirely
+    cache_key = (session_id, page_id, page.url, page_navigations.get(page), dom_revisions.get(page))
+    html = rendered_page_cache.get(cache_key)
+    if html is not None:
+        return html, 200
 
-    async def _get_content():
-        try:
-            content = await page.content()
-            current_url = page.url
-            return {'content': content, 'url': current_url}
-        except Exception as e:
-            return {'error': str(e)}
-
-    future = asyncio.run_coroutine_threadsafe(_get_content(), loop)
-    result = future.result()
+    try:
+        content = await page.content()
+        base_url = page.url
+    except Exception as e:
+        return f"Failed to get page content: {e}", 500
 
-    if 'error' in result:
-        return f"Failed to get page content: {result['error']}", 500
+    # Rewriting is CPU-bound; keep it off the event loop so other sessions aren't stalled
+    html = await asyncio.get_running_loop().run_in_executor(
+        None, rewrite_page_html, content, base_url, session_id, page_id)
+    if base_url == cache_key[2] and page_navigations.get(page) == cache_key[3]:
+        rendered_page_cache.put(cache_key, html)
+    return html, 200
 
-    content = result['content']
-    base_url = result['url']
+async def navigate_and_view_browser_page(session_id, page_id, url, user_id, options=None):
+    if not url:
+        return "URL is required", 400
+    page = get_browser_page(session_id, page_id)
+    if not page:
+        return "Session or page not found", 404
+    browser_sessions[session_id]['restore'].pop(page_id, None) # Superseded by this navigation
+    report, error = await run_navigation(page, url, user_id, options)
+    if error:
+        return error, 400
+    if 'error' in report:
+        print(f"Navigation failed in navigate_and_view: {report['error']}")
+    return await view_browser_page(session_id, page_id)
+
+def clamp_param(value, low, high, default):
+    try:
+        return min(max(int(value), low), high)
+    except (TypeError, ValueError):
+        return default
+
+async def screencast_frames(session_id, page_id, fps=None, kbps=None, width=None, height=None):
+    """Live view: yields {'frame': base64 JPEG, 'width', 'height', 'url'} as the page repaints,
+    or None as a keepalive while nothing changes.
+
+    Frames come from Chrome's screencast, which sends the next frame only once the previous one
+    is acknowledged; holding back the ack paces the stream to `fps` and to the `kbps` budget.
+    While the budget is what limits the frame rate, JPEG quality is stepped down (and back up
+    when there is room), so fast-changing pages degrade in sharpness rather than smoothness.
+    """
+    page = get_browser_page(session_id, page_id)
+    if not page:
+        return
+    await restore_browser_page(session_id, page_id, page)
+    fps = clamp_param(fps, 1, app.config['SCREENCAST_MAX_FPS'], app.config['SCREENCAST_MAX_FPS'])
+    budget = clamp_param(kbps, 100, app.config['SCREENCAST_MAX_KBPS'], app.config['SCREENCAST_MAX_KBPS']) * 1000 / 8
+    max_quality = app.config['SCREENCAST_QUALITY']
+    quality = max_quality
+    if width and height:
+        # Lay the page out for the window showing it, so frames map 1:1 onto the viewer
+        await page.set_viewport_size({'width': clamp_param(width, 200, 1920, 1280), 'height': clamp_param(height, 200, 1080, 720)})
+
+    cdp = await page.context.new_cdp_session(page)
+    frames = asyncio.Queue()
+    cdp.on('Page.screencastFrame', frames.put_nowait)
+
+    async def start():
+        while not frames.empty(): # Frames of the old encoding need no ack once it is stopped
+            frames.get_nowait()
+        await cdp.send('Page.startScreencast', {'format': 'jpeg', 'quality': quality})
+
+    await start()
+    window_started, window_bytes = time.monotonic(), 0
+    try:
+        while not page.is_closed():
+            try:
+                frame = await asyncio.wait_for(frames.get(), timeout=15)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            touch_browser_session(session_id)
+            metadata = frame.get('metadata', {})
+            yield {'frame': frame['data'], 'width': metadata.get('deviceWidth'),
+                   'height': metadata.get('deviceHeight'), 'url': page.url}
+
+            size = len(frame['data']) * 3 // 4
+            window_bytes += size
+            await asyncio.sleep(max(1 / fps, size / budget))
+
+            now = time.monotonic()
+            if now - window_started >= 1:
+                rate = window_bytes / (now - window_started)
+                window_started, window_bytes = now, 0
+                new_quality = quality
+                if rate > 0.9 * budget:
+                    new_quality = max(quality - 10, app.config['SCREENCAST_MIN_QUALITY'])
+                elif rate < 0.5 * budget:
+                    new_quality = min(quality + 10, max_quality)
+                if new_quality != quality:
+                    quality = new_quality
+                    await cdp.send('Page.stopScreencast')
+                    await start() # Restarting replaces the pending ack
+                    continue
+            await cdp.send('Page.screencastFrameAck', {'sessionId': frame['sessionId']})
+    finally:
+        try:
+            await cdp.send('Page.stopScreencast')
+            await cdp.detach()
+        except Exception:
+            pass # The page or its context is already gone
+
+async def send_browser_input(session_id, page_id, event):
+    """Replays a live view input event on the page; coordinates are viewport CSS pixels."""
+    page = get_browser_page(session_id, page_id)
+    if not page:
+        return {'error': 'Session or page not found'}, 404
+    kind = event.get('type')
+    button = event.get('button') if event.get('button') in ('left', 'middle', 'right') else 'left'
+    try:
+        x, y = float(event.get('x', 0)), float(event.get('y', 0))
+        if kind == 'move':
+            await page.mouse.move(x, y)
+        elif kind == 'down':
+            await page.mouse.move(x, y)
+            await page.mouse.down(button=button)
+        elif kind == 'up':
+            await page.mouse.move(x, y)
+            await page.mouse.up(button=button)
+        elif kind == 'wheel':
+            await page.mouse.move(x, y)
+            await page.mouse.wheel(float(event.get('deltaX', 0)), float(event.get('deltaY', 0)))
+        elif kind == 'key':
+            await page.keyboard.press(str(event['key']))
+        elif kind == 'text':
+            await page.keyboard.insert_text(str(event['text']))
+        else:
+            return {'error': 'Unknown input type'}, 400
+    except (KeyError, TypeError, ValueError):
+        return {'error': 'Invalid input event'}, 400
+    except Exception as e:
+        return {'error': f'Input failed: {e}'}, 500
+    return {'message': 'ok'}, 200
+
+def screencast_event(frame):
+    """Server-sent event for one screencast frame, or a comment line as keepalive."""
+    return f"data: {json.dumps(frame)}\n\n" if frame else ": keepalive\n\n"
+
+CSS_URL_PATTERN = re.compile(r'url\((.*?)\)')
+REWRITTEN_URL_ATTRS = {
+    'a': ('href',), 'link': ('href',), 'img': ('src', 'srcset'),
+    'script': ('src',), 'audio': ('src',), 'video': ('src', 'poster'),
+    'source': ('src', 'srcset'), 'embed': ('src',), 'iframe': ('src',),
+    'object': ('data',), 'track': ('src',),
+}
+
+def rewrite_page_html(content, base_url, session_id, page_id):
+    """Points the page's links, assets and forms at this server's navigate/proxy endpoints."""
     soup = BeautifulSoup(content, 'lxml')
 
     base_tag = soup.new_tag('base', href=base_url)
@@ -679,87 +4106,590 @@ def browser_view(session_id, page_id):
         head.append(base_tag)
         head.append(post_message_script)
 
-    def proxy_css_urls(css_text):
-        def replacer(m):
-            original_url = m.group(1).strip('\'"')
-            if original_url.startswith('data:'):
-                return f"url('{original_url}')"
-            absolute_url = urljoin(base_url, original_url)
-            proxied_url = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
-            return f"url('{proxied_url}')"
-        return re.sub(r'url\((.*?)\)', replacer, css_text)
-
-    for tag in soup.find_all(style=True):
-        tag['style'] = proxy_css_urls(tag['style'])
-
-    for style_tag in soup.find_all('style'):
-        if style_tag.string:
-            style_tag.string.replace_with(proxy_css_urls(style_tag.string))
-
-    tags_to_rewrite = {
-        'a': ['href'], 'link': ['href'], 'img': ['src', 'srcset'],
-        'script': ['src'], 'audio': ['src'], 'video': ['src', 'poster'],
-        'source': ['src', 'srcset'], 'embed': ['src'], 'iframe': ['src'],
-        'object': ['data'], 'track': ['src'],
-    }
+    proxy_prefix = f"/api/browser/{session_id}/pages/{page_id}/proxy?url="
+    navigate_prefix = f"/api/browser/{session_id}/pages/{page_id}/navigate_and_view?url="
+
+    def css_replacer(m):
+        original_url = m.group(1).strip('\'"')
+        if original_url.startswith('data:'):
+            return f"url('{original_url}')"
+        return f"url('{proxy_prefix}{quote(urljoin(base_url, original_url))}')"
+
+    # One walk over the tree handles every rewrite: inline styles, <style> blocks,
+    # URL attributes (including srcset) and form actions.
+    for tag in soup.find_all(True):
+        attrs = tag.attrs
+        if 'style' in attrs:
+            attrs['style'] = CSS_URL_PATTERN.sub(css_replacer, attrs['style'])
+
+        tag_name = tag.name
+        if tag_name == 'style':
+            if tag.string:
+                tag.string.replace_with(CSS_URL_PATTERN.sub(css_replacer, tag.string))
+            continue
+        if tag_name == 'form':
+            if 'action' in attrs:
+                attrs['action'] = navigate_prefix + quote(urljoin(base_url, attrs['action']))
+            continue
 
-    for tag_name, attrs in tags_to_rewrite.items():
-        for tag in soup.find_all(tag_name):
-            for attr in attrs:
-                if not tag.has_attr(attr): continue
+        url_attrs = REWRITTEN_URL_ATTRS.get(tag_name)
+        if not url_attrs:
+            continue
+        for attr in url_attrs:
+            val = attrs.get(attr)
+            if not val or val.startswith(('data:', 'javascript:', '#')): continue
+
+            if attr != 'srcset':
+                absolute_url = quote(urljoin(base_url, val))
+                if tag_name == 'a' or (tag_name == 'link' and attrs.get('rel') != ['stylesheet']):
+                    attrs[attr] = navigate_prefix + absolute_url
+                else:
+                    attrs[attr] = proxy_prefix + absolute_url
+            else:
+                new_srcset = []
+                for part in val.split(','):
+                    part = part.strip()
+                    if not part: continue
+                    url_part, *descriptor_part = part.split(maxsplit=1)
+                    descriptor = descriptor_part[0] if descriptor_part else ''
+                    new_srcset.append(f"{proxy_prefix}{quote(urljoin(base_url, url_part))} {descriptor}")
+                attrs[attr] = ", ".join(new_srcset)
+
+    return str(soup)
+
+def run_browser_handler(coro):
+    """Runs a browser handler on the Playwright loop from a WSGI worker thread and builds the response."""
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        body, status = future.result(app.config['BROWSER_REQUEST_TIMEOUT'])
+    except concurrent.futures.TimeoutError:
+        future.cancel() # Cancels the coroutine (and any pending navigation) on the loop
+        return jsonify({'error': 'Browser request timed out'}), 504
+    if isinstance(body, dict):
+        return jsonify(body), status
+    return body, status, {'Content-Type': 'text/html; charset=utf-8'}
 
-                val = tag[attr]
-                if not val or val.startswith('data:') or val.startswith('javascript:'): continue
-                if val.startswith('#'): continue
+@app.route('/api/browser', methods=['POST'])
+@login_required
+def browser_new_session():
+    return run_browser_handler(open_browser_session(session['user_id']))
 
-                if attr != 'srcset':
-                    absolute_url = urljoin(base_url, val)
-                    if tag_name == 'a' or (tag_name == 'link' and tag.get('rel') != ['stylesheet']):
-                        tag[attr] = f"/api/browser/{session_id}/pages/{page_id}/navigate_and_view?url={quote(absolute_url)}"
-                    else:
-                        tag[attr] = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
-                else:
-                    new_srcset = []
-                    for part in val.split(','):
-                        part = part.strip()
-                        if not part: continue
-                        url_part, *descriptor_part = part.split(maxsplit=1)
-                        descriptor = descriptor_part[0] if descriptor_part else ''
-                        absolute_url = urljoin(base_url, url_part)
-                        proxied_url = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
-                        new_srcset.append(f"{proxied_url} {descriptor}")
-                    tag[attr] = ", ".join(new_srcset)
-
-    for form in soup.find_all('form', action=True):
-        action = form['action']
-        absolute_url = urljoin(base_url, action)
-        form['action'] = f"/api/browser/{session_id}/pages/{page_id}/navigate_and_view?url={quote(absolute_url)}"
-
-    return str(soup), 200, {'Content-Type': 'text/html; charset=utf-8'}
+# POST as well, because the frontend closes sessions with navigator.sendBeacon when the window goes away
+@app.route('/api/browser/<session_id>', methods=['DELETE', 'POST'])
+@login_required
+def browser_close_session(session_id):
+    return run_browser_handler(close_browser_session(session_id))
 
-@app.route('/api/browser/<session_id>/pages/<page_id>/navigate_and_view')
+@app.route('/api/browser/<session_id>/pages', methods=['POST'])
 @login_required
-def browser_navigate_and_view(session_id, page_id):
+def browser_new_page(session_id):
+    return run_browser_handler(open_browser_page(session_id))
+
+@app.route('/api/browser/<session_id>/pages/<page_id>', methods=['DELETE'])
+@login_required
+def browser_close_page(session_id, page_id):
+    return run_browser_handler(close_browser_page(session_id, page_id))
+
+@app.route('/api/browser/<session_id>/pages/<page_id>/navigate', methods=['POST'])
+@login_required
+def browser_navigate(session_id, page_id):
+    data = request.get_json() or {}
+    return run_browser_handler(navigate_browser_page(session_id, page_id, data.get('url'), session['user_id'], data))
+
+def proxy_request_headers(url, entry, range_header=None, if_range=None):
+    """Headers for the upstream fetch: validators when a stale copy is cached, and the client's Range."""
+    headers = {'Referer': url}
+    if entry:
+        if 'etag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+    if range_header:
+        headers['Range'] = range_header
+        if if_range:
+            headers['If-Range'] = if_range
+    return headers
+
+def proxy_response_headers(upstream):
+    headers = {name.title(): upstream[name] for name in PROXY_STORED_HEADERS if name in upstream}
+    for name in ('content-length', 'content-range', 'accept-ranges'):
+        if name in upstream:
+            headers[name.title()] = upstream[name]
+    headers.setdefault('Content-Type', 'application/octet-stream')
+    headers.setdefault('Cache-Control', 'public, max-age=86400')
+    return headers
+
+def proxy_cacheable(response):
+    """Whether a full response is worth teeing into the proxy cache while it streams."""
+    return (response.status_code == 200 and freshness_lifetime(response.headers) is not None
+            and int(response.headers.get('content-length') or 0) <= app.config['PROXY_CACHE_MAX_OBJECT'])
+
+def cached_range(entry, size, range_header, if_range):
+    """(start, stop) of the single byte range to serve from a cached body, or None for all of it."""
+    if not range_header or (if_range and if_range not in (entry['headers'].get('etag'), entry['headers'].get('last-modified'))):
+        return None
+    byte_ranges = parse_range_header(range_header)
+    return byte_ranges.range_for_length(size) if byte_ranges else None
+
+@app.route('/api/browser/<session_id>/pages/<page_id>/proxy')
+@login_required
+def proxy_resource(session_id, page_id):
+    touch_browser_session(session_id)
     url = request.args.get('url')
     if not url:
         return "URL is required", 400
 
-    if session_id not in browser_sessions or page_id not in browser_sessions[session_id]['pages']:
-        return "Session or page not found", 404
+    if not url.startswith(('http://', 'https://')):
+        return "Invalid URL scheme", 400
+
+    asset = captured_asset(session_id, url)
+    if asset:
+        response = Response(asset['body'], headers=proxy_response_headers(asset['headers']))
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(asset['body']))
 
-    page = browser_sessions[session_id]['pages'][page_id]
+    entry = proxy_cache.lookup(url)
+    if entry and entry['fresh_until'] > time.time():
+        response = send_cached_proxy_entry(entry)
+        if response:
+            return response
 
-    async def _navigate():
+    range_header = request.headers.get('Range')
+    request_headers = proxy_request_headers(url, entry, range_header, request.headers.get('If-Range'))
+    try:
+        proxied_response = http_client.send(http_client.build_request('GET', url, headers=request_headers), stream=True)
+    except httpx.HTTPError as e:
+        print(f"Error proxying {url}: {e}")
+        return "Failed to proxy resource", 502
+
+    if entry and proxied_response.status_code == 304:
+        proxied_response.close()
+        proxy_cache.revalidated(url, entry, proxied_response.headers)
+        response = send_cached_proxy_entry(entry)
+        if response:
+            return response
+        return proxy_resource(session_id, page_id) # Evicted meanwhile; fetch it in full
+    if proxied_response.status_code >= 400 and proxied_response.status_code != 416:
+        proxied_response.close()
+        print(f"Error proxying {url}: HTTP {proxied_response.status_code}")
+        return "Failed to proxy resource", 502
+
+    # The body is relayed as the origin encoded it, and teed into the cache when it may be stored
+    upstream = proxied_response.headers
+    cacheable = not range_header and proxy_cacheable(proxied_response)
+
+    def generate():
+        body_file = tmp_path = None
+        received = 0
         try:
-            await page.goto(url, wait_until='domcontentloaded')
-        except Exception as e:
-            print(f"Navigation failed in navigate_and_view: {e}")
+            if cacheable:
+                body_file, tmp_path = proxy_cache.new_body_file()
+            for chunk in proxied_response.iter_raw(chunk_size=app.config['PROXY_CHUNK_SIZE']):
+                received += len(chunk)
+                if body_file and received > app.config['PROXY_CACHE_MAX_OBJECT']:
+                    body_file.close()
+                    os.remove(tmp_path)
+                    body_file = None
+                if body_file:
+                    body_file.write(chunk)
+                yield chunk
+            if body_file:
+                body_file.close()
+                body_file = None
+                proxy_cache.store(url, upstream, tmp_path)
+        except httpx.HTTPError as e:
+            print(f"Error proxying {url}: {e}")
+        finally:
+            proxied_response.close()
+            if body_file: # Client went away or the origin failed mid-body
+                body_file.close()
+                os.remove(tmp_path)
+
+    return Response(generate(), status=proxied_response.status_code, headers=proxy_response_headers(upstream))
+
+def send_cached_proxy_entry(entry):
+    """Serves a cached body (with Range support), or None if it was evicted since the lookup."""
+    headers = proxy_response_headers(entry['headers'])
+    try:
+        response = send_file(entry['path'], mimetype=headers.pop('Content-Type'), conditional=True, etag=False)
+    except FileNotFoundError:
+        return None
+    response.headers.update(headers)
+    return response
 
-    future = asyncio.run_coroutine_threadsafe(_navigate(), loop)
-    future.result()
+@app.route('/api/browser/<session_id>/pages/<page_id>/view')
+@login_required
+def browser_view(session_id, page_id):
+    return run_browser_handler(view_browser_page(session_id, page_id))
 
-    return browser_view(session_id, page_id)
+@app.route('/api/browser/<session_id>/pages/<page_id>/navigate_and_view')
+@login_required
+def browser_navigate_and_view(session_id, page_id):
+    return run_browser_handler(navigate_and_view_browser_page(
+        session_id, page_id, request.args.get('url'), session['user_id'], request.args.to_dict()))
 
+@app.route('/api/browser/<session_id>/pages/<page_id>/input', methods=['POST'])
+@login_required
+def browser_input(session_id, page_id):
+    return run_browser_handler(send_browser_input(session_id, page_id, request.get_json(silent=True) or {}))
+
+@app.route('/api/browser/<session_id>/pages/<page_id>/screencast')
+@login_required
+def browser_screencast(session_id, page_id):
+    if not get_browser_page(session_id, page_id):
+        return jsonify({'error': 'Session or page not found'}), 404
+    frames = screencast_frames(session_id, page_id, request.args.get('fps'), request.args.get('kbps'),
+                               request.args.get('width'), request.args.get('height'))
+
+    def generate():
+        # Pulls each frame from the Playwright loop; closing the response stops the screencast
+        try:
+            while True:
+                try:
+                    frame = asyncio.run_coroutine_threadsafe(frames.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    return
+                yield screencast_event(frame)
+        finally:
+            asyncio.run_coroutine_threadsafe(frames.aclose(), loop).result()
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- ASGI Serving Mode ---
+# `python3 backend/app.py --asgi` serves through hypercorn: the browser endpoints below are awaited
+# directly on the server's event loop (which also runs Playwright), with the request cancelled if the
+# client disconnects. Every other route is the regular Flask app, run on hypercorn's WSGI thread pool.
+ASGI_BROWSER_ROUTES = [
+    ('POST', r'/api/browser', lambda user_id, query, body: open_browser_session(user_id)),
+    ('DELETE', r'/api/browser/(?P<session_id>[^/]+)', lambda user_id, query, body, session_id: close_browser_session(session_id)),
+    ('POST', r'/api/browser/(?P<session_id>[^/]+)', lambda user_id, query, body, session_id: close_browser_session(session_id)),
+    ('POST', r'/api/browser/(?P<session_id>[^/]+)/pages', lambda user_id, query, body, session_id: open_browser_page(session_id)),
+    ('DELETE', r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)',
+     lambda user_id, query, body, session_id, page_id: close_browser_page(session_id, page_id)),
+    ('POST', r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/navigate',
+     lambda user_id, query, body, session_id, page_id: navigate_browser_page(session_id, page_id, body.get('url'), user_id, body)),
+    ('GET', r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/view',
+     lambda user_id, query, body, session_id, page_id: view_browser_page(session_id, page_id)),
+    ('GET', r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/navigate_and_view',
+     lambda user_id, query, body, session_id, page_id: navigate_and_view_browser_page(session_id, page_id, query.get('url'), user_id, query)),
+    ('POST', r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/input',
+     lambda user_id, query, body, session_id, page_id: send_browser_input(session_id, page_id, body)),
+]
+ASGI_BROWSER_ROUTES = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in ASGI_BROWSER_ROUTES]
+
+# Hypercorn buffers WSGI request bodies; chunked uploads keep each request at UPLOAD_CHUNK_SIZE
+wsgi_fallback = AsyncioWSGIMiddleware(app, max_body_size=1024 * 1024 * 1024)
+
+def session_user_id(scope):
+    """Loads the Flask session for an ASGI request and returns its user id (None if logged out)."""
+    environ = {
+        'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': '', 'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'), 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr,
+    }
+    for name, value in scope['headers']:
+        environ['HTTP_' + name.decode('latin-1').upper().replace('-', '_')] = value.decode('latin-1')
+    with app.request_context(environ):
+        return session.get('user_id')
+
+async def send_asgi_response(send, body, status):
+    if isinstance(body, dict):
+        payload, content_type = json.dumps(body).encode('utf-8'), b'application/json'
+    else:
+        payload, content_type = body.encode('utf-8'), b'text/html; charset=utf-8'
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(payload)).encode())]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+async def serve_browser_route(scope, receive, send, handler, params):
+    running_loop = asyncio.get_running_loop()
+    user_id = await running_loop.run_in_executor(None, session_user_id, scope)
+    if user_id is None:
+        await send_asgi_response(send, {'error': 'Authentication required'}, 401)
+        return
+
+    raw_body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        raw_body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        body = json.loads(raw_body) if raw_body else {}
+    except ValueError:
+        body = {}
+    query = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    task = asyncio.ensure_future(handler(user_id, query, body if isinstance(body, dict) else {}, **params))
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    done, _ = await asyncio.wait({task, watcher}, timeout=app.config['BROWSER_REQUEST_TIMEOUT'],
+                                 return_when=asyncio.FIRST_COMPLETED)
+    disconnected = watcher in done
+    watcher.cancel()
+    if task not in done:
+        task.cancel() # Client went away or the request timed out: stop the navigation
+        if not disconnected:
+            await send_asgi_response(send, {'error': 'Browser request timed out'}, 504)
+        return
+    body, status = task.result()
+    await send_asgi_response(send, body, status)
+
+async def asgi_lifespan(receive, send):
+    global loop
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            init_db()
+            file_reclaimer.start()
+            search_indexer.start()
+            app.session_interface.start()
+            loop = asyncio.get_running_loop() # Playwright lives on the server's loop in this mode
+            await launch_playwright()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await browser_pool.stop()
+            await playwright.stop()
+            await http_async_client.aclose()
+            password_hasher.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await asgi_lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        match = ASGI_PROXY_ROUTE.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await serve_proxy_route(scope, receive, send, **match.groupdict())
+            return
+        match = ASGI_SCREENCAST_ROUTE.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            await serve_screencast_route(scope, receive, send, **match.groupdict())
+            return
+        for method, pattern, handler in ASGI_BROWSER_ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                await serve_browser_route(scope, receive, send, handler, match.groupdict())
+                return
+    await wsgi_fallback(scope, receive, send)
+
+# The async proxy relays each asset on the event loop instead of holding a WSGI worker thread for the
+# whole download. The next chunk is only read from the origin once the client has taken the last one,
+# and fetches are capped per browser session and per origin host.
+ASGI_PROXY_ROUTE = re.compile(r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/proxy$')
+
+class ProxyLimits:
+    """Semaphores bounding concurrent upstream fetches, created per key on demand and dropped when idle."""
+    def __init__(self):
+        self._slots = {} # key -> [semaphore, holders and waiters]
+
+    @asynccontextmanager
+    async def _slot(self, key, limit):
+        if key not in self._slots:
+            self._slots[key] = [asyncio.Semaphore(limit), 0]
+        slot = self._slots[key]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._slots[key]
+
+    @asynccontextmanager
+    async def hold(self, session_id, origin):
+        async with self._slot(('session', session_id), app.config['PROXY_MAX_PER_SESSION']):
+            async with self._slot(('origin', origin), app.config['PROXY_MAX_PER_ORIGIN']):
+                yield
+
+proxy_limits = ProxyLimits()
+
+def asgi_headers(headers):
+    return [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+
+async def send_cached_proxy_entry_asgi(send, entry, range_header, if_range):
+    """Async counterpart of send_cached_proxy_entry: False if the entry was evicted since the lookup."""
+    try:
+        body_file = open(entry['path'], 'rb')
+    except FileNotFoundError:
+        return False
+    running_loop = asyncio.get_running_loop()
+    chunk_size = app.config['PROXY_CHUNK_SIZE']
+    with body_file:
+        size = os.fstat(body_file.fileno()).st_size
+        headers = proxy_response_headers(entry['headers'])
+        headers['Accept-Ranges'] = 'bytes'
+        status, (start, stop) = 200, (0, size)
+        byte_range = cached_range(entry, size, range_header, if_range)
+        if byte_range:
+            status, (start, stop) = 206, byte_range
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = stop - start
+        await send({'type': 'http.response.start', 'status': status, 'headers': asgi_headers(headers)})
+        body_file.seek(start)
+        remaining = stop - start
+        while remaining:
+            chunk = await running_loop.run_in_executor(None, body_file.read, min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+    return True
+
+async def send_captured_asset_asgi(send, asset, range_header, if_range):
+    body = asset['body']
+    headers = proxy_response_headers(asset['headers'])
+    headers['Accept-Ranges'] = 'bytes'
+    status, (start, stop) = 200, (0, len(body))
+    byte_range = cached_range(asset, len(body), range_header, if_range)
+    if byte_range:
+        status, (start, stop) = 206, byte_range
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(body)}'
+    headers['Content-Length'] = stop - start
+    await send({'type': 'http.response.start', 'status': status, 'headers': asgi_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body[start:stop]})
+
+async def stream_proxied_resource(send, session_id, url, range_header, if_range):
+    asset = captured_asset(session_id, url)
+    if asset:
+        await send_captured_asset_asgi(send, asset, range_header, if_range)
+        return
+
+    entry = proxy_cache.lookup(url)
+    if entry and entry['fresh_until'] > time.time():
+        if await send_cached_proxy_entry_asgi(send, entry, range_header, if_range):
+            return
+
+    running_loop = asyncio.get_running_loop()
+    async with proxy_limits.hold(session_id, urlparse(url).netloc):
+        request_headers = proxy_request_headers(url, entry, range_header, if_range)
+        try:
+            response = await http_async_client.send(
+                http_async_client.build_request('GET', url, headers=request_headers), stream=True)
+        except httpx.HTTPError as e:
+            print(f"Error proxying {url}: {e}")
+            await send_asgi_response(send, "Failed to proxy resource", 502)
+            return
+
+        body_file = tmp_path = None
+        try:
+            if entry and response.status_code == 304:
+                proxy_cache.revalidated(url, entry, response.headers)
+                if await send_cached_proxy_entry_asgi(send, entry, range_header, if_range):
+                    return
+                entry = None # Evicted meanwhile; fetch it in full below
+            elif response.status_code >= 400 and response.status_code != 416:
+                print(f"Error proxying {url}: HTTP {response.status_code}")
+                await send_asgi_response(send, "Failed to proxy resource", 502)
+                return
+            else:
+                if not range_header and proxy_cacheable(response):
+                    body_file, tmp_path = proxy_cache.new_body_file()
+                await send({'type': 'http.response.start', 'status': response.status_code,
+                            'headers': asgi_headers(proxy_response_headers(response.headers))})
+                received = 0
+                try:
+                    async for chunk in response.aiter_raw(app.config['PROXY_CHUNK_SIZE']):
+                        received += len(chunk)
+                        if body_file and received > app.config['PROXY_CACHE_MAX_OBJECT']:
+                            body_file.close()
+                            os.remove(tmp_path)
+                            body_file = None
+                        if body_file:
+                            await running_loop.run_in_executor(None, body_file.write, chunk)
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                except httpx.HTTPError as e:
+                    print(f"Error proxying {url}: {e}") # Headers are out; end the body where it broke
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                await send({'type': 'http.response.body', 'body': b''})
+                if body_file:
+                    body_file.close()
+                    body_file = None
+                    await running_loop.run_in_executor(None, proxy_cache.store, url, response.headers, tmp_path)
+                return
+        finally:
+            await response.aclose()
+            if body_file: # Client went away or the origin failed mid-body
+                body_file.close()
+                os.remove(tmp_path)
+    await stream_proxied_resource(send, session_id, url, range_header, None)
+
+async def serve_proxy_route(scope, receive, send, session_id, page_id):
+    user_id = await asyncio.get_running_loop().run_in_executor(None, session_user_id, scope)
+    if user_id is None:
+        await send_asgi_response(send, {'error': 'Authentication required'}, 401)
+        return
+    touch_browser_session(session_id)
+    url = dict(parse_qsl(scope['query_string'].decode('latin-1'))).get('url')
+    if not url:
+        await send_asgi_response(send, "URL is required", 400)
+        return
+    if not url.startswith(('http://', 'https://')):
+        await send_asgi_response(send, "Invalid URL scheme", 400)
+        return
+
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    task = asyncio.ensure_future(stream_proxied_resource(send, session_id, url, headers.get('range'), headers.get('if-range')))
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    watcher.cancel()
+    if task not in done:
+        task.cancel() # Client went away: stop reading from the origin
+    else:
+        task.result()
+
+ASGI_SCREENCAST_ROUTE = re.compile(r'/api/browser/(?P<session_id>[^/]+)/pages/(?P<page_id>[^/]+)/screencast$')
+
+async def serve_screencast_route(scope, receive, send, session_id, page_id):
+    user_id = await asyncio.get_running_loop().run_in_executor(None, session_user_id, scope)
+    if user_id is None:
+        await send_asgi_response(send, {'error': 'Authentication required'}, 401)
+        return
+    if not get_browser_page(session_id, page_id):
+        await send_asgi_response(send, {'error': 'Session or page not found'}, 404)
+        return
+    query = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+
+    async def stream():
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        async for frame in screencast_frames(session_id, page_id, query.get('fps'), query.get('kbps'),
+                                             query.get('width'), query.get('height')):
+            await send({'type': 'http.response.body', 'body': screencast_event(frame).encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    task = asyncio.ensure_future(stream())
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    watcher.cancel()
+    if task not in done:
+        task.cancel() # Viewer went away: stop the screencast
+    else:
+        task.result()
+
+def serve_asgi(bind='127.0.0.1:5001'):
+    config = HypercornConfig()
+    config.bind = [bind]
+    asyncio.run(hypercorn_serve(asgi_app, config))
 
 @app.route('/api/files/new_text_file', methods=['POST'])
 @login_required
@@ -768,46 +4698,46 @@ def new_text_file():
     data = request.get_json()
     parent_id = data.get('parent_id')
     filename = data.get('filename') # Can be None
+    if filename and not valid_filename(filename):
+        return jsonify({'error': 'Invalid file name'}), 400
 
+    # Empty files all share the one empty blob
+    staged = stage_blob(lambda f: None)
     conn = get_db_connection()
+    try:
+        # The free name is picked under the same write lock that inserts it
+        conn.execute('BEGIN IMMEDIATE')
+        if not filename:
+            # Find a unique filename if not provided
+            base_name = "Untitled"
+            extension = ".txt"
+            filename = f"{base_name}{extension}"
+            counter = 1
+
+            # Build query to check for existing file
+            query = 'SELECT 1 FROM files WHERE user_id = ? AND filename = ? AND '
+            params = [user_id, filename]
+            if parent_id is None:
+                query += 'parent_id IS NULL'
+            else:
+                query += 'parent_id = ?'
+                params.append(parent_id)
+
+            while conn.execute(query, tuple(params)).fetchone():
+                filename = f"{base_name} ({counter}){extension}"
+                params[1] = filename # Update filename in params
+                counter += 1
+
+        file_id = insert_file(conn, user_id, parent_id, filename, staged)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        discard_staged(staged)
+        raise
+    finally:
+        conn.close()
 
-    if not filename:
-        # Find a unique filename if not provided
-        base_name = "Untitled"
-        extension = ".txt"
-        filename = f"{base_name}{extension}"
-        counter = 1
-
-        # Build query to check for existing file
-        query = 'SELECT 1 FROM files WHERE user_id = ? AND filename = ? AND '
-        params = [user_id, filename]
-        if parent_id is None:
-            query += 'parent_id IS NULL'
-        else:
-            query += 'parent_id = ?'
-            params.append(parent_id)
-
-        while conn.execute(query, tuple(params)).fetchone():
-            filename = f"{base_name} ({counter}){extension}"
-            params[1] = filename # Update filename in params
-            counter += 1
-
-    # Create the empty physical file and the DB record
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO files (user_id, parent_id, filename, is_folder, file_path) VALUES (?, ?, ?, ?, ?)',
-        (user_id, parent_id, filename, False, 'placeholder')
-    )
-    file_id = cursor.lastrowid
-
-    file_path = os.path.join(UPLOADS_FOLDER_PATH, str(user_id), str(file_id))
-    with open(file_path, 'w') as f:
-        pass # Create empty file
-
-    cursor.execute('UPDATE files SET file_path = ? WHERE id = ?', (file_path, file_id))
-    conn.commit()
-    conn.close()
-
+    directory_cache.invalidate(user_id, parent_id)
     return jsonify({'message': 'File created successfully', 'id': file_id, 'filename': filename}), 201
 
 # --- Static File Serving ---
@@ -826,14 +4756,22 @@ import atexit
 def shutdown_playwright():
     if playwright:
         async def _shutdown():
+            await browser_pool.stop()
             await playwright.stop()
 
         future = asyncio.run_coroutine_threadsafe(_shutdown(), loop)
         future.result()
 
 if __name__ == '__main__':
+    if '--asgi' in sys.argv:
+        serve_asgi()
+        sys.exit()
     init_db()
+    file_reclaimer.start()
+    search_indexer.start()
+    app.session_interface.start()
     start_event_loop_thread()
     start_playwright()
     atexit.register(shutdown_playwright)
+    atexit.register(password_hasher.shutdown)
     app.run(debug=True, port=5001)
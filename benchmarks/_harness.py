@@ -0,0 +1,55 @@
+"""Shared helpers for the benchmark scripts: an isolated app instance and a concurrent load driver."""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def load_app():
+    """Imports backend/app.py and points its database (login sessions included) and uploads at a scratch directory."""
+    import app as webos
+
+    workdir = tempfile.mkdtemp(prefix='webos-bench-')
+    webos.DB_PATH = os.path.join(workdir, 'database.db')
+    webos.UPLOADS_FOLDER_PATH = os.path.join(workdir, 'uploads')
+    webos.app.config['TESTING'] = True
+    webos.init_db()
+    return webos
+
+
+def logged_in_client(webos, username='bench', password='password'):
+    client = webos.app.test_client()
+    client.post('/api/register', json={'username': username, 'email': f'{username}@example.com', 'password': password})
+    response = client.post('/api/login', json={'username': username, 'password': password})
+    assert response.status_code == 200, response.get_json()
+    return client
+
+
+def run_concurrent(make_worker, clients, duration=3.0):
+    """Runs `clients` threads calling the function returned by make_worker() until `duration` elapses.
+
+    Returns completed calls per second across all threads.
+    """
+    counts = [0] * clients
+    deadline = time.perf_counter() + duration
+    start = threading.Barrier(clients + 1)
+
+    def loop(index):
+        work = make_worker(index)
+        start.wait()
+        while time.perf_counter() < deadline:
+            work()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.perf_counter() - began)
@@ -0,0 +1,37 @@
+"""Requests/sec for `GET /api/files` with and without the SQLite connection pool.
+
+Usage: python3 benchmarks/bench_db_pool.py [--files 500] [--duration 3]
+"""
+import argparse
+
+from _harness import load_app, logged_in_client, run_concurrent
+
+CONCURRENCY = (1, 8, 64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=500, help='files seeded into the listed folder')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per measurement')
+    args = parser.parse_args()
+
+    webos = load_app()
+    seed = logged_in_client(webos)
+    for i in range(args.files):
+        seed.post('/api/files/folder', json={'filename': f'folder-{i:05d}', 'parent_id': None})
+
+    def make_worker(_):
+        client = logged_in_client(webos)
+        return lambda: client.get('/api/files?parent_id=null')
+
+    print(f"{'clients':>8} {'no pool (req/s)':>16} {'pool (req/s)':>14}")
+    for clients in CONCURRENCY:
+        results = []
+        for pool_size in (0, 16):
+            webos.app.config['DB_POOL_SIZE'] = pool_size
+            results.append(run_concurrent(make_worker, clients, args.duration))
+        print(f'{clients:>8} {results[0]:>16.1f} {results[1]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""ms/page and peak memory of rewrite_page_html against the previous multi-pass rewriter.
+
+Every fixture under benchmarks/fixtures/pages is rewritten by both implementations and the
+outputs are compared first, so a run doubles as an equivalence check.
+
+Usage: python3 benchmarks/bench_html_rewrite.py [--iterations 20]
+"""
+import argparse
+import os
+import re
+import time
+import tracemalloc
+from urllib.parse import urljoin, quote
+
+from bs4 import BeautifulSoup
+
+import _harness  # noqa: F401  (puts backend/ on sys.path)
+from app import rewrite_page_html
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+BASE_URL = 'https://www.example.com/news/2024/notes.html'
+SESSION_ID, PAGE_ID = 'bench-session', 'bench-page'
+
+
+def legacy_rewrite_page_html(content, base_url, session_id, page_id):
+    """The rewriter as it was before the single-pass version: one find_all per concern."""
+    soup = BeautifulSoup(content, 'lxml')
+
+    base_tag = soup.new_tag('base', href=base_url)
+    post_message_script = soup.new_tag('script')
+    post_message_script.string = f"""
+        window.addEventListener('load', () => {{
+            if (window.parent && window.parent !== window) {{
+                window.parent.postMessage({{
+                    type: 'browser-url-change',
+                    url: '{base_url}',
+                    sessionId: '{session_id}',
+                    pageId: '{page_id}'
+                }}, '*');
+            }}
+        }});
+    """
+
+    if soup.head:
+        soup.head.insert(0, base_tag)
+        soup.head.append(post_message_script)
+    else:
+        head = soup.new_tag('head')
+        soup.insert(0, head)
+        head.append(base_tag)
+        head.append(post_message_script)
+
+    def proxy_css_urls(css_text):
+        def replacer(m):
+            original_url = m.group(1).strip('\'"')
+            if original_url.startswith('data:'):
+                return f"url('{original_url}')"
+            absolute_url = urljoin(base_url, original_url)
+            proxied_url = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
+            return f"url('{proxied_url}')"
+        return re.sub(r'url\((.*?)\)', replacer, css_text)
+
+    for tag in soup.find_all(style=True):
+        tag['style'] = proxy_css_urls(tag['style'])
+
+    for style_tag in soup.find_all('style'):
+        if style_tag.string:
+            style_tag.string.replace_with(proxy_css_urls(style_tag.string))
+
+    tags_to_rewrite = {
+        'a': ['href'], 'link': ['href'], 'img': ['src', 'srcset'],
+        'script': ['src'], 'audio': ['src'], 'video': ['src', 'poster'],
+        'source': ['src', 'srcset'], 'embed': ['src'], 'iframe': ['src'],
+        'object': ['data'], 'track': ['src'],
+    }
+
+    for tag_name, attrs in tags_to_rewrite.items():
+        for tag in soup.find_all(tag_name):
+            for attr in attrs:
+                if not tag.has_attr(attr): continue
+
+                val = tag[attr]
+                if not val or val.startswith('data:') or val.startswith('javascript:'): continue
+                if val.startswith('#'): continue
+
+                if attr != 'srcset':
+                    absolute_url = urljoin(base_url, val)
+                    if tag_name == 'a' or (tag_name == 'link' and tag.get('rel') != ['stylesheet']):
+                        tag[attr] = f"/api/browser/{session_id}/pages/{page_id}/navigate_and_view?url={quote(absolute_url)}"
+                    else:
+                        tag[attr] = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
+                else:
+                    new_srcset = []
+                    for part in val.split(','):
+                        part = part.strip()
+                        if not part: continue
+                        url_part, *descriptor_part = part.split(maxsplit=1)
+                        descriptor = descriptor_part[0] if descriptor_part else ''
+                        absolute_url = urljoin(base_url, url_part)
+                        proxied_url = f"/api/browser/{session_id}/pages/{page_id}/proxy?url={quote(absolute_url)}"
+                        new_srcset.append(f"{proxied_url} {descriptor}")
+                    tag[attr] = ", ".join(new_srcset)
+
+    for form in soup.find_all('form', action=True):
+        action = form['action']
+        absolute_url = urljoin(base_url, action)
+        form['action'] = f"/api/browser/{session_id}/pages/{page_id}/navigate_and_view?url={quote(absolute_url)}"
+
+    return str(soup)
+
+
+def measure(rewrite, content, iterations):
+    """Returns (ms per page, peak traced bytes of a single rewrite)."""
+    began = time.perf_counter()
+    for _ in range(iterations):
+        rewrite(content, BASE_URL, SESSION_ID, PAGE_ID)
+    elapsed = (time.perf_counter() - began) * 1000 / iterations
+
+    tracemalloc.start()
+    rewrite(content, BASE_URL, SESSION_ID, PAGE_ID)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20, help='rewrites per fixture and implementation')
+    args = parser.parse_args()
+
+    fixtures = sorted(f for f in os.listdir(FIXTURES_DIR) if f.endswith('.html'))
+    print(f"{'fixture':<16} {'KiB':>6} {'legacy ms':>10} {'legacy peak':>12} {'new ms':>8} {'new peak':>10}")
+    for name in fixtures:
+        with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+            content = f.read()
+
+        expected = legacy_rewrite_page_html(content, BASE_URL, SESSION_ID, PAGE_ID)
+        actual = rewrite_page_html(content, BASE_URL, SESSION_ID, PAGE_ID)
+        if actual != expected:
+            raise SystemExit(f'{name}: rewritten output differs from the legacy rewriter')
+
+        legacy_ms, legacy_peak = measure(legacy_rewrite_page_html, content, args.iterations)
+        new_ms, new_peak = measure(rewrite_page_html, content, args.iterations)
+        print(f'{name:<16} {len(content) / 1024:>6.1f} {legacy_ms:>10.2f} {legacy_peak / 1024:>10.0f}Ki'
+              f' {new_ms:>8.2f} {new_peak / 1024:>8.0f}Ki')
+
+
+if __name__ == '__main__':
+    main()
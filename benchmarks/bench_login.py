@@ -0,0 +1,44 @@
+"""Logins/sec with bcrypt on the request threads versus in the password hashing process pool.
+
+Usage: python3 benchmarks/bench_login.py [--rounds 12] [--duration 5]
+"""
+import argparse
+import os
+
+from _harness import load_app, run_concurrent
+
+CONCURRENCY = (1, 4, 16, 64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per measurement')
+    args = parser.parse_args()
+
+    webos = load_app()
+    webos.app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    webos.app.config['PASSWORD_HASH_QUEUE'] = max(CONCURRENCY)
+    webos.app.test_client().post('/api/register', json={
+        'username': 'bench', 'email': 'bench@example.com', 'password': 'password'})
+
+    def make_worker(_):
+        client = webos.app.test_client()
+        def login():
+            response = client.post('/api/login', json={'username': 'bench', 'password': 'password'})
+            assert response.status_code == 200, response.get_json()
+        return login
+
+    workers = os.cpu_count() or 1
+    print(f"{'clients':>8} {'inline (logins/s)':>18} {f'pool x{workers} (logins/s)':>22}")
+    for clients in CONCURRENCY:
+        results = []
+        for pool_workers in (0, workers):
+            webos.app.config['PASSWORD_HASH_WORKERS'] = pool_workers
+            results.append(run_concurrent(make_worker, clients, args.duration))
+        print(f'{clients:>8} {results[0]:>18.1f} {results[1]:>22.1f}')
+    webos.password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Throughput of concurrent slow navigations through /api/browser/.../navigate.
+
+Start the server first, either threaded WSGI or ASGI mode:
+    python3 backend/app.py            # WSGI: each navigation holds a worker thread
+    python3 backend/app.py --asgi     # ASGI: navigations are awaited on the event loop
+then run:
+    python3 benchmarks/bench_slow_navigation.py [--clients 100] [--delay 2]
+
+A local origin answers every request after --delay seconds, so the numbers measure how
+many navigations the server keeps in flight rather than how fast the network is.
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+
+def start_slow_origin(delay):
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            body = b'<html><head><title>slow</title></head><body>slow page</body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5001')
+    parser.add_argument('--clients', type=int, default=100, help='concurrent navigations (one tab each)')
+    parser.add_argument('--delay', type=float, default=2.0, help='seconds the origin takes per response')
+    args = parser.parse_args()
+
+    origin = start_slow_origin(args.delay)
+    # One client shared by every thread; no timeout, and enough connections that none waits for the pool
+    http = httpx.Client(timeout=None, limits=httpx.Limits(max_connections=args.clients))
+    credentials = {'username': 'navbench', 'email': 'navbench@example.com', 'password': 'password'}
+    http.post(f'{args.base_url}/api/register', json=credentials)
+    http.post(f'{args.base_url}/api/login', json=credentials).raise_for_status()
+
+    browser = http.post(f'{args.base_url}/api/browser').json()
+    session_id = browser['session_id']
+    pages = [browser['page_id']]
+    while len(pages) < args.clients:
+        pages.append(http.post(f'{args.base_url}/api/browser/{session_id}/pages').json()['page_id'])
+
+    def navigate(index):
+        started = time.perf_counter()
+        response = http.post(f'{args.base_url}/api/browser/{session_id}/pages/{pages[index]}/navigate',
+                             json={'url': f'{origin}/page/{index}'})
+        ok = response.is_success and 'error' not in response.json()
+        return ok, time.perf_counter() - started
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        results = list(executor.map(navigate, range(args.clients)))
+    elapsed = time.perf_counter() - began
+
+    latencies = sorted(latency for _, latency in results)
+    succeeded = sum(ok for ok, _ in results)
+    print(f'{succeeded}/{args.clients} navigations in {elapsed:.2f}s '
+          f'({succeeded / elapsed:.1f} nav/s, origin delay {args.delay}s)')
+    print(f'latency p50 {latencies[len(latencies) // 2]:.2f}s, max {latencies[-1]:.2f}s')
+
+    http.delete(f'{args.base_url}/api/browser/{session_id}')
+    http.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,40 @@
-// Global listener for URL changes from browser iframes
-window.addEventListener('message', (event) => {
-    if (event.data && event.data.type === 'browser-url-change') {
-        const { url, sessionId, pageId } = event.data;
-        const winBody = document.querySelector(`.window-body[data-session-id='${sessionId}']`);
-        if (winBody) {
-            const addressBar = winBody.querySelector('.address-bar');
-            const tabEl = winBody.querySelector(`.browser-tab[data-page-id='${pageId}']`);
-
-            if (tabEl) {
-                // Update tab title (e.g., with the domain name)
-                try {
-                    const urlObject = new URL(url);
-                    const title = urlObject.hostname.replace('www.', '');
-                    tabEl.querySelector('span').textContent = title;
-                } catch (e) {
-                    tabEl.querySelector('span').textContent = 'New Tab';
-                }
+function updateBrowserTabUrl(sessionId, pageId, url) {
+    const winBody = document.querySelector(`.window-body[data-session-id='${sessionId}']`);
+    if (winBody) {
+        const addressBar = winBody.querySelector('.address-bar');
+        const tabEl = winBody.querySelector(`.browser-tab[data-page-id='${pageId}']`);
+
+        if (tabEl) {
+            // Update tab title (e.g., with the domain name)
+            try {
+                const urlObject = new URL(url);
+                const title = urlObject.hostname.replace('www.', '');
+                tabEl.querySelector('span').textContent = title;
+            } catch (e) {
+                tabEl.querySelector('span').textContent = 'New Tab';
             }
+        }
 
-            // Update address bar only if the message is from the active tab
-            if (tabEl && tabEl.classList.contains('active')) {
-                if (document.activeElement !== addressBar) {
-                    addressBar.value = url;
-                }
+        // Update address bar only if the message is from the active tab
+        if (tabEl && tabEl.classList.contains('active')) {
+            if (document.activeElement !== addressBar) {
+                addressBar.value = url;
             }
         }
     }
+}
+
+// Global listener for URL changes from browser iframes
+window.addEventListener('message', (event) => {
+    if (event.data && event.data.type === 'browser-url-change') {
+        const { url, sessionId, pageId } = event.data;
+        updateBrowserTabUrl(sessionId, pageId, url);
+    }
 });
 
+// Live view: how often pointer moves are forwarded while hovering over the frame
+const LIVE_VIEW_MOVE_INTERVAL = 50;
+
 function createBrowserWindow() {
     const appId = 'browser';
     const title = 'Browser';
@@ -43,6 +50,8 @@ function createBrowserWindow() {
             <div class="bg-gray-100 p-1 flex items-center">
                 <input type="text" class="address-bar flex-grow bg-white text-black rounded-full px-4 py-1 border border-gray-300">
                 <button class="go-btn bg-blue-500 hover:bg-blue-600 text-white font-bold py-1 px-3 rounded-full ml-1">Go</button>
+                <button class="mode-btn bg-gray-400 hover:bg-gray-500 text-white font-bold py-1 px-3 rounded-full ml-1"
+                        title="Switch between the rewritten page and a live video of the remote browser"></button>
             </div>
             <div class="browser-content flex-grow relative bg-white">
                 <!-- iFrames will be dynamically inserted here -->
@@ -62,13 +71,118 @@ function createBrowserWindow() {
     const tabsContainer = winBody.querySelector('#browser-tabs-container');
     const browserContent = winBody.querySelector('.browser-content');
     const loadingOverlay = winBody.querySelector('.loading-overlay');
+    const modeBtn = winBody.querySelector('.mode-btn');
 
     let sessionId = null;
+    // 'page' shows the rewritten HTML in an iframe; 'live' streams frames of the remote page and forwards input
+    let renderMode = localStorage.getItem('browserRenderMode') === 'live' ? 'live' : 'page';
     let tabsState = {
         activePageId: null,
-        pages: new Map() // pageId -> { iframe, tabEl }
+        pages: new Map() // pageId -> { iframe, screen, tabEl, stream, frameSize, navigated, pendingView }
     };
 
+    function updateModeButton() {
+        modeBtn.textContent = renderMode === 'live' ? 'Page' : 'Live';
+    }
+
+    function sendInput(pageId, event) {
+        fetch(`/api/browser/${sessionId}/pages/${pageId}/input`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(event),
+            credentials: 'include'
+        }).catch(() => {});
+    }
+
+    function startStream(pageId) {
+        const page = tabsState.pages.get(pageId);
+        if (!page || page.stream) return;
+        const params = new URLSearchParams({
+            width: Math.round(browserContent.clientWidth),
+            height: Math.round(browserContent.clientHeight)
+        });
+        page.stream = new EventSource(`/api/browser/${sessionId}/pages/${pageId}/screencast?${params}`);
+        page.stream.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            page.screen.src = `data:image/jpeg;base64,${data.frame}`;
+            page.frameSize = { width: data.width, height: data.height };
+            loadingOverlay.classList.add('hidden');
+            if (data.url && data.url !== page.lastUrl) {
+                page.lastUrl = data.url;
+                updateBrowserTabUrl(sessionId, pageId, data.url);
+            }
+        };
+    }
+
+    function stopStream(pageId) {
+        const page = tabsState.pages.get(pageId);
+        if (page && page.stream) {
+            page.stream.close();
+            page.stream = null;
+        }
+    }
+
+    // Shows the active tab in the current render mode; only the active tab streams
+    function showActivePage() {
+        tabsState.pages.forEach((page, pageId) => {
+            const active = pageId === tabsState.activePageId;
+            page.iframe.classList.toggle('hidden', !active || renderMode !== 'page');
+            page.screen.classList.toggle('hidden', !active || renderMode !== 'live');
+            if (active && renderMode === 'page' && page.pendingView) {
+                // A tab restored from a previous session loads its page the first time it is shown
+                page.pendingView = false;
+                page.iframe.src = `/api/browser/${sessionId}/pages/${pageId}/view`;
+            }
+            if (active && renderMode === 'live') {
+                startStream(pageId);
+            } else {
+                stopStream(pageId);
+            }
+        });
+    }
+
+    // Translates pointer and keyboard events on a live view frame into input for the remote page
+    function forwardInput(pageId, screen) {
+        const buttons = ['left', 'middle', 'right'];
+        let lastMove = 0;
+        const position = (e) => {
+            const page = tabsState.pages.get(pageId);
+            const rect = screen.getBoundingClientRect();
+            const size = (page && page.frameSize) || { width: rect.width, height: rect.height };
+            return {
+                x: (e.clientX - rect.left) * size.width / rect.width,
+                y: (e.clientY - rect.top) * size.height / rect.height
+            };
+        };
+        screen.addEventListener('mousedown', (e) => {
+            e.preventDefault();
+            screen.focus();
+            sendInput(pageId, { type: 'down', button: buttons[e.button], ...position(e) });
+        });
+        screen.addEventListener('mouseup', (e) => {
+            sendInput(pageId, { type: 'up', button: buttons[e.button], ...position(e) });
+        });
+        screen.addEventListener('mousemove', (e) => {
+            const now = Date.now();
+            if (now - lastMove < LIVE_VIEW_MOVE_INTERVAL) return;
+            lastMove = now;
+            sendInput(pageId, { type: 'move', ...position(e) });
+        });
+        screen.addEventListener('wheel', (e) => {
+            e.preventDefault();
+            sendInput(pageId, { type: 'wheel', deltaX: e.deltaX, deltaY: e.deltaY, ...position(e) });
+        }, { passive: false });
+        screen.addEventListener('contextmenu', (e) => e.preventDefault());
+        screen.addEventListener('keydown', (e) => {
+            e.preventDefault();
+            if (e.key.length === 1 && !e.ctrlKey && !e.metaKey && !e.altKey) {
+                sendInput(pageId, { type: 'text', text: e.key });
+            } else {
+                sendInput(pageId, { type: 'key', key: e.key });
+            }
+        });
+    }
+
     function switchTab(pageId) {
         if (!tabsState.pages.has(pageId)) return;
 
@@ -79,10 +193,8 @@ function createBrowserWindow() {
             tab.classList.toggle('active', tab.dataset.pageId === pageId);
         });
 
-        // Update iframes
-        browserContent.querySelectorAll('iframe').forEach(iframe => {
-            iframe.classList.toggle('hidden', iframe.dataset.pageId !== pageId);
-        });
+        // Update iframes and live views
+        showActivePage();
 
         // Update address bar
         const activePage = tabsState.pages.get(pageId);
@@ -100,8 +212,10 @@ function createBrowserWindow() {
         // Send request to backend to close the page
         await fetch(`/api/browser/${sessionId}/pages/${pageId}`, { method: 'DELETE', credentials: 'include' });
 
-        const { iframe, tabEl } = tabsState.pages.get(pageId);
+        stopStream(pageId);
+        const { iframe, screen, tabEl } = tabsState.pages.get(pageId);
         iframe.remove();
+        screen.remove();
         tabEl.remove();
         tabsState.pages.delete(pageId);
 
@@ -134,7 +248,15 @@ function createBrowserWindow() {
         iframe.src = 'about:blank';
         browserContent.appendChild(iframe);
 
-        tabsState.pages.set(pageId, { iframe, tabEl });
+        const screen = document.createElement('img');
+        screen.className = 'w-full h-full hidden outline-none select-none';
+        screen.tabIndex = 0;
+        screen.draggable = false;
+        screen.dataset.pageId = pageId;
+        browserContent.appendChild(screen);
+        forwardInput(pageId, screen);
+
+        tabsState.pages.set(pageId, { iframe, screen, tabEl, stream: null, frameSize: null, navigated: false, pendingView: false });
 
         tabEl.addEventListener('click', () => switchTab(pageId));
         tabEl.querySelector('.close-tab-btn').addEventListener('click', (e) => {
@@ -150,7 +272,8 @@ function createBrowserWindow() {
     async function navigate() {
         if (!sessionId || !tabsState.activePageId) return;
         const activePageId = tabsState.activePageId;
-        const { iframe } = tabsState.pages.get(activePageId);
+        const page = tabsState.pages.get(activePageId);
+        const { iframe } = page;
 
         let userInput = addressBar.value.trim();
         if (!userInput) return;
@@ -187,7 +310,13 @@ function createBrowserWindow() {
             if (!isSearch) {
                 addressBar.value = navResult.final_url || url;
             }
+            page.navigated = true;
 
+            if (renderMode === 'live') {
+                // The open screencast picks up the new page; the overlay goes away with its first frame
+                startStream(activePageId);
+                return;
+            }
             iframe.src = `/api/browser/${sessionId}/pages/${activePageId}/view`;
             iframe.onload = () => loadingOverlay.classList.add('hidden');
             iframe.onerror = () => {
@@ -214,7 +343,21 @@ function createBrowserWindow() {
             browserContent.innerHTML = '';
             tabsState.pages.clear();
 
-            addTab(data.page_id, true);
+            // Tabs kept from an earlier session (even across server restarts) come back in the same response
+            const pages = data.pages || [{ page_id: data.page_id, url: null }];
+            pages.forEach(({ page_id, url }) => {
+                addTab(page_id, false);
+                if (url) {
+                    const page = tabsState.pages.get(page_id);
+                    page.navigated = true;
+                    page.pendingView = true;
+                    updateBrowserTabUrl(sessionId, page_id, url);
+                }
+            });
+            switchTab(pages[0].page_id);
+            if (pages[0].url) {
+                addressBar.value = pages[0].url;
+            }
 
         } catch (error) {
             showNotification(`Error: ${error.message}`, 'error');
@@ -231,6 +374,18 @@ function createBrowserWindow() {
     });
 
     goBtn.addEventListener('click', navigate);
+    modeBtn.addEventListener('click', () => {
+        renderMode = renderMode === 'live' ? 'page' : 'live';
+        localStorage.setItem('browserRenderMode', renderMode);
+        updateModeButton();
+        const page = tabsState.pages.get(tabsState.activePageId);
+        if (page && page.navigated && renderMode === 'page') {
+            // The iframe may be showing an older state of the page than the live view left it in
+            page.iframe.src = `/api/browser/${sessionId}/pages/${tabsState.activePageId}/view`;
+        }
+        showActivePage();
+    });
+    updateModeButton();
     addressBar.addEventListener('keydown', (e) => {
         if (e.key === 'Enter') navigate();
     });
@@ -238,6 +393,7 @@ function createBrowserWindow() {
     const win = winBody.closest('.app-window');
     const observer = new MutationObserver(() => {
         if (!document.body.contains(win)) {
+            tabsState.pages.forEach((page, pageId) => stopStream(pageId));
             if (sessionId) {
                 navigator.sendBeacon(`/api/browser/${sessionId}`, JSON.stringify({}), { type: 'application/json', keepalive: true });
             }
@@ -61,10 +61,12 @@ document.addEventListener('DOMContentLoaded', () => {
         });
 
         try {
+            // Patch just this key so a concurrent settings change in another tab isn't overwritten
             await fetch('/api/settings', {
-                method: 'PUT',
-                headers: { 'Content-Type': 'application/json', 'credentials': 'include' },
-                body: JSON.stringify({ iconPositions: positions })
+                method: 'PATCH',
+                headers: { 'Content-Type': 'application/json-patch+json' },
+                credentials: 'include',
+                body: JSON.stringify([{ op: 'add', path: '/iconPositions', value: positions }])
             });
         } catch (error) {
             console.error('Failed to save icon positions:', error);
@@ -73,7 +75,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     async function loadIconPositions() {
         try {
-            const response = await fetch('/api/settings', { credentials: 'include' });
+            const response = await fetch('/api/settings', { credentials: 'include', cache: 'no-cache' });
             const settings = await response.json();
             const positions = settings.iconPositions;
 
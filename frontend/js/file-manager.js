@@ -30,6 +30,21 @@ function initFileManager(container) {
     }
 
     // --- File Rendering ---
+    const thumbnailExtensions = ['.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'];
+
+    function showThumbnail(fileEl, fileId) {
+        const icon = fileEl.querySelector('i');
+        const thumb = document.createElement('img');
+        thumb.src = `/api/files/thumbnail/${fileId}?size=small`;
+        thumb.className = 'w-12 h-12 object-cover rounded hidden';
+        thumb.addEventListener('load', () => {
+            thumb.classList.remove('hidden');
+            icon.remove();
+        });
+        thumb.addEventListener('error', () => thumb.remove()); // Keep the generic icon
+        fileEl.insertBefore(thumb, icon);
+    }
+
     async function renderFiles(parentId, parentName) {
         // Manage history
         if (parentName) { // Navigating into a folder
@@ -43,13 +58,10 @@ function initFileManager(container) {
 
         const parentIdQuery = parentId === null ? 'null' : parentId;
         try {
+            // Revalidate with the listing's ETag; unchanged folders come back as 304 from the browser cache
             const response = await fetch(`/api/files?parent_id=${parentIdQuery}`, {
                 credentials: 'include',
-                headers: {
-                    'Cache-Control': 'no-cache',
-                    'Pragma': 'no-cache',
-                    'Expires': '0'
-                }
+                cache: 'no-cache'
             });
             if (!response.ok) throw new Error('Failed to fetch files');
             const files = await response.json();
@@ -70,6 +82,9 @@ function initFileManager(container) {
                     <i class="fas ${iconClass} fa-2x"></i>
                     <span class="text-xs mt-1">${file.filename}</span>
                 `;
+                if (!file.is_folder && thumbnailExtensions.some(ext => file.filename.toLowerCase().endsWith(ext))) {
+                    showThumbnail(fileEl, file.id);
+                }
                 fileView.appendChild(fileEl);
 
                 // Event Listeners
@@ -309,6 +324,61 @@ function initFileManager(container) {
     }
 
 
+    // --- Chunked Upload ---
+    const UPLOAD_CONCURRENCY = 4; // Chunks in flight at once
+    const UPLOAD_RETRIES = 3; // Attempts per chunk before giving up
+
+    async function uploadJson(url, options = {}) {
+        const response = await fetch(url, { credentials: 'include', ...options });
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.error || 'Upload failed');
+        return data;
+    }
+
+    async function uploadInChunks(file, parentId) {
+        const upload = await uploadJson('/api/files/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, parent_id: parentId })
+        });
+        const baseUrl = `/api/files/uploads/${upload.upload_id}`;
+
+        const pending = [];
+        for (let offset = 0; offset < file.size; offset += upload.chunk_size) {
+            pending.push(offset);
+        }
+
+        async function sendChunk(offset) {
+            const body = file.slice(offset, offset + upload.chunk_size);
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    return await uploadJson(`${baseUrl}/${offset}`, {
+                        method: 'PUT',
+                        headers: { 'Content-Type': 'application/octet-stream' },
+                        body
+                    });
+                } catch (error) {
+                    if (attempt >= UPLOAD_RETRIES) throw error;
+                }
+            }
+        }
+
+        // A few workers pull offsets from the shared list so chunks upload in parallel
+        async function worker() {
+            while (pending.length > 0) {
+                await sendChunk(pending.shift());
+            }
+        }
+
+        try {
+            await Promise.all(Array.from({ length: UPLOAD_CONCURRENCY }, worker));
+            return await uploadJson(`${baseUrl}/complete`, { method: 'POST' });
+        } catch (error) {
+            fetch(baseUrl, { method: 'DELETE', credentials: 'include' });
+            throw error;
+        }
+    }
+
     uploadBtn.addEventListener('click', () => {
         const fileInput = document.createElement('input');
         fileInput.type = 'file';
@@ -317,20 +387,8 @@ function initFileManager(container) {
         fileInput.addEventListener('change', async () => {
             if (fileInput.files.length > 0) {
                 const file = fileInput.files[0];
-                const formData = new FormData();
-                formData.append('file', file);
-                formData.append('parent_id', currentParentId || '');
-
                 try {
-                    const response = await fetch('/api/files/upload', {
-                        method: 'POST',
-                        credentials: 'include',
-                        body: formData
-                    });
-                    if (!response.ok) {
-                        const err = await response.json();
-                        throw new Error(err.error || 'Upload failed');
-                    }
+                    await uploadInChunks(file, currentParentId);
                     showNotification(`'${file.name}' uploaded successfully.`, 'success');
                     renderFiles(currentParentId); // Refresh view
                 } catch (error) {
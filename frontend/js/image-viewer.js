@@ -9,9 +9,20 @@ function initImageViewer(fileId, fileName) {
 
     windowBody.style.padding = '0';
     windowBody.style.overflow = 'hidden';
+    // Show a server-side preview first; the original is only fetched on request
+    const originalUrl = `/api/files/download/${fileId}?inline=1`;
     windowBody.innerHTML = `
         <div class="image-viewer h-full w-full flex items-center justify-center bg-gray-900">
-            <img src="/api/files/download/${fileId}" alt="${fileName}" class="max-w-full max-h-full object-contain">
+            <img src="/api/files/thumbnail/${fileId}?size=large" alt="${fileName}" title="Double-click to view the original" class="max-w-full max-h-full object-contain">
         </div>
     `;
+
+    const img = windowBody.querySelector('img');
+    const showOriginal = () => {
+        if (img.src.endsWith(originalUrl)) return;
+        img.src = originalUrl;
+        img.removeAttribute('title');
+    };
+    img.addEventListener('dblclick', showOriginal);
+    img.addEventListener('error', showOriginal); // No preview (e.g. SVG): fall back to the original
 }
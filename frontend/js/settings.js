@@ -26,12 +26,15 @@ function initSettings() {
     const wallpaperInput = windowBody.querySelector('#wallpaper-url');
     const saveBtn = windowBody.querySelector('#settings-save-btn');
     const desktop = document.getElementById('desktop');
+    let loadedWallpaper; // Wallpaper the form was loaded with; saves only apply on top of it (undefined if unset)
 
     // --- Load Current Settings ---
     async function loadSettings() {
         try {
-            const response = await fetch('/api/settings', { credentials: 'include' });
+            // Revalidate with the settings' ETag; unchanged settings come back as 304 from the browser cache
+            const response = await fetch('/api/settings', { credentials: 'include', cache: 'no-cache' });
             const settings = await response.json();
+            loadedWallpaper = settings.wallpaper;
             if (settings.wallpaper) {
                 wallpaperInput.value = settings.wallpaper;
                 // Apply current wallpaper
@@ -45,17 +48,25 @@ function initSettings() {
     // --- Save Settings ---
     saveBtn.addEventListener('click', async () => {
         const newWallpaper = wallpaperInput.value;
-        const newSettings = {
-            wallpaper: newWallpaper
-        };
+        // Patch only the wallpaper, so changes saved elsewhere (e.g. icon positions) are kept.
+        // The test op guards against a wallpaper changed in another window since the form was loaded.
+        const patch = [{ op: 'add', path: '/wallpaper', value: newWallpaper }];
+        if (loadedWallpaper !== undefined) patch.unshift({ op: 'test', path: '/wallpaper', value: loadedWallpaper });
 
         try {
-            await fetch('/api/settings', {
-                method: 'PUT',
-                headers: { 'Content-Type': 'application/json' },
+            const response = await fetch('/api/settings', {
+                method: 'PATCH',
+                headers: { 'Content-Type': 'application/json-patch+json' },
                 credentials: 'include',
-                body: JSON.stringify(newSettings)
+                body: JSON.stringify(patch)
             });
+            if (response.status === 409) {
+                showNotification('The wallpaper was changed in another window and has been reloaded.', 'error');
+                loadSettings();
+                return;
+            }
+            if (!response.ok) throw new Error((await response.json()).error);
+            loadedWallpaper = newWallpaper;
 
             // Apply new wallpaper live
             if (newWallpaper) {
@@ -5,6 +5,7 @@ function initTerminal(windowBody) {
     let cwd_name = '~';
     let commandHistory = [];
     let historyIndex = -1;
+    let running = null; // AbortController of the command whose output is streaming in; Ctrl+C aborts it
 
     // --- UI Setup ---
     windowBody.style.padding = '0';
@@ -30,9 +31,31 @@ function initTerminal(windowBody) {
 
     function printToOutput(text) {
         const line = document.createElement('div');
-        line.innerHTML = text.replace(/\n/g, '<br>'); // innerHTML to render <br>
+        line.style.whiteSpace = 'pre-wrap'; // Keep newlines and the columns of ls/du output
+        line.textContent = text;
         outputEl.appendChild(line);
         outputEl.scrollTop = outputEl.scrollHeight; // Scroll to bottom
+        return line;
+    }
+
+    function appendOutput(line, text) {
+        line.appendChild(document.createTextNode(text));
+        outputEl.scrollTop = outputEl.scrollHeight;
+    }
+
+    function handleMessage(message, line) {
+        if (message.output) {
+            appendOutput(line, message.output);
+        }
+        if (message.error) {
+            printToOutput(`Error: ${message.error}`);
+        }
+        // Update CWD if changed
+        if (message.new_cwd && message.new_cwd.id !== undefined) {
+            cwd_id = message.new_cwd.id;
+            cwd_name = message.new_cwd.name;
+            updatePrompt();
+        }
     }
 
     async function executeCommand(commandStr) {
@@ -44,36 +67,48 @@ function initTerminal(windowBody) {
 
         // Print command to output
         printToOutput(`${promptEl.textContent} ${commandStr}`);
+        const line = printToOutput('');
+        const controller = new AbortController();
+        running = controller;
 
         try {
             const response = await fetch('/api/terminal/execute', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
                 credentials: 'include',
-                body: JSON.stringify({ command: commandStr, cwd_id: cwd_id })
+                body: JSON.stringify({ command: commandStr, cwd_id: cwd_id }),
+                signal: controller.signal
             });
-            const data = await response.json();
-
-            // Print command output
-            if (data.output) {
-                printToOutput(data.output);
-            }
+            if (!response.ok) throw new Error(response.statusText || `HTTP ${response.status}`);
 
-            // Update CWD if changed
-            if (data.new_cwd && data.new_cwd.id !== undefined) {
-                cwd_id = data.new_cwd.id;
-                cwd_name = data.new_cwd.name;
-                updatePrompt();
+            // Output streams in as one JSON message per line, so long output renders as it arrives
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let pending = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                pending += decoder.decode(value, { stream: true });
+                const messages = pending.split('\n');
+                pending = messages.pop();
+                messages.filter(Boolean).forEach(message => handleMessage(JSON.parse(message), line));
             }
-
         } catch (error) {
-            printToOutput(`Error: ${error.message}`);
+            if (error.name === 'AbortError') {
+                appendOutput(line, '^C');
+            } else {
+                printToOutput(`Error: ${error.message}`);
+            }
+        } finally {
+            if (running === controller) running = null;
         }
     }
 
     // --- Event Listeners ---
     inputEl.addEventListener('keydown', (e) => {
-        if (e.key === 'Enter') {
+        if (e.key === 'c' && e.ctrlKey && running && !inputEl.value) {
+            running.abort();
+        } else if (e.key === 'Enter') {
             executeCommand(inputEl.value);
             inputEl.value = '';
         } else if (e.key === 'ArrowUp') {
@@ -31,18 +31,44 @@ function initTextEditor(fileId, fileName) {
     // --- State ---
     let currentFileId = fileId;
     let currentFileName = fileName;
+    const PAGE_BYTES = 256 * 1024; // Loaded per request as the user scrolls
+    let loadedBytes = 0; // Bytes of the stored file shown in the textarea
+    let version = null; // Content version the textarea is based on
+    let eof = true;
+    let loadingPage = false;
 
     // --- Load File Content ---
+    async function loadNextPage() {
+        if (loadingPage || eof) return;
+        loadingPage = true;
+        try {
+            const response = await fetch(`/api/files/content/${currentFileId}?offset=${loadedBytes}&length=${PAGE_BYTES}`, { credentials: 'include' });
+            if (!response.ok) throw new Error('Failed to load file content.');
+            const data = await response.json();
+
+            // Append without disturbing the caret or scroll position
+            const { selectionStart, selectionEnd, scrollTop } = textarea;
+            textarea.value += data.content;
+            textarea.setSelectionRange(selectionStart, selectionEnd);
+            textarea.scrollTop = scrollTop;
+
+            loadedBytes = data.next_offset;
+            version = data.version;
+            eof = data.eof;
+        } finally {
+            loadingPage = false;
+        }
+    }
+
     async function loadContent() {
         if (isNewFile) {
             textarea.value = ''; // Start with a blank slate
             return;
         }
         try {
-            const response = await fetch(`/api/files/content/${currentFileId}`, { credentials: 'include' });
-            if (!response.ok) throw new Error('Failed to load file content.');
-            const data = await response.json();
-            textarea.value = data.content;
+            textarea.value = '';
+            eof = false;
+            await loadNextPage();
         } catch (error) {
             console.error('Error loading file:', error);
             textarea.value = `Error: ${error.message}`;
@@ -50,6 +76,12 @@ function initTextEditor(fileId, fileName) {
         }
     }
 
+    textarea.addEventListener('scroll', () => {
+        if (textarea.scrollTop + textarea.clientHeight >= textarea.scrollHeight - 200) {
+            loadNextPage().catch(error => showNotification(`Error: ${error.message}`, 'error'));
+        }
+    });
+
     // --- Save File Content ---
     saveBtn.addEventListener('click', async () => {
         const content = textarea.value;
@@ -79,14 +111,22 @@ function initTextEditor(fileId, fileName) {
                 // This means the user could open the same file twice. Acceptable for now.
             }
 
-            // Now, save the content to the (possibly new) file ID
+            // Save as a patch over the part of the file that has been loaded, so the
+            // unloaded tail of a large file never has to travel to the browser and back.
             const saveResponse = await fetch(`/api/files/content/${currentFileId}`, {
                 method: 'PUT',
                 headers: { 'Content-Type': 'application/json' },
                 credentials: 'include',
-                body: JSON.stringify({ content: content })
+                body: JSON.stringify({
+                    patches: [{ offset: 0, length: loadedBytes, content: content }],
+                    base_version: version
+                })
             });
+            if (saveResponse.status === 409) throw new Error('The file was changed elsewhere. Reopen it to get the latest version.');
             if (!saveResponse.ok) throw new Error('Failed to save file content.');
+            const saved = await saveResponse.json();
+            version = saved.version;
+            loadedBytes = new TextEncoder().encode(content).length;
 
             showNotification('File saved successfully!', 'success');
 
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend')))
+
+
+@pytest.fixture(scope='session')
+def webos(tmp_path_factory):
+    """backend/app.py with its database and uploads in a scratch directory."""
+    import app as webos
+
+    workdir = tmp_path_factory.mktemp('webos')
+    webos.DB_PATH = str(workdir / 'database.db')
+    webos.UPLOADS_FOLDER_PATH = str(workdir / 'uploads')
+    webos.app.config['TESTING'] = True
+    webos.app.config['PASSWORD_HASH_WORKERS'] = 0 # Hash inline instead of spawning a process pool
+    webos.init_db()
+    return webos
+
+
+@pytest.fixture
+def client(webos):
+    """A test client logged in as a fresh user."""
+    client = webos.app.test_client()
+    username = f'user{os.urandom(4).hex()}'
+    client.post('/api/register', json={'username': username, 'email': f'{username}@example.com', 'password': 'password'})
+    response = client.post('/api/login', json={'username': username, 'password': 'password'})
+    assert response.status_code == 200, response.get_json()
+    return client
@@ -0,0 +1,31 @@
+"""Saving file content through /api/files/content."""
+import pytest
+
+
+@pytest.fixture
+def file_id(client):
+    return client.post('/api/files/new_text_file', json={'parent_id': None}).get_json()['id']
+
+
+def test_save_and_patch(client, file_id):
+    assert client.put(f'/api/files/content/{file_id}', json={'content': 'hello world'}).status_code == 200
+    response = client.put(f'/api/files/content/{file_id}', json={'patches': [{'offset': 0, 'length': 5, 'content': 'HELLO'}]})
+    assert response.status_code == 200
+    assert client.get(f'/api/files/download/{file_id}').get_data() == b'HELLO world'
+
+
+@pytest.mark.parametrize('body', [
+    {'content': 123},
+    {'content': None},
+    {},
+    {'patches': None},
+    {'patches': [1]},
+    [],
+])
+def test_malformed_body(client, file_id, body):
+    response = client.put(f'/api/files/content/{file_id}', json=body)
+    assert response.status_code == 400, response.get_json()
+
+
+def test_non_json_body(client, file_id):
+    assert client.put(f'/api/files/content/{file_id}', data='not json', content_type='text/plain').status_code == 400
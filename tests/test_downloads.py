@@ -0,0 +1,55 @@
+"""Range requests against /api/files/download."""
+import io
+
+import pytest
+
+
+@pytest.fixture
+def file_id(client):
+    response = client.post('/api/files/upload', data={'file': (io.BytesIO(b'abc'), 'abc.txt')}, content_type='multipart/form-data')
+    assert response.status_code == 201, response.get_json()
+    return next(f['id'] for f in client.get('/api/files').get_json() if f['filename'] == 'abc.txt')
+
+
+def parse_byteranges(response):
+    boundary = response.mimetype_params['boundary'].encode()
+    parts = []
+    for part in response.get_data().split(b'--' + boundary)[1:-1]:
+        head, body = part.strip(b'\r\n').split(b'\r\n\r\n', 1)
+        headers = dict(line.split(b': ', 1) for line in head.split(b'\r\n'))
+        parts.append((headers[b'Content-Range'].decode(), body))
+    return parts
+
+
+def test_single_range(client, file_id):
+    response = client.get(f'/api/files/download/{file_id}', headers={'Range': 'bytes=1-'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 1-2/3'
+    assert response.get_data() == b'bc'
+
+
+def test_multiple_ranges(client, file_id):
+    response = client.get(f'/api/files/download/{file_id}', headers={'Range': 'bytes=0-0,2-2'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.get_data())
+    assert parse_byteranges(response) == [('bytes 0-0/3', b'a'), ('bytes 2-2/3', b'c')]
+
+
+def test_multiple_ranges_with_matching_if_range(client, file_id):
+    etag = client.get(f'/api/files/download/{file_id}').headers['ETag']
+    response = client.get(f'/api/files/download/{file_id}', headers={'Range': 'bytes=0-0,-1', 'If-Range': etag})
+    assert response.status_code == 206
+    assert parse_byteranges(response) == [('bytes 0-0/3', b'a'), ('bytes 2-2/3', b'c')]
+
+
+def test_multiple_ranges_with_stale_if_range(client, file_id):
+    response = client.get(f'/api/files/download/{file_id}', headers={'Range': 'bytes=0-0,2-2', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.get_data() == b'abc'
+
+
+def test_unsatisfiable_ranges(client, file_id):
+    response = client.get(f'/api/files/download/{file_id}', headers={'Range': 'bytes=5-6,8-9'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */3'
@@ -0,0 +1,29 @@
+"""Name clashes in a folder are 409s, however the requests interleave."""
+import threading
+
+
+def test_create_folder_name_taken(client):
+    assert client.post('/api/files/folder', json={'filename': 'docs', 'parent_id': None}).status_code == 201
+    assert client.post('/api/files/folder', json={'filename': 'docs', 'parent_id': None}).status_code == 409
+
+
+def test_concurrent_create_folder(webos, client):
+    cookie = client.get_cookie('session')
+    statuses = []
+
+    def create():
+        other = webos.app.test_client()
+        other.set_cookie(cookie.key, cookie.value)
+        statuses.append(other.post('/api/files/folder', json={'filename': 'race', 'parent_id': None}).status_code)
+
+    threads = [threading.Thread(target=create) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(statuses) == [201] + [409] * 7
+
+
+def test_new_text_file_picks_free_name(client):
+    names = [client.post('/api/files/new_text_file', json={'parent_id': None}).get_json()['filename'] for _ in range(3)]
+    assert names == ['Untitled.txt', 'Untitled (1).txt', 'Untitled (2).txt']
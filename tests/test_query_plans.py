@@ -0,0 +1,38 @@
+"""EXPLAIN QUERY PLAN checks for the files hot paths: each must search an idx_files_* index, never scan the table."""
+import pytest
+
+LISTING = 'SELECT id, filename, is_folder, created_at FROM files WHERE user_id = ? AND {} ORDER BY is_folder DESC, filename ASC'
+NAME_LOOKUP = 'SELECT 1 FROM files WHERE user_id = ? AND filename = ? AND {}'
+
+HOT_QUERIES = {
+    'root listing': (LISTING.format('parent_id IS NULL'), (1,)),
+    'folder listing': (LISTING.format('parent_id = ?'), (1, 2)),
+    'path lookup': ('SELECT * FROM files WHERE user_id = ? AND path = ?', (1, '/docs/notes.txt')),
+    'root name lookup': (NAME_LOOKUP.format('parent_id IS NULL'), (1, 'notes.txt')),
+    'folder name lookup': (NAME_LOOKUP.format('parent_id = ?'), (1, 'notes.txt', 2)),
+    'child lookup': ('SELECT id FROM files WHERE parent_id = ?', (2,)),
+}
+
+
+@pytest.fixture(scope='module')
+def conn(webos):
+    conn = webos.connect_db()
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, query, params):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+
+
+@pytest.mark.parametrize('name', HOT_QUERIES)
+def test_hot_query_uses_files_index(conn, name):
+    plan = query_plan(conn, *HOT_QUERIES[name])
+    assert not any(step.startswith('SCAN files') for step in plan), plan
+    assert any(step.startswith('SEARCH files USING') and 'INDEX idx_files_' in step for step in plan), plan
+
+
+@pytest.mark.parametrize('name', ['root listing', 'folder listing'])
+def test_listing_is_read_in_index_order(conn, name):
+    plan = query_plan(conn, *HOT_QUERIES[name])
+    assert not any('TEMP B-TREE' in step for step in plan), plan
@@ -0,0 +1,37 @@
+"""FileReclaimer: queued files are unlinked, re-uploaded content is kept."""
+import hashlib
+import io
+import os
+
+
+def upload(client, name, content):
+    response = client.post('/api/files/upload', data={'file': (io.BytesIO(content), name)}, content_type='multipart/form-data')
+    assert response.status_code == 201, response.get_json()
+    return next(f['id'] for f in client.get('/api/files').get_json() if f['filename'] == name)
+
+
+def blob_path(webos, content):
+    return webos.blob_path(hashlib.sha256(content).hexdigest())
+
+
+def drain(webos):
+    while webos.file_reclaimer.reclaim_batch():
+        pass
+
+
+def test_deleted_blob_is_unlinked(webos, client):
+    content = b'reclaim me'
+    file_id = upload(client, 'gone.txt', content)
+    assert os.path.exists(blob_path(webos, content))
+    client.delete(f'/api/files/delete/{file_id}')
+    drain(webos)
+    assert not os.path.exists(blob_path(webos, content))
+    assert os.listdir(os.path.join(webos.UPLOADS_FOLDER_PATH, 'trash')) == []
+
+
+def test_blob_uploaded_again_is_kept(webos, client):
+    content = b'back again'
+    client.delete(f"/api/files/delete/{upload(client, 'first.txt', content)}")
+    upload(client, 'second.txt', content)
+    drain(webos)
+    assert os.path.exists(blob_path(webos, content))
@@ -0,0 +1,11 @@
+"""Paging through /api/search."""
+import pytest
+
+
+@pytest.mark.parametrize('limit', ['0', '-1'])
+def test_limit_below_one_still_advances(client, limit):
+    for name in ('alpha-one', 'alpha-two'):
+        client.post('/api/files/folder', json={'filename': name, 'parent_id': None})
+    body = client.get(f'/api/search?q=alpha&in=name&limit={limit}').get_json()
+    assert len(body['results']) == 1
+    assert body['next_offset'] == 1
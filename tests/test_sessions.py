@@ -0,0 +1,28 @@
+"""Server-side login sessions."""
+import time
+
+
+def test_login_rotates_session_id(webos, client):
+    old_sid = client.get_cookie('session').value
+    response = client.post('/api/login', json={'username': client.get('/api/check_session').get_json()['username'],
+                                               'password': 'password'})
+    assert response.status_code == 200
+    new_sid = client.get_cookie('session').value
+    assert new_sid != old_sid
+    assert client.get('/api/check_session').status_code == 200
+
+    stale = webos.app.test_client()
+    stale.set_cookie('session', old_sid)
+    assert stale.get('/api/check_session').status_code == 401
+
+
+def test_expire_batch(webos, client):
+    sid = client.get_cookie('session').value
+    conn = webos.get_db_connection()
+    conn.execute('UPDATE sessions SET expires_at = ? WHERE id = ?', (time.time() - 1, sid))
+    conn.commit()
+    conn.close()
+    assert webos.app.session_interface.expire_batch(100) >= 1
+    conn = webos.get_db_connection()
+    assert conn.execute('SELECT 1 FROM sessions WHERE id = ?', (sid,)).fetchone() is None
+    conn.close()
@@ -0,0 +1,40 @@
+"""Terminal commands run through /api/terminal/execute."""
+import io
+import json
+
+import pytest
+
+
+@pytest.fixture
+def run(client):
+    def run(command):
+        return client.post('/api/terminal/execute', json={'command': command, 'cwd_id': None}).get_json()['output']
+    return run
+
+
+def test_find_name_is_exact(client, run):
+    run('mkdir -p docs/report docs/reports')
+    client.post('/api/files/upload', data={'file': (io.BytesIO(b'x'), 'report.txt')}, content_type='multipart/form-data')
+    run('mv report.txt docs')
+    assert run('find -name report') == '~/docs/report/'
+    assert run('find docs -name repor') == ''
+    assert run('find -name report* -type d') == '~/docs/report/\n~/docs/reports/'
+    assert run('find -name report* -type f') == '~/docs/report.txt'
+
+
+def test_command_names_are_case_insensitive(run):
+    run('mkdir Upper')
+    assert run('LS') == 'Upper/'
+    assert run('nosuch') == 'nosuch: command not found'
+
+
+def test_streamed_failure_ends_with_error_record(webos, client, monkeypatch):
+    def boom(term, args, stdin):
+        yield 'partial\n'
+        raise RuntimeError('kaboom')
+    monkeypatch.setitem(webos.TERMINAL_COMMANDS, 'boom', (boom, 'boom'))
+    response = client.post('/api/terminal/execute', json={'command': 'boom', 'cwd_id': None},
+                           headers={'Accept': 'application/x-ndjson'})
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert records[0] == {'output': 'partial\n'}
+    assert records[-1] == {'error': 'Command failed: kaboom'}
@@ -0,0 +1,13 @@
+"""/api/files/thumbnail for files without a usable image."""
+
+
+def test_missing_legacy_file(webos, client):
+    client.post('/api/files/folder', json={'filename': 'legacy', 'parent_id': None})
+    conn = webos.get_db_connection()
+    user_id, folder_id = conn.execute("SELECT user_id, id FROM files WHERE filename = 'legacy' ORDER BY id DESC").fetchone()
+    # A file stored before the blob store, whose content has gone missing
+    file_id = conn.execute('INSERT INTO files (user_id, parent_id, filename, is_folder, file_path, path) VALUES (?, ?, ?, ?, ?, ?)',
+                           (user_id, folder_id, 'photo.jpg', False, '/nonexistent/photo.jpg', '/legacy/photo.jpg')).lastrowid
+    conn.commit()
+    conn.close()
+    assert client.get(f'/api/files/thumbnail/{file_id}').status_code == 415